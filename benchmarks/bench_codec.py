@@ -0,0 +1,96 @@
+"""
+Compare JSON and MessagePack for the catalog payload exchanged between services.
+
+Builds a catalog shaped like ``GET /inventory`` (``Product.to_dict()`` rows),
+then reports the encoded size and the best-of-N encode and decode times of
+both formats. JSON is encoded the way Flask's default provider does it
+(compact separators, sorted keys).
+
+Usage::
+
+    python benchmarks/bench_codec.py [--products 100000] [--repeat 5] [--json-output FILE]
+"""
+import argparse
+import json
+import random
+import string
+import sys
+import time
+
+try:
+    import msgpack
+except ImportError:
+    sys.exit("msgpack is required: pip install msgpack")
+
+CATEGORIES = ["food", "clothes", "accessories", "electronics"]
+
+
+def make_catalog(size, seed=435):
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(2000)]
+    return [
+        {
+            "id": i,
+            "name": " ".join(rng.choices(words, k=3)).title(),
+            "category": rng.choice(CATEGORIES),
+            "price_per_item": round(rng.uniform(0.5, 2000), 2),
+            "description": " ".join(rng.choices(words, k=rng.randint(5, 25))),
+            "count_in_stock": rng.randint(0, 500),
+        }
+        for i in range(1, size + 1)
+    ]
+
+
+def best_of(repeat, fn):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json-output", help="Also write the results to this file as JSON")
+    args = parser.parse_args(argv)
+
+    catalog = make_catalog(args.products)
+    codecs = {
+        "json": (
+            lambda obj: json.dumps(obj, separators=(",", ":"), sort_keys=True).encode(),
+            lambda data: json.loads(data),
+        ),
+        "msgpack": (
+            lambda obj: msgpack.packb(obj, use_bin_type=True),
+            lambda data: msgpack.unpackb(data, raw=False),
+        ),
+    }
+
+    results = {}
+    for name, (encode, decode) in codecs.items():
+        payload = encode(catalog)
+        assert decode(payload) == catalog
+        results[name] = {
+            "bytes": len(payload),
+            "encode_ms": best_of(args.repeat, lambda: encode(catalog)) * 1000,
+            "decode_ms": best_of(args.repeat, lambda: decode(payload)) * 1000,
+        }
+
+    print(f"{args.products} products, best of {args.repeat}")
+    print(f"{'codec':<10}{'bytes':>14}{'encode ms':>12}{'decode ms':>12}")
+    for name, result in results.items():
+        print(f"{name:<10}{result['bytes']:>14,}{result['encode_ms']:>12.1f}{result['decode_ms']:>12.1f}")
+    baseline = results["json"]
+    for metric in ("bytes", "encode_ms", "decode_ms"):
+        print(f"msgpack/json {metric}: {results['msgpack'][metric] / baseline[metric]:.2f}")
+
+    if args.json_output:
+        with open(args.json_output, "w") as f:
+            json.dump({"products": args.products, "repeat": args.repeat, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
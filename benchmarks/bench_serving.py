@@ -0,0 +1,167 @@
+"""
+Compare Flask's development server with the gunicorn production setup.
+
+Boots the inventory service twice on the same SQLite file, once with
+``flask run`` (threaded development server) and once with
+``gunicorn -c gunicorn.conf.py wsgi:app``. Each run gets ``--clients``
+keep-alive clients that read ``GET /inventory/<id>`` for ``--duration``
+seconds. The benchmark reports requests per second and latency percentiles
+for each server. Workers and threads of the gunicorn run come from
+``--workers`` and ``--threads`` (default: the gunicorn.conf.py defaults).
+
+Usage::
+
+    python benchmarks/bench_serving.py [--clients 16] [--duration 10]
+        [--workers N] [--threads N] [--json-output FILE]
+
+Requires gunicorn (``pip install gunicorn``).
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+SERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inventory_service")
+PRODUCTS = 200
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"Server exited with status {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    sys.exit(f"Server did not come up at {url}")
+
+
+def start_server(kind, port, env, workers, threads):
+    if kind == "dev":
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"]
+        env = dict(env, GUNICORN_BIND=f"127.0.0.1:{port}")
+        if workers:
+            env["WEB_CONCURRENCY"] = str(workers)
+        if threads:
+            env["GUNICORN_THREADS"] = str(threads)
+    return subprocess.Popen(command, cwd=SERVICE_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def seed(base_url):
+    for i in range(PRODUCTS):
+        requests.post(f"{base_url}/inventory", json={
+            "name": f"Product {i}",
+            "category": "Electronics",
+            "price_per_item": 10.0 + i,
+            "description": "Benchmark product",
+            "count_in_stock": 100,
+        }).raise_for_status()
+
+
+def load(base_url, clients, duration):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        rng = random.Random()
+        local = []
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            try:
+                ok = session.get(f"{base_url}/inventory/{rng.randint(1, PRODUCTS)}").status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - start)
+            else:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else None
+
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--json-output", help="Also write the results to this file as JSON")
+    args = parser.parse_args(argv)
+
+    results = {"clients": args.clients, "duration": args.duration, "cpus": os.cpu_count()}
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'inventory.db')}")
+        subprocess.run([sys.executable, "-m", "flask", "--app", "app", "init-db"],
+                       cwd=SERVICE_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+        for kind in ("dev", "gunicorn"):
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            process = start_server(kind, port, env, args.workers, args.threads)
+            try:
+                wait_until_up(f"{base_url}/inventory/1", process)
+                if kind == "dev":
+                    seed(base_url)
+                results[kind] = load(base_url, args.clients, args.duration)
+            finally:
+                process.terminate()
+                process.wait()
+
+    for kind in ("dev", "gunicorn"):
+        r = results[kind]
+        print(f"{kind:>9}: {r['requests_per_second']:8.0f} req/s  p50 {r['p50_ms']:.1f} ms  "
+              f"p95 {r['p95_ms']:.1f} ms  p99 {r['p99_ms']:.1f} ms  ({r['errors']} errors)")
+    print(f"speedup: {results['gunicorn']['requests_per_second'] / results['dev']['requests_per_second']:.2f}x "
+          f"on {results['cpus']} CPU(s)")
+
+    if args.json_output:
+        with open(args.json_output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Measure stock-decrement throughput on a single hot product.
+
+Runs the inventory service's :class:`combiner.StockCombiner` in-process
+against a real database, with ``--threads`` concurrent workers each taking
+one unit at a time until ``--decrements`` requests have been made. The
+baseline (``max_batch=1``, no window) commits each decrement on its own, as
+the service did before the combiner existed. The combined run uses the
+service defaults. Stock starts below the number of requests, so both runs
+also exercise rejections. The benchmark checks that no run oversells.
+
+Usage::
+
+    python benchmarks/bench_stock_combiner.py [--threads 32] [--decrements 5000]
+        [--database-url URL] [--json-output FILE]
+
+Without ``--database-url`` a temporary SQLite file is used; pass a
+PostgreSQL URL to measure row-lock contention as in production.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inventory_service"))
+
+from flask import Flask  # noqa: E402
+
+from combiner import GRANTED, StockCombiner  # noqa: E402
+from db import db  # noqa: E402
+from models import Product, ProductChange  # noqa: E402
+
+STOCK_RATIO = 0.9
+
+
+def make_app(database_url):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    if database_url.startswith("sqlite"):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 60}}
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def run(app, combiner, threads, decrements):
+    stock = int(decrements * STOCK_RATIO)
+    with app.app_context():
+        db.session.query(ProductChange).delete()
+        db.session.query(Product).delete()
+        product = Product(name="Hot SKU", category="Electronics", price_per_item=1.0, count_in_stock=stock)
+        db.session.add(product)
+        db.session.commit()
+        product_id = product.id
+
+    remaining = [decrements]
+    granted = [0]
+    lock = threading.Lock()
+
+    def worker():
+        with app.app_context():
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        return
+                    remaining[0] -= 1
+                outcome, _ = combiner.decrement(product_id, 1)
+                if outcome == GRANTED:
+                    with lock:
+                        granted[0] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        final_stock = db.session.get(Product, product_id).count_in_stock
+    if granted[0] != stock - final_stock or final_stock < 0:
+        sys.exit(f"Inconsistent stock: granted {granted[0]}, stock {stock} -> {final_stock}")
+    return {
+        "seconds": elapsed,
+        "decrements_per_second": decrements / elapsed,
+        "granted": granted[0],
+        "rejected": decrements - granted[0],
+        "combiner": combiner.stats(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--decrements", type=int, default=5000)
+    parser.add_argument("--database-url")
+    parser.add_argument("--json-output", help="Also write the results to this file as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        app = make_app(database_url)
+        results = {
+            "database": database_url.split(":", 1)[0],
+            "threads": args.threads,
+            "decrements": args.decrements,
+            "individual": run(app, StockCombiner(window=0, max_batch=1), args.threads, args.decrements),
+            "combined": run(app, StockCombiner(), args.threads, args.decrements),
+        }
+        with app.app_context():
+            db.engine.dispose()
+
+    for name in ("individual", "combined"):
+        r = results[name]
+        print(f"{name:>10}: {r['decrements_per_second']:10.0f} decrements/s "
+              f"({r['granted']} granted, {r['rejected']} rejected, "
+              f"avg batch {r['combiner']['avg_batch']:.1f}, {r['combiner']['conflicts']} conflicts)")
+    speedup = results["combined"]["decrements_per_second"] / results["individual"]["decrements_per_second"]
+    print(f"speedup: {speedup:.1f}x")
+
+    if args.json_output:
+        with open(args.json_output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+HTTP proxy that injects latency, errors and dropped connections.
+
+Put a :class:`FaultProxy` between a service and one of its downstreams, e.g.
+between sales and the customer service, to see how timeouts, retries and
+circuit breakers behave when the downstream is slow or flaky. Requests are
+matched against a list of rules, and the first matching rule applies:
+
+``method``, ``path``
+    HTTP method (any if omitted) and ``fnmatch`` pattern of the path
+    (default ``*``), e.g. ``{"method": "POST", "path": "/customers/*/deduct"}``.
+``latency``
+    Delay added before the request is handled. One of
+    ``{"dist": "fixed", "ms": 50}``,
+    ``{"dist": "uniform", "min_ms": 10, "max_ms": 200}``,
+    ``{"dist": "normal", "mean_ms": 50, "stddev_ms": 20}``,
+    ``{"dist": "lognormal", "median_ms": 20, "sigma": 1.0}`` (a long tail) or
+    ``{"dist": "exponential", "mean_ms": 30}``.
+``error_rate``, ``error_status``
+    Fraction of requests answered with ``error_status`` (default 503)
+    without reaching the upstream.
+``drop_rate``, ``drop``
+    Fraction of requests whose connection is closed without an answer.
+    With ``"drop": "before"`` (the default) the upstream never sees the
+    request; with ``"drop": "after"`` it handles the request and only the
+    answer is lost, as when a response times out after the write happened.
+
+Requests no rule matches are forwarded unchanged. Bodies and headers pass
+through as they are, including compressed and msgpack-encoded ones.
+
+The proxy also answers on ``/_faults``. ``GET`` returns the rules and, per
+rule, how many requests matched, were delayed, got an injected error or were
+dropped. ``PUT`` with a JSON list replaces the rules.
+
+Used on its own::
+
+    python benchmarks/faultproxy.py --upstream http://127.0.0.1:5001
+        [--port 6001] [--rules RULES] [--seed N]
+
+``RULES`` is a JSON list of rules or the path of a file holding one. Then
+point the service at the proxy, e.g. ``CUSTOMERS_SERVICE_URL=http://127.0.0.1:6001``.
+``benchmarks/loadtest.py --faults FILE`` starts proxies in front of the
+customer and inventory services itself.
+"""
+import argparse
+import fnmatch
+import http.server
+import json
+import math
+import random
+import socket
+import sys
+import threading
+import time
+
+import requests
+
+LATENCY_DISTRIBUTIONS = {
+    "fixed": lambda rng, ms: ms,
+    "uniform": lambda rng, min_ms, max_ms: rng.uniform(min_ms, max_ms),
+    "normal": lambda rng, mean_ms, stddev_ms: max(0.0, rng.gauss(mean_ms, stddev_ms)),
+    "lognormal": lambda rng, median_ms, sigma: rng.lognormvariate(math.log(median_ms), sigma),
+    "exponential": lambda rng, mean_ms: rng.expovariate(1.0 / mean_ms),
+}
+
+# Headers that describe one connection, not the message
+HOP_BY_HOP = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "content-length", "host",
+}
+
+CONTROL_PATH = "/_faults"
+
+
+class FaultRule:
+    """One entry of the proxy's rule list; see the module docstring."""
+
+    def __init__(self, path="*", method=None, latency=None, error_rate=0.0, error_status=503,
+                 drop_rate=0.0, drop="before"):
+        if latency is not None:
+            params = dict(latency)
+            dist = params.pop("dist", None)
+            if dist not in LATENCY_DISTRIBUTIONS:
+                raise ValueError(f"Unknown latency distribution {dist!r}")
+            # Fail on bad parameters now rather than in the middle of a run
+            LATENCY_DISTRIBUTIONS[dist](random.Random(0), **params)
+        if drop not in ("before", "after"):
+            raise ValueError(f"drop must be 'before' or 'after', not {drop!r}")
+        if not (0 <= error_rate <= 1 and 0 <= drop_rate <= 1):
+            raise ValueError("error_rate and drop_rate must be between 0 and 1")
+        self.path = path
+        self.method = method.upper() if method else None
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.drop = drop
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "method": self.method,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "error_status": self.error_status,
+            "drop_rate": self.drop_rate,
+            "drop": self.drop,
+        }
+
+    def matches(self, method, path):
+        return (self.method is None or self.method == method) and fnmatch.fnmatchcase(path, self.path)
+
+    def delay(self, rng):
+        """Seconds to delay a request by."""
+        if self.latency is None:
+            return 0.0
+        params = dict(self.latency)
+        return LATENCY_DISTRIBUTIONS[params.pop("dist")](rng, **params) / 1000
+
+
+def load_rules(value):
+    """
+    Parse rules given as a JSON list, or as the path of a file holding one.
+    """
+    if value.lstrip().startswith("["):
+        data = json.loads(value)
+    else:
+        with open(value) as f:
+            data = json.load(f)
+    return [FaultRule.from_dict(rule) for rule in data]
+
+
+def _new_counters():
+    return {"requests": 0, "delayed": 0, "errors": 0, "drops": 0, "upstream_failures": 0}
+
+
+class FaultProxy:
+    """
+    Fault-injecting reverse proxy in front of ``upstream``.
+
+    :param upstream: Base URL requests are forwarded to.
+    :param rules: :class:`FaultRule` list; the first matching rule applies.
+    :param port: Port to listen on (0 picks a free one).
+    :param seed: Seed of the random faults, for repeatable runs.
+    """
+
+    def __init__(self, upstream, rules=(), port=0, host="127.0.0.1", seed=None):
+        self.upstream = upstream.rstrip("/")
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.set_rules(rules)
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def set_rules(self, rules):
+        """Replace the rules and reset the counters."""
+        with self._lock:
+            self.rules = list(rules)
+            self._counters = [_new_counters() for _ in self.rules]
+            self._unmatched = _new_counters()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "upstream": self.upstream,
+                "rules": [
+                    dict(rule.to_dict(), **counters)
+                    for rule, counters in zip(self.rules, self._counters)
+                ],
+                "unmatched": dict(self._unmatched),
+                "injected": sum(c["errors"] + c["drops"] for c in self._counters),
+            }
+
+    def start(self):
+        """Serve in a background thread; returns the proxy."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fault-proxy", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _decide(self, method, path):
+        """Pick the rule for a request and roll its faults."""
+        with self._lock:
+            for rule, counters in zip(self.rules, self._counters):
+                if rule.matches(method, path):
+                    break
+            else:
+                self._unmatched["requests"] += 1
+                return None, self._unmatched, 0.0, None
+            counters["requests"] += 1
+            delay = rule.delay(self._rng)
+            if delay > 0:
+                counters["delayed"] += 1
+            roll = self._rng.random()
+            if roll < rule.drop_rate:
+                fault = "drop"
+                counters["drops"] += 1
+            elif roll < rule.drop_rate + rule.error_rate:
+                fault = "error"
+                counters["errors"] += 1
+            else:
+                fault = None
+            return rule, counters, delay, fault
+
+    def _forward(self, method, path, headers, body):
+        response = self._session().request(
+            method, self.upstream + path, headers=headers, data=body,
+            stream=True, allow_redirects=False, timeout=60,
+        )
+        # Pass the body through as sent, e.g. still gzip-compressed
+        content = response.raw.read(decode_content=False)
+        return response.status_code, response.reason, response.headers, content
+
+    def _handler_class(self):
+        proxy = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, headers, body, reason=None):
+                self.send_response(status, reason)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_json(self, status, data):
+                self._send(status, [("Content-Type", "application/json")], json.dumps(data).encode())
+
+            def _drop(self):
+                self.close_connection = True
+                try:
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+            def _control(self, body):
+                if self.command == "GET":
+                    return self._send_json(200, proxy.stats())
+                if self.command == "PUT":
+                    try:
+                        proxy.set_rules(FaultRule.from_dict(rule) for rule in json.loads(body))
+                    except (TypeError, ValueError) as e:
+                        return self._send_json(400, {"error": str(e)})
+                    return self._send_json(200, proxy.stats())
+                return self._send_json(405, {"error": "Method not allowed"})
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else None
+                if self.path.split("?", 1)[0] == CONTROL_PATH:
+                    return self._control(body)
+
+                rule, counters, delay, fault = proxy._decide(self.command, self.path.split("?", 1)[0])
+                if delay:
+                    time.sleep(delay)
+                if fault == "error":
+                    return self._send_json(rule.error_status, {"error": "Injected fault"})
+                if fault == "drop" and rule.drop == "before":
+                    return self._drop()
+
+                headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP}
+                try:
+                    status, reason, response_headers, content = proxy._forward(
+                        self.command, self.path, headers, body
+                    )
+                except requests.RequestException:
+                    with proxy._lock:
+                        counters["upstream_failures"] += 1
+                    return self._send_json(502, {"error": "Upstream unavailable"})
+                if fault == "drop":
+                    return self._drop()
+                self._send(status, [(k, v) for k, v in response_headers.items()
+                                    if k.lower() not in HOP_BY_HOP], content, reason)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_HEAD = _handle
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--upstream", required=True, help="Base URL of the service behind the proxy")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--rules", help="JSON list of rules, or a file holding one")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    proxy = FaultProxy(args.upstream, load_rules(args.rules) if args.rules else [],
+                       port=args.port, host=args.host, seed=args.seed)
+    print(f"proxying {proxy.url} -> {proxy.upstream} with {len(proxy.rules)} rule(s)", file=sys.stderr)
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+"""
+End-to-end load test of all four services.
+
+Boots customer, inventory, sales and reviews as local subprocesses, each on
+its own SQLite file in a temporary directory, wired to each other as in
+docker-compose. It then seeds ``--customers`` customers, ``--products``
+products and ``--reviews`` reviews through the public APIs. Finally
+``--clients`` closed-loop clients drive a weighted mix of requests for
+``--duration`` seconds:
+
+==================  ==============================================
+operation           request
+==================  ==============================================
+``browse``          ``GET /goods`` (sales)
+``product``         ``GET /goods/<id>`` (sales)
+``checkout``        ``POST /sale`` of one unit (sales)
+``review_submit``   ``POST /reviews`` in upsert mode (reviews)
+``review_list``     ``GET /products/<id>/reviews`` (reviews)
+==================  ==============================================
+
+``--workload`` picks one of the mixes in :data:`WORKLOADS`. The first
+``--warmup`` seconds are not recorded. The result is JSON with the settings
+and, per endpoint and in total: requests, errors by status, throughput and
+p50/p95/p99/max latency. It is printed as a table and written to
+``--json-output``. With ``--baseline`` the result is compared with an
+earlier one. The script exits with status 1 if an endpoint's p95 latency rose
+or its throughput fell by more than ``--max-regression``.
+
+The services run in separate processes because their modules share names
+(``app``, ``db``, ``models``); they cannot be imported side by side. Each runs
+under gunicorn with ``--workers`` workers of ``--threads`` threads, or under
+Flask's development server with ``--server dev``. ``--env KEY=VALUE`` sets
+a variable for every service, e.g. ``--env SALES_WRITE_BEHIND=1``.
+
+``--faults FILE`` puts a :class:`faultproxy.FaultProxy` in front of the
+customer and/or inventory service, as seen from sales and reviews, e.g.
+``benchmarks/faults.example.json``. The rules are switched on after seeding.
+The result then also holds each proxy's counters, and the table shows how
+many client errors each injected fault caused. To get a baseline with the
+same proxy overhead, run with a file whose rule lists are empty. The proxies
+run in the load generator's process, so they compete with it for CPU.
+
+Usage::
+
+    python benchmarks/loadtest.py [--workload mixed] [--clients 16]
+        [--duration 30] [--warmup 5] [--customers 500] [--products 200]
+        [--reviews 1000] [--server gunicorn|dev] [--workers 1] [--threads 8]
+        [--env KEY=VALUE ...] [--faults FILE] [--json-output FILE]
+        [--baseline FILE] [--max-regression 0.2]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_serving import free_port, wait_until_up
+from faultproxy import FaultProxy, FaultRule
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SERVICES = {
+    "customers": "customer_service",
+    "inventory": "inventory_service",
+    "sales": "sales_service",
+    "reviews": "reviews_service",
+}
+# A URL that answers 200 once the service is up
+HEALTH_PATHS = {
+    "customers": "/customers",
+    "inventory": "/inventory",
+    "sales": "/catalog/status",
+    "reviews": "/downstreams",
+}
+# Services called by sales and reviews, and the setting that points at them
+DOWNSTREAM_SETTINGS = {
+    "customers": "CUSTOMERS_SERVICE_URL",
+    "inventory": "INVENTORY_SERVICE_URL",
+}
+
+WORKLOADS = {
+    "mixed": {"browse": 50, "product": 15, "checkout": 15, "review_submit": 10, "review_list": 10},
+    "browse": {"browse": 70, "product": 30},
+    "checkout": {"checkout": 100},
+    "reviews": {"review_submit": 30, "review_list": 70},
+}
+
+CATEGORIES = ["Food", "Clothes", "Accessories", "Electronics"]
+COMMENTS = [
+    "Great value for the price.",
+    "Works as described, would buy again.",
+    "Arrived late and the box was damaged.",
+    "Not what I expected, quality could be better.",
+    "Excellent! Exactly what I needed.",
+]
+
+
+class Cluster:
+    """
+    The four services running as subprocesses in ``workdir``.
+
+    Ports are picked when the cluster is created, so :attr:`urls` is known
+    before :meth:`start`. To put something between the services (e.g. a
+    fault-injecting proxy), point :attr:`downstream_urls` elsewhere before
+    starting; sales and reviews then call those URLs instead.
+    """
+
+    def __init__(self, workdir, server="gunicorn", workers=1, threads=8, env=None):
+        self.workdir = workdir
+        self.server = server
+        self.workers = workers
+        self.threads = threads
+        self.env = dict(env or {})
+        self.urls = {name: f"http://127.0.0.1:{free_port()}" for name in SERVICES}
+        self.downstream_urls = {name: self.urls[name] for name in DOWNSTREAM_SETTINGS}
+        self.processes = {}
+
+    def _service_env(self, name):
+        service_dir = os.path.abspath(os.path.join(ROOT, SERVICES[name]))
+        run_dir = os.path.join(self.workdir, name)
+        os.makedirs(run_dir, exist_ok=True)
+        env = dict(
+            os.environ,
+            PYTHONPATH=service_dir,
+            DATABASE_URL=f"sqlite:///{os.path.join(run_dir, name + '.db')}",
+            SALES_JOURNAL_DIR=os.path.join(run_dir, "journal"),
+            **{setting: self.downstream_urls[downstream]
+               for downstream, setting in DOWNSTREAM_SETTINGS.items()},
+        )
+        env.update(self.env)
+        return service_dir, run_dir, env
+
+    def _command(self, name, service_dir):
+        port = self.urls[name].rsplit(":", 1)[1]
+        if self.server == "dev":
+            return [sys.executable, "-m", "flask", "--app", "app", "run", "--port", port, "--with-threads"], {}
+        return (
+            [sys.executable, "-m", "gunicorn", "-c", os.path.join(service_dir, "gunicorn.conf.py"), "wsgi:app"],
+            {
+                "GUNICORN_BIND": f"127.0.0.1:{port}",
+                "WEB_CONCURRENCY": str(self.workers),
+                "GUNICORN_THREADS": str(self.threads),
+            },
+        )
+
+    def start(self):
+        for name in SERVICES:
+            service_dir, run_dir, env = self._service_env(name)
+            # Run from a scratch directory so profiling logs and journals
+            # stay out of the source tree
+            subprocess.run([sys.executable, "-m", "flask", "--app", "app", "init-db"],
+                           cwd=run_dir, env=env, check=True, stdout=subprocess.DEVNULL)
+            command, server_env = self._command(name, service_dir)
+            log = open(os.path.join(run_dir, "server.log"), "w")
+            self.processes[name] = subprocess.Popen(
+                command, cwd=run_dir, env=dict(env, **server_env),
+                stdout=log, stderr=subprocess.STDOUT,
+            )
+            log.close()
+        for name, process in self.processes.items():
+            wait_until_up(self.urls[name] + HEALTH_PATHS[name], process)
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.processes = {}
+
+    def __enter__(self):
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def seed(cluster, customers, products, reviews, rng, parallelism=8):
+    """
+    Create customers, products and reviews through the services' APIs.
+
+    :return: The data the workload draws from: usernames, product ids and
+        names, and the password shared by all customers.
+    """
+    urls = cluster.urls
+    password = "loadtest"
+    usernames = [f"user{i}" for i in range(customers)]
+    names = [f"Product {i}" for i in range(products)]
+
+    def post(url, body, ok=(200, 201)):
+        response = requests.post(url, json=body, timeout=30)
+        if response.status_code not in ok:
+            raise RuntimeError(f"Seeding {url} failed: {response.status_code} {response.text[:200]}")
+
+    with ThreadPoolExecutor(parallelism) as pool:
+        list(pool.map(lambda username: post(f"{urls['customers']}/customers", {
+            "full_name": username.title(),
+            "username": username,
+            "password": password,
+            "age": rng.randint(18, 80),
+            "address": f"{rng.randint(1, 999)} Main Street",
+            "gender": rng.choice(["Male", "Female"]),
+            "marital_status": rng.choice(["Single", "Married"]),
+            "wallet_balance": 1e9,
+        }), usernames))
+        # Products are created in order, so product i gets id i + 1
+        for i, name in enumerate(names):
+            post(f"{urls['inventory']}/inventory", {
+                "name": name,
+                "category": CATEGORIES[i % len(CATEGORIES)],
+                "price_per_item": round(rng.uniform(1, 500), 2),
+                "description": f"Load test product {i}",
+                "count_in_stock": 10 ** 7,
+            })
+        product_ids = list(range(1, products + 1))
+        pairs = rng.sample(range(customers * products), min(reviews, customers * products))
+        list(pool.map(lambda pair: post(f"{urls['reviews']}/reviews", {
+            "username": usernames[pair // products],
+            "password": password,
+            "product_id": product_ids[pair % products],
+            "rating": rng.randint(0, 5),
+            "comment": rng.choice(COMMENTS),
+            "upsert": True,
+        }), pairs))
+    return {"usernames": usernames, "product_ids": product_ids, "product_names": names, "password": password}
+
+
+def browse(session, urls, data, rng):
+    return session.get(f"{urls['sales']}/goods", timeout=30)
+
+
+def product(session, urls, data, rng):
+    product_id = rng.choice(data["product_ids"])
+    return session.get(f"{urls['sales']}/goods/{product_id}", timeout=30)
+
+
+def checkout(session, urls, data, rng):
+    return session.post(f"{urls['sales']}/sale", json={
+        "product_name": rng.choice(data["product_names"]),
+        "username": rng.choice(data["usernames"]),
+        "quantity": 1,
+    }, timeout=30)
+
+
+def review_submit(session, urls, data, rng):
+    return session.post(f"{urls['reviews']}/reviews", json={
+        "username": rng.choice(data["usernames"]),
+        "password": data["password"],
+        "product_id": rng.choice(data["product_ids"]),
+        "rating": rng.randint(0, 5),
+        "comment": rng.choice(COMMENTS),
+        "upsert": True,
+    }, timeout=30)
+
+
+def review_list(session, urls, data, rng):
+    product_id = rng.choice(data["product_ids"])
+    return session.get(f"{urls['reviews']}/products/{product_id}/reviews", timeout=30)
+
+
+OPERATIONS = {
+    "browse": ("GET /goods", browse),
+    "product": ("GET /goods/<id>", product),
+    "checkout": ("POST /sale", checkout),
+    "review_submit": ("POST /reviews", review_submit),
+    "review_list": ("GET /products/<id>/reviews", review_list),
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))] * 1000
+
+
+def summarize(latencies, statuses, elapsed):
+    """Throughput and latency of one endpoint (or all of them)."""
+    latencies = sorted(latencies)
+    errors = {status: n for status, n in statuses.items() if not str(status).startswith("2")}
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors.values()),
+        "error_statuses": errors,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": latencies[-1] * 1000 if latencies else None,
+    }
+
+
+def run_load(urls, data, mix, clients, duration, warmup=0.0, seed=0):
+    """
+    Drive the weighted ``mix`` of operations with ``clients`` closed-loop
+    clients. Every request counts, including failed ones, so error responses
+    and timeouts show in the latency percentiles as well as the error counts;
+    a request that got no response is counted under the status
+    ``"connection"``.
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    samples = {OPERATIONS[name][0]: [] for name in names}
+    lock = threading.Lock()
+    record_from = time.perf_counter() + warmup
+    stop_at = record_from + duration
+
+    def client(index):
+        session = requests.Session()
+        rng = random.Random(seed * 1000 + index)
+        local = []
+        while True:
+            start = time.perf_counter()
+            if start >= stop_at:
+                break
+            name = rng.choices(names, weights)[0]
+            try:
+                status = OPERATIONS[name][1](session, urls, data, rng).status_code
+            except requests.RequestException:
+                status = "connection"
+            end = time.perf_counter()
+            if start >= record_from:
+                local.append((OPERATIONS[name][0], status, end - start))
+        with lock:
+            for endpoint, status, latency in local:
+                samples[endpoint].append((status, latency))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    endpoints = {}
+    all_latencies, all_statuses = [], {}
+    for endpoint, results in samples.items():
+        statuses = {}
+        for status, _ in results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            all_statuses[str(status)] = all_statuses.get(str(status), 0) + 1
+        latencies = [latency for _, latency in results]
+        all_latencies.extend(latencies)
+        endpoints[endpoint] = summarize(latencies, statuses, duration)
+    return {"endpoints": endpoints, "total": summarize(all_latencies, all_statuses, duration)}
+
+
+def compare(result, baseline, max_regression):
+    """
+    Compare the endpoints of two results.
+
+    :return: Lines describing each endpoint, and whether any regressed by
+        more than ``max_regression`` (a fraction) in p95 or throughput.
+    """
+    lines, regressed = [], False
+    for endpoint, current in result["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(endpoint)
+        if not before or not before["requests"] or not current["requests"]:
+            lines.append(f"{endpoint:<28} no baseline")
+            continue
+        p95_change = current["p95_ms"] / before["p95_ms"] - 1
+        rps_change = current["requests_per_second"] / before["requests_per_second"] - 1
+        bad = p95_change > max_regression or rps_change < -max_regression
+        regressed |= bad
+        lines.append(f"{endpoint:<28} p95 {p95_change:+7.1%}  req/s {rps_change:+7.1%}"
+                     + ("  REGRESSION" if bad else ""))
+    return lines, regressed
+
+
+def print_result(result):
+    print(f"{'endpoint':<28} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    rows = list(result["endpoints"].items()) + [("total", result["total"])]
+    for endpoint, r in rows:
+        if not r["requests"]:
+            print(f"{endpoint:<28} {'-':>8}")
+            continue
+        print(f"{endpoint:<28} {r['requests_per_second']:8.1f} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} "
+              f"{r['p99_ms']:8.1f} {r['errors']:7d}")
+
+
+def print_faults(result):
+    injected = 0
+    for name, stats in result["faults"].items():
+        matched = sum(rule["requests"] for rule in stats["rules"])
+        print(f"{name} proxy: {matched} requests matched a rule, {stats['injected']} faults injected")
+        injected += stats["injected"]
+    errors = result["total"]["errors"]
+    if injected:
+        # Above 1: each injected fault failed more than one client request
+        print(f"client errors per injected fault: {errors / injected:.2f}")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_faults(path):
+    """
+    Read a ``--faults`` file: a JSON object mapping ``customers`` and/or
+    ``inventory`` to a list of :class:`faultproxy.FaultRule` settings.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    unknown = set(data) - set(DOWNSTREAM_SETTINGS)
+    if unknown:
+        raise SystemExit(f"--faults: no proxy can be put in front of {', '.join(sorted(unknown))}")
+    for rules in data.values():
+        for rule in rules:
+            FaultRule.from_dict(rule)
+    return data
+
+
+def parse_env(values):
+    env = {}
+    for value in values:
+        key, sep, val = value.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"--env expects KEY=VALUE, got {value!r}")
+        env[key] = val
+    return env
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--customers", type=int, default=500)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--reviews", type=int, default=1000)
+    parser.add_argument("--server", choices=["gunicorn", "dev"], default="gunicorn")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Set an environment variable for every service")
+    parser.add_argument("--faults", metavar="FILE",
+                        help="Put fault-injecting proxies in front of the customer and inventory services")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the data and the request mix")
+    parser.add_argument("--json-output", help="Also write the results to this file as JSON")
+    parser.add_argument("--baseline", help="Earlier --json-output to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Largest tolerated p95 increase or throughput drop, as a fraction")
+    return parser
+
+
+def settings(args):
+    return {
+        "workload": args.workload,
+        "mix": WORKLOADS[args.workload],
+        "clients": args.clients,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "customers": args.customers,
+        "products": args.products,
+        "reviews": args.reviews,
+        "server": args.server,
+        "workers": args.workers,
+        "threads": args.threads,
+        "env": parse_env(args.env),
+        "seed": args.seed,
+        "faults": load_faults(args.faults) if args.faults else {},
+        "cpus": os.cpu_count(),
+        "revision": git_revision(),
+    }
+
+
+def finish(args, result):
+    """Print, save and compare a result; returns the exit status."""
+    print_result(result)
+    if "faults" in result:
+        print_faults(result)
+    if args.json_output:
+        with open(args.json_output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressed = compare(result, baseline, args.max_regression)
+        print(f"\ncompared with {args.baseline} (revision {baseline.get('settings', {}).get('revision')}):")
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    result = {"settings": settings(args)}
+    faults = {name: [FaultRule.from_dict(rule) for rule in rules]
+              for name, rules in result["settings"]["faults"].items()}
+    with tempfile.TemporaryDirectory() as tmp:
+        cluster = Cluster(tmp, args.server, args.workers, args.threads, result["settings"]["env"])
+        # The proxies start without rules so that seeding is not disturbed
+        proxies = {name: FaultProxy(cluster.urls[name], seed=args.seed).start() for name in faults}
+        for name, proxy in proxies.items():
+            cluster.downstream_urls[name] = proxy.url
+        try:
+            with cluster:
+                print(f"seeding {args.customers} customers, {args.products} products, {args.reviews} reviews")
+                data = seed(cluster, args.customers, args.products, args.reviews, random.Random(args.seed))
+                for name, proxy in proxies.items():
+                    proxy.set_rules(faults[name])
+                print(f"running {args.workload} with {args.clients} clients for {args.duration:g} s")
+                result.update(run_load(cluster.urls, data, WORKLOADS[args.workload], args.clients,
+                                       args.duration, args.warmup, args.seed))
+                if proxies:
+                    result["faults"] = {name: proxy.stats() for name, proxy in proxies.items()}
+        finally:
+            for proxy in proxies.values():
+                proxy.stop()
+    return finish(args, result)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Print the critical path of a distributed trace.
+
+Reads spans recorded by ``tracing.py`` from span files (``TRACE_FILE``, one
+JSON object per line) and/or from the ``GET /traces/<trace_id>`` endpoint of
+services using the in-memory collector, joins them into one tree per trace and
+walks it backwards from the end of the root span: at each level the child that
+finished last before the current point is on the critical path, and the walk
+continues from where that child started. Time in a span not covered by a
+critical child is that span's own (self) time.
+
+Usage::
+
+    python benchmarks/trace_critical_path.py SOURCE [SOURCE ...] [--trace TRACE_ID]
+
+A SOURCE is a span file or a ``/traces/<trace_id>`` URL. Without ``--trace``
+the slowest trace found is shown.
+"""
+import argparse
+import json
+import sys
+import urllib.request
+from collections import defaultdict
+
+
+def load_spans(source):
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source) as response:
+            return json.load(response)
+    with open(source, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def group_traces(spans):
+    traces = defaultdict(dict)
+    for span in spans:
+        traces[span["trace_id"]][span["span_id"]] = span
+    return traces
+
+
+def find_root(spans):
+    """Return the span whose parent is not part of the trace (the earliest if several)."""
+    roots = [s for s in spans.values() if s["parent_id"] not in spans]
+    return min(roots, key=lambda s: s["start"]) if roots else None
+
+
+def critical_path(spans, root):
+    """
+    Return ``[(depth, span, self_ms)]`` for the spans on the critical path.
+    """
+    children = defaultdict(list)
+    for span in spans.values():
+        if span["parent_id"] in spans:
+            children[span["parent_id"]].append(span)
+
+    path = []
+
+    def walk(span, depth):
+        entry = [depth, span, span["duration_ms"]]
+        path.append(entry)
+        cursor = span["end"]
+        for child in sorted(children[span["span_id"]], key=lambda s: s["end"], reverse=True):
+            # Clocks of different services are not perfectly in sync, so a
+            # child is judged by its start only
+            if child["start"] < cursor:
+                entry[2] -= child["duration_ms"]
+                walk(child, depth + 1)
+                cursor = child["start"]
+
+    walk(root, 0)
+    return [(depth, span, max(self_ms, 0.0)) for depth, span, self_ms in path]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("sources", nargs="+", help="Span files or /traces/<trace_id> URLs")
+    parser.add_argument("--trace", help="Trace ID (default: the slowest trace)")
+    args = parser.parse_args(argv)
+
+    spans = []
+    for source in args.sources:
+        spans.extend(load_spans(source))
+    traces = group_traces(spans)
+    if not traces:
+        sys.exit("No spans found")
+
+    if args.trace:
+        if args.trace not in traces:
+            sys.exit(f"Trace {args.trace} not found")
+        trace_id = args.trace
+    else:
+        trace_id = max(traces, key=lambda t: find_root(traces[t])["duration_ms"] if find_root(traces[t]) else 0)
+
+    trace = traces[trace_id]
+    root = find_root(trace)
+    print(f"Trace {trace_id}: {len(trace)} spans, {root['duration_ms']:.1f} ms")
+    print(f"{'total ms':>10} {'self ms':>10}  span")
+    for depth, span, self_ms in critical_path(trace, root):
+        label = f"{span['service']}: {span['name']}"
+        statement = span["attributes"].get("db.statement")
+        if statement:
+            label += f" [{' '.join(statement.split())[:60]}]"
+        print(f"{span['duration_ms']:>10.1f} {self_ms:>10.1f}  {'  ' * depth}{label}")
+
+
+if __name__ == "__main__":
+    main()
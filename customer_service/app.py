@@ -1,14 +1,125 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify
+from flask.cli import with_appcontext
 from sqlalchemy.exc import IntegrityError
-from models import Customer
+from models import Customer, WalletEntry
 from db import db, init_db
+from dbrouting import read_only
+from config import Config
+from resilience import init_resilience
+from codec import init_codec
+from compression import init_compression
+from tracing import init_tracing
+from cache import ProfileCache
+import wallet
+import click
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://user:password@db/customers_db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-init_db(app)
+COMPRESSION_MIN_SIZE = 1024
 
-@app.route('/auth', methods=['POST'])
+CUSTOMER_CACHE_SIZE = 10000
+CUSTOMER_CACHE_TTL = 30.0
+
+WALLET_COMPACT_INTERVAL = 60.0
+WALLET_COMPACT_MIN_ENTRIES = 1
+WALLET_HISTORY_DEFAULT_LIMIT = 50
+WALLET_HISTORY_MAX_LIMIT = 500
+
+customer_cache = ProfileCache(maxsize=CUSTOMER_CACHE_SIZE, ttl=CUSTOMER_CACHE_TTL)
+# Created by create_app: folds the wallet ledger into balance snapshots
+wallet_compactor = None
+
+bp = Blueprint('customers', __name__)
+
+# Fields a PUT may change; the version is only ever bumped by the server and
+# the wallet only changes through charge and deduct
+UPDATABLE_CUSTOMER_FIELDS = (frozenset(Customer.__table__.columns.keys())
+                             - {'id', 'version', 'wallet_balance', 'wallet_seq'})
+
+def if_match_versions():
+    """
+    Return the versions the request's ``If-Match`` header accepts.
+
+    :return: None if there is no header or it is ``*``; otherwise the set of
+        versions named by its strong entity tags (empty if none is a version).
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    versions = (tag.split('.', 1)[0] for tag in if_match.as_set())
+    return {int(version) for version in versions if version.isdigit()}
+
+def profile_etag(profile):
+    """
+    Entity tag of a profile: its version and the last wallet entry its
+    balance includes. Only the version is checked by ``If-Match``.
+    """
+    return f"{profile['version']}.{profile['wallet_seq']}"
+
+def versioned_response(profile):
+    """
+    Return a customer profile with its ``ETag``, or a 304 if the request's
+    ``If-None-Match`` already names it.
+    """
+    response = jsonify(profile)
+    response.set_etag(profile_etag(profile))
+    return response.make_conditional(request)
+
+def fetch_profile(username):
+    """
+    Read a customer's profile, with the current wallet balance, in the
+    current transaction; None if there is no such customer.
+    """
+    rows = wallet.customers_with_wallets(Customer.username == username)
+    if not rows:
+        return None
+    customer, balance, seq = rows[0]
+    return customer.to_dict(balance, seq)
+
+def parse_wallet_request(data):
+    """
+    Read the ``amount`` and optional ``operation_id`` of a charge or deduction.
+
+    :return: ``(amount, operation_id, error)``; ``error`` is a message if the
+        body is invalid.
+    """
+    amount = data.get('amount')
+    operation_id = data.get('operation_id')
+    if not isinstance(amount, (int, float)) or isinstance(amount, bool) or amount <= 0:
+        return None, None, "amount must be a positive number"
+    if operation_id is not None and not (isinstance(operation_id, str) and 0 < len(operation_id) <= 64):
+        return None, None, "operation_id must be a string of at most 64 characters"
+    return amount, operation_id, None
+
+def update_wallet(username, amount, kind, operation_id):
+    """
+    Record a wallet movement and drop the customer's cached profile.
+
+    :return: ``(outcome, profile)``: an outcome of :func:`wallet.record` and
+        the profile after the movement; ``(None, None)`` if the customer does
+        not exist.
+    :raises wallet.OperationConflict: If ``operation_id`` was used for another movement.
+    """
+    customer = Customer.query.filter_by(username=username).first()
+    if customer is None:
+        return None, None
+    try:
+        outcome = wallet.record(customer.id, amount, kind, operation_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    # Invalidated rather than replaced once committed: two movements that
+    # commit in one order could otherwise cache their profiles in the other.
+    customer_cache.invalidate(username)
+    profile = fetch_profile(username)
+    return outcome, profile
+
+@bp.before_app_request
+def start_background_workers():
+    # Started lazily so that each worker process runs its own compactor
+    if wallet_compactor is not None:
+        wallet_compactor.start()
+
+@bp.route('/auth', methods=['POST'])
 def authenticate_customer():
     """
     Authenticate a customer based on username and password.
@@ -36,7 +147,7 @@ def authenticate_customer():
         db.session.rollback()
         return jsonify({"error": "Customer not authenticated or does not exist."}), 400
 
-@app.route('/customers', methods=['POST'])
+@bp.route('/customers', methods=['POST'])
 def register_customer():
     """
     Register a new customer.
@@ -46,29 +157,39 @@ def register_customer():
 
     **Request Body**:
     - Customer details (JSON object with attributes like username, password, etc.).
+      A `wallet_balance` is recorded as the opening entry of the wallet ledger.
 
     **Response**:
     - If registration is successful: `{"message": "Customer registered successfully"}` with a 201 status code.
     - If the username already exists: `{"error": "Username already exists"}` with a 400 status code.
+    - If the opening entry's operation id is already taken: `{"error": ...}` with a 409 status code.
     """
     try:
-        data = request.json
+        data = dict(request.json)
+        opening_balance = data.pop('wallet_balance', None)
         customer = Customer(**data)
         db.session.add(customer)
+        db.session.flush()
+        if opening_balance:
+            wallet.record(customer.id, opening_balance, wallet.OPEN, f"open-{customer.id}")
         db.session.commit()
         return jsonify({"message": "Customer registered successfully"}), 201
     except IntegrityError:
         db.session.rollback()
         return jsonify({"error": "Username already exists"}), 400
+    except wallet.OperationConflict as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 409
 
-@app.route('/customers/<username>', methods=['DELETE'])
+@bp.route('/customers/<username>', methods=['DELETE'])
 def delete_customer(username):
     """
     Delete a customer by username.
 
     This route deletes a customer's account from the system based on the provided
-    username. If the customer exists, they are removed from the database. If the
-    customer is not found, an error message is returned.
+    username. If the customer exists, they are removed from the database together
+    with their wallet ledger entries. If the customer is not found, an error
+    message is returned.
 
     **Response**:
     - If the customer is deleted successfully: `{"message": "Customer deleted"}` with a 200 status code.
@@ -76,12 +197,15 @@ def delete_customer(username):
     """
     customer = Customer.query.filter_by(username=username).first()
     if customer:
+        wallet.lock_wallet(customer.id, exclusive=True)
+        db.session.execute(db.delete(WalletEntry).where(WalletEntry.customer_id == customer.id))
         db.session.delete(customer)
         db.session.commit()
+        customer_cache.invalidate(username)
         return jsonify({"message": "Customer deleted"}), 200
     return jsonify({"error": "Customer not found"}), 404
 
-@app.route('/customers/<username>', methods=['PUT'])
+@bp.route('/customers/<username>', methods=['PUT'])
 def update_customer(username):
     """
     Update customer details by username.
@@ -90,23 +214,56 @@ def update_customer(username):
     should contain the fields to be updated. If the customer is not found, an error
     message is returned.
 
+    Send the customer's ``ETag`` (from ``GET /customers/<username>``) in an
+    ``If-Match`` header to update only the version you read. Wallet movements
+    do not change the version, only the ETag's wallet part. The update is a
+    single ``UPDATE ... WHERE version = :v``, so no lock is held between the
+    read and the write, and a concurrent change makes it fail with 412
+    instead of being overwritten. Without ``If-Match`` the update is
+    unconditional.
+
     **Request Body**:
     - Customer details to be updated (JSON object).
 
     **Response**:
-    - If the update is successful: `{"message": "Customer updated"}` with a 200 status code.
+    - If the update is successful: `{"message": "Customer updated"}` with a 200 status code and the new `ETag`.
+    - If a field is unknown or read-only (`id`, `version`, `wallet_balance`, `wallet_seq`;
+      use charge and deduct for the wallet): `{"error": ...}` with a 400 status code.
+    - If the new username is taken: `{"error": "Username already exists"}` with a 400 status code.
     - If the customer is not found: `{"error": "Customer not found"}` with a 404 status code.
+    - If the customer changed since the `If-Match` version: `{"error": ...}` with a 412 status code.
     """
-    customer = Customer.query.filter_by(username=username).first()
-    if not customer:
-        return jsonify({"error": "Customer not found"}), 404
     data = request.json
-    for key, value in data.items():
-        setattr(customer, key, value)
+    unknown = set(data) - UPDATABLE_CUSTOMER_FIELDS
+    if unknown:
+        return jsonify({"error": f"Unknown or read-only fields: {', '.join(sorted(unknown))}"}), 400
+    versions = if_match_versions()
+    statement = (db.update(Customer)
+                 .where(Customer.username == username)
+                 .values(**data, version=Customer.version + 1)
+                 .execution_options(synchronize_session=False))
+    if versions is not None:
+        statement = statement.where(Customer.version.in_(versions))
+    try:
+        updated = db.session.execute(statement).rowcount
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "Username already exists"}), 400
+    if not updated:
+        db.session.rollback()
+        if Customer.query.filter_by(username=username).first() is None:
+            return jsonify({"error": "Customer not found"}), 404
+        return jsonify({"error": "Customer was modified since the If-Match version"}), 412
+    profile = fetch_profile(data.get('username', username))
     db.session.commit()
-    return jsonify({"message": "Customer updated"}), 200
+    customer_cache.invalidate(username)
+    customer_cache.invalidate(profile['username'])
+    response = jsonify({"message": "Customer updated"})
+    response.set_etag(profile_etag(profile))
+    return response, 200
 
-@app.route('/customers', methods=['GET'])
+@bp.route('/customers', methods=['GET'])
+@read_only
 def get_all_customers():
     """
     Retrieve a list of all customers.
@@ -116,75 +273,211 @@ def get_all_customers():
     **Response**:
     - A list of all customers' details (JSON array).
     """
-    customers = Customer.query.all()
-    return jsonify([customer.to_dict() for customer in customers]), 200
+    customers = wallet.customers_with_wallets()
+    return jsonify([customer.to_dict(balance, seq) for customer, balance, seq in customers]), 200
 
-@app.route('/customers/<username>', methods=['GET'])
+@bp.route('/customers/<username>', methods=['GET'])
 def get_customer(username): 
     """
     Retrieve details of a specific customer by username.
 
     This route returns the details of a customer based on the provided username.
     If the customer is found, their details are returned. Otherwise, an error message is returned.
+    Profiles are served from the in-process profile cache when possible; every
+    write route invalidates the cached entry once committed. Cache misses read from the
+    primary database, never the replica: the profile carries the wallet
+    balance, and a lagging replica would put a stale one in the cache.
+
+    The wallet balance is the customer's wallet snapshot plus the ledger
+    entries after it. The response's ``ETag`` combines the customer's version
+    and the last wallet entry included; a request whose ``If-None-Match``
+    matches it gets a 304 without a body.
 
     **Response**:
     - If the customer is found: Customer details in JSON format with a 200 status code.
     - If the customer is not found: `{"error": "Customer not found"}` with a 404 status code.
     """
-    customer = Customer.query.filter_by(username=username).first()
-    if customer:
-        return jsonify(customer.to_dict()), 200
+    cached = customer_cache.get(username)
+    if cached is not None:
+        return versioned_response(cached)
+    token = customer_cache.reserve(username)
+    profile = fetch_profile(username)
+    if profile:
+        customer_cache.fill(username, profile, token)
+        return versioned_response(profile)
     return jsonify({"error": "Customer not found"}), 404
 
-@app.route('/customers/<username>/charge', methods=['POST'])
+@bp.route('/customers/<username>/charge', methods=['POST'])
 def charge_wallet(username):
     """
     Charge a customer's wallet.
 
     This route allows a customer to add funds to their wallet. The amount is provided
     in the request body. If the customer is not found, an error message is returned.
+    The charge is appended to the wallet ledger. A request repeating the
+    `operation_id` of a recorded charge is not applied again.
 
     **Request Body**:
-    - `amount`: The amount to be added to the wallet (float).
+    - `amount`: The amount to be added to the wallet (positive float).
+    - `operation_id` (optional): Unique id of this charge, for safe retries (string, max 64 characters).
 
     **Response**:
-    - If successful: `{"message": "Wallet charged", "balance": updated_balance}` with a 200 status code.
+    - If successful: `{"message": "Wallet charged", "balance": updated_balance, "duplicate": false}` with a 200 status code;
+      `duplicate` is true if the `operation_id` was already recorded.
+    - If the amount or operation id is invalid: `{"error": ...}` with a 400 status code.
     - If the customer is not found: `{"error": "Customer not found"}` with a 404 status code.
+    - If the `operation_id` was used for another movement: `{"error": ...}` with a 409 status code.
     """
-    data = request.json
-    customer = Customer.query.filter_by(username=username).first()
-    if not customer:
+    amount, operation_id, error = parse_wallet_request(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        outcome, profile = update_wallet(username, amount, wallet.CHARGE, operation_id)
+    except wallet.OperationConflict as e:
+        return jsonify({"error": str(e)}), 409
+    if profile is None:
         return jsonify({"error": "Customer not found"}), 404
-    customer.wallet_balance += data.get('amount', 0)
-    db.session.commit()
-    return jsonify({"message": "Wallet charged", "balance": customer.wallet_balance}), 200
+    return jsonify({
+        "message": "Wallet charged",
+        "balance": profile['wallet_balance'],
+        "duplicate": outcome == wallet.DUPLICATE,
+    }), 200
 
-@app.route('/customers/<username>/deduct', methods=['POST'])
+@bp.route('/customers/<username>/deduct', methods=['POST'])
 def deduct_wallet(username):
     """
     Deduct funds from a customer's wallet.
 
     This route allows a customer to withdraw funds from their wallet. The amount is provided
     in the request body. If the customer does not have sufficient funds, an error message is returned.
+    The deduction is appended to the wallet ledger in one statement that
+    also checks the balance, so concurrent deductions cannot overdraw the
+    wallet. A request repeating the `operation_id` of a recorded deduction is
+    not applied again.
 
     **Request Body**:
-    - `amount`: The amount to be deducted from the wallet (float).
+    - `amount`: The amount to be deducted from the wallet (positive float).
+    - `operation_id` (optional): Unique id of this deduction, for safe retries (string, max 64 characters).
 
     **Response**:
-    - If successful: `{"message": "Wallet deducted", "balance": updated_balance}` with a 200 status code.
+    - If successful: `{"message": "Wallet deducted", "balance": updated_balance, "duplicate": false}` with a 200 status code;
+      `duplicate` is true if the `operation_id` was already recorded.
     - If the customer is not found: `{"error": "Customer not found"}` with a 404 status code.
+    - If the amount or operation id is invalid: `{"error": ...}` with a 400 status code.
     - If there are insufficient funds: `{"error": "Insufficient funds"}` with a 400 status code.
+    - If the `operation_id` was used for another movement: `{"error": ...}` with a 409 status code.
     """
-    data = request.json
-    customer = Customer.query.filter_by(username=username).first()
-    if not customer:
+    amount, operation_id, error = parse_wallet_request(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        outcome, profile = update_wallet(username, -amount, wallet.DEDUCT, operation_id)
+    except wallet.OperationConflict as e:
+        return jsonify({"error": str(e)}), 409
+    if profile is None:
         return jsonify({"error": "Customer not found"}), 404
-    amount = data.get('amount', 0)
-    if customer.wallet_balance < amount:
+    if outcome == wallet.INSUFFICIENT:
         return jsonify({"error": "Insufficient funds"}), 400
-    customer.wallet_balance -= amount
-    db.session.commit()
-    return jsonify({"message": "Wallet deducted", "balance": customer.wallet_balance}), 200
+    return jsonify({
+        "message": "Wallet deducted",
+        "balance": profile['wallet_balance'],
+        "duplicate": outcome == wallet.DUPLICATE,
+    }), 200
+
+@bp.route('/customers/<username>/wallet', methods=['GET'])
+@read_only
+def get_wallet_history(username):
+    """
+    Retrieve a customer's wallet balance and ledger entries, newest first.
+
+    Served from the read replica when one is configured, so it may lag
+    behind the latest movements.
+
+    **Query Parameters**:
+    - `limit` (optional): Maximum number of entries to return (default 50, max 500).
+    - `before` (optional): Only return entries with a smaller `seq`; pass the `next_before` of the previous page.
+
+    **Response**:
+    - The balance, the last entry it includes (`wallet_seq`), the entries and the `next_before` cursor
+      (null on the last page) with a 200 status code.
+    - If the limit or cursor is invalid: `{"error": ...}` with a 400 status code.
+    - If the customer is not found: `{"error": "Customer not found"}` with a 404 status code.
+    """
+    limit = request.args.get('limit', WALLET_HISTORY_DEFAULT_LIMIT, type=int)
+    before = request.args.get('before', type=int)
+    if limit is None or not (1 <= limit <= WALLET_HISTORY_MAX_LIMIT):
+        return jsonify({"error": "Invalid limit"}), 400
+    if 'before' in request.args and before is None:
+        return jsonify({"error": "Invalid cursor"}), 400
+    rows = wallet.customers_with_wallets(Customer.username == username)
+    if not rows:
+        return jsonify({"error": "Customer not found"}), 404
+    customer, balance, seq = rows[0]
+    entries = wallet.history(customer.id, before, limit)
+    return jsonify({
+        "balance": balance,
+        "wallet_seq": seq,
+        "entries": [entry.to_dict() for entry in entries],
+        "next_before": entries[-1].seq if len(entries) == limit else None,
+    }), 200
+
+@bp.route('/wallets/compaction', methods=['GET'])
+def get_wallet_compaction():
+    """
+    Retrieve the state of the wallet ledger compaction.
+
+    **Response**:
+    - Interval, run and compacted-customer counts and the time of the last run with a 200 status code.
+    """
+    return jsonify(wallet_compactor.stats()), 200
+
+@bp.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Retrieve the customer profile cache counters.
+
+    **Response**:
+    - Cache size, capacity, TTL and hit/miss/eviction/expiration/invalidation counts with a 200 status code.
+    """
+    return jsonify(customer_cache.stats()), 200
+
+@click.command('compact-wallets')
+@click.option('--min-entries', default=WALLET_COMPACT_MIN_ENTRIES, show_default=True,
+              help='Skip customers with fewer ledger entries since their snapshot.')
+@with_appcontext
+def compact_wallets_command(min_entries):
+    """Fold the wallet ledger into the customers' balance snapshots."""
+    click.echo(f'Compacted the wallets of {wallet.compact(min_entries)} customers.')
+
+def create_app(config=None):
+    """
+    Create the customers service app.
+
+    Creating the app does not connect to the database; see :mod:`config` for
+    the settings and :func:`db.init_db` for schema creation.
+
+    :param config: Settings overriding :class:`config.Config`: a mapping, or
+        an object with upper-case attributes such as :class:`config.TestingConfig`.
+    :return: The Flask app.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    init_db(app)
+    app.cli.add_command(compact_wallets_command)
+
+    global wallet_compactor
+    wallet_compactor = wallet.WalletCompactor(app, WALLET_COMPACT_INTERVAL, WALLET_COMPACT_MIN_ENTRIES)
+
+    init_tracing(app, 'customers')
+    init_resilience(app)
+    init_codec(app)
+    init_compression(app, min_size=COMPRESSION_MIN_SIZE)
+    app.register_blueprint(bp)
+    return app
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000)
+    create_app().run(host='0.0.0.0', port=5000)
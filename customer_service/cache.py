@@ -0,0 +1,139 @@
+"""
+In-process cache of customer profiles.
+
+``GET /customers/<username>`` is called by the sales service on every sale, so
+profiles are cached by username with LRU eviction and a TTL. Every write path
+in :mod:`app` invalidates the entry once its transaction has committed, and a
+fill started before a write is discarded, so a request never sees an older
+balance than the last write made through this process.
+
+The cache is local to one process: writes handled by other worker processes
+only become visible here once the entry expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class ProfileCache:
+    """
+    Bounded LRU cache with per-entry expiry and hit/miss/eviction counters.
+
+    Misses are filled with the :meth:`reserve` / :meth:`fill` pair::
+
+        token = cache.reserve(username)
+        profile = load_from_db(username)
+        cache.fill(username, profile, token)
+
+    :meth:`fill` is a no-op if the key was written or invalidated after
+    :meth:`reserve`, which keeps a slow reader from caching a value older than
+    a concurrent write.
+
+    :param maxsize: Maximum number of entries; 0 disables caching.
+    :param ttl: Seconds an entry stays valid.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Sequence number of the latest write per key, bounded like the
+        # entries; keys dropped from it fall back to the highest dropped stamp.
+        self._seq = 0
+        self._writes = OrderedDict()
+        self._write_floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Return the cached value for ``key``, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def reserve(self, key):
+        """
+        Start a fill for ``key``.
+
+        :return: A token to pass to :meth:`fill`.
+        """
+        with self._lock:
+            return self._seq
+
+    def fill(self, key, value, token):
+        """
+        Store a value loaded after :meth:`reserve`, unless ``key`` was written since.
+        """
+        with self._lock:
+            if token < self._writes.get(key, self._write_floor):
+                return
+            self._store(key, value)
+
+    def invalidate(self, key):
+        """
+        Drop ``key`` from the cache.
+        """
+        with self._lock:
+            self._record_write(key)
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._writes.clear()
+            self._seq += 1
+            self._write_floor = self._seq
+
+    def stats(self):
+        """
+        Return the cache counters as a dict.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _record_write(self, key):
+        self._seq += 1
+        self._writes[key] = self._seq
+        self._writes.move_to_end(key)
+        while len(self._writes) > max(self.maxsize, 1):
+            _, stamp = self._writes.popitem(last=False)
+            self._write_floor = max(self._write_floor, stamp)
+
+    def _store(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, self._clock() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
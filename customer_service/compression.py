@@ -0,0 +1,157 @@
+"""
+Response compression negotiated from ``Accept-Encoding``.
+
+Responses of at least ``min_size`` bytes are compressed with the best encoding
+the client accepts: zstd and brotli when the optional ``zstandard`` /
+``brotli`` packages are installed, gzip always. Streamed responses are
+compressed chunk by chunk as they are sent, whatever their size. Each chunk
+is flushed, so the client can decode it on arrival: server-sent events and
+keep-alives are not held back in the compressor until the stream ends.
+
+:data:`ACCEPT_ENCODING` is the header value internal clients send: every
+encoding the local HTTP client (urllib3) can decode transparently.
+
+This module is identical in every service.
+"""
+import zlib
+
+from flask import request
+from urllib3.util.request import ACCEPT_ENCODING
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+DEFAULT_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+class _GzipStream:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _ZstdStream:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def _available_encodings():
+    # Server preference order, best first
+    encodings = {}
+    if zstandard is not None:
+        encodings["zstd"] = _ZstdStream
+    if brotli is not None:
+        encodings["br"] = _BrotliStream
+    encodings["gzip"] = _GzipStream
+    return encodings
+
+
+ENCODINGS = _available_encodings()
+
+
+def choose_encoding(accept_encodings):
+    """
+    Pick the encoding to use for a request.
+
+    :param accept_encodings: The request's parsed ``Accept-Encoding``
+        (:attr:`flask.Request.accept_encodings`).
+    :return: The chosen encoding name, or None to send the body as is.
+    """
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding):
+    """Compress a whole body with ``encoding``."""
+    stream = ENCODINGS[encoding]()
+    return stream.compress(data) + stream.finish()
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compress an iterable of body chunks lazily, yielding one compressed,
+    flushed chunk per non-empty input chunk.
+    """
+    stream = ENCODINGS[encoding]()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if chunk:
+            yield stream.compress(chunk) + stream.flush()
+    yield stream.finish()
+
+
+def init_compression(app, min_size=DEFAULT_MIN_SIZE):
+    """
+    Compress the responses of a Flask app.
+
+    :param min_size: Smallest (non-streamed) body in bytes worth compressing.
+    """
+    @app.after_request
+    def compress_response(response):
+        if (request.method == "HEAD"
+                or response.status_code < 200
+                or response.status_code in (204, 304)
+                or "Content-Encoding" in response.headers
+                or response.direct_passthrough):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+            response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -1,8 +1,71 @@
+import os
+
+import click
+from flask import jsonify
+from flask.cli import with_appcontext
+from flask_migrate import Migrate, upgrade
 from flask_sqlalchemy import SQLAlchemy
+from dbrouting import DEFAULT_MAX_LAG, REPLICA_BIND, ReplicaMonitor, RoutingSession
+from sqlstats import init_sqlstats
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+migrate = Migrate()
 
-db = SQLAlchemy()
+# Versioned schema migrations (Alembic), one revision per schema change
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
 
 def init_db(app):
+    """
+    Bind the database to an app and register the ``init-db`` and ``db`` commands.
+
+    Tables are only created here if ``CREATE_SCHEMA`` is set (e.g. for an
+    in-memory SQLite database, which starts empty in every process);
+    otherwise run the migrations with ``flask --app app db upgrade`` (or
+    ``init-db``) before starting the service. A database created by
+    ``init-db`` before the migrations existed is upgraded in place: each
+    revision skips the tables, columns and indexes that are already there.
+
+    If a ``replica`` bind is configured, routes marked with
+    :func:`dbrouting.read_only` read from it; ``GET /db/replica`` reports its lag.
+    """
     db.init_app(app)
+    migrate.init_app(app, db, directory=MIGRATIONS_DIR, render_as_batch=True)
+    app.cli.add_command(init_db_command)
     with app.app_context():
-        db.create_all()
+        if app.config.get('SQL_INSTRUMENTATION'):
+            init_sqlstats(app, db.engines.values())
+        if app.config.get('CREATE_SCHEMA'):
+            db.create_all(bind_key=None)
+        replica = db.engines.get(REPLICA_BIND)
+        if replica is not None:
+            app.extensions['db_replica'] = ReplicaMonitor(
+                replica, max_lag=app.config.get('REPLICA_MAX_LAG', DEFAULT_MAX_LAG)
+            )
+
+    @app.route('/db/replica', methods=['GET'])
+    def get_replica_status():
+        """
+        Get the state of the read replica.
+
+        **Responses:**
+            - 200: Whether a replica is configured and, if so, its lag in
+              seconds (null if it cannot be measured), the lag limit and how
+              many reads went to it or fell back to the primary.
+        """
+        monitor = app.extensions.get('db_replica')
+        if monitor is None:
+            return jsonify({'configured': False}), 200
+        return jsonify(monitor.status()), 200
+
+@click.command('init-db')
+@click.option('--replica', is_flag=True,
+              help='Also create the schema on the replica (when it is not a streaming replica).')
+@with_appcontext
+def init_db_command(replica):
+    """Run the pending schema migrations."""
+    upgrade()
+    if replica:
+        if REPLICA_BIND not in db.engines:
+            raise click.UsageError('No replica database is configured.')
+        db.metadata.create_all(db.engines[REPLICA_BIND])
+    click.echo('Database schema is up to date.')
@@ -0,0 +1,42 @@
+"""Create the customer table
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19 09:00:00.000000
+
+The schema that ``init-db`` created before the migrations existed; a
+database that already has it is left as it is.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('customer'):
+        return
+    op.create_table(
+        'customer',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('full_name', sa.String(length=100), nullable=False),
+        sa.Column('username', sa.String(length=50), nullable=False),
+        sa.Column('password', sa.String(length=100), nullable=False),
+        sa.Column('age', sa.Integer(), nullable=False),
+        sa.Column('address', sa.String(length=200), nullable=False),
+        sa.Column('gender', sa.String(length=10), nullable=False),
+        sa.Column('marital_status', sa.String(length=20), nullable=False),
+        sa.Column('wallet_balance', sa.Float(), nullable=True),
+        sa.Column('is_admin', sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username'),
+    )
+
+
+def downgrade():
+    op.drop_table('customer')
@@ -0,0 +1,29 @@
+"""Add customer.version for conditional updates
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 09:00:00.000000
+
+``PUT /customers/<username>`` compares ``If-Match`` against this version;
+existing customers start at version 1.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('customer')}
+    if 'version' not in columns:
+        op.add_column('customer', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('customer') as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,52 @@
+"""Add the wallet ledger
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 09:00:00.000000
+
+Charges and deductions are appended to ``wallet_entries``; the existing
+balances become the first snapshots, as of ``wallet_seq`` 0. On SQLite the
+customer table is rebuilt with AUTOINCREMENT so that the id of a deleted
+customer, whose ledger entries are gone with them, is never handed out again
+(PostgreSQL sequences never reuse ids anyway).
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('customer')}
+    if 'wallet_seq' not in columns:
+        op.add_column('customer', sa.Column('wallet_seq', sa.Integer(), nullable=False, server_default='0'))
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table('customer', recreate='always',
+                                  table_kwargs={'sqlite_autoincrement': True}):
+            pass
+    if not inspector.has_table('wallet_entries'):
+        op.create_table(
+            'wallet_entries',
+            sa.Column('seq', sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column('customer_id', sa.Integer(), nullable=False),
+            sa.Column('amount', sa.Float(), nullable=False),
+            sa.Column('kind', sa.String(length=10), nullable=False),
+            sa.Column('operation_id', sa.String(length=64), nullable=False),
+            sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=True),
+            sa.PrimaryKeyConstraint('seq'),
+            sa.UniqueConstraint('operation_id'),
+        )
+        op.create_index('ix_wallet_entries_customer_seq', 'wallet_entries', ['customer_id', 'seq'])
+
+
+def downgrade():
+    op.drop_index('ix_wallet_entries_customer_seq', table_name='wallet_entries')
+    op.drop_table('wallet_entries')
+    with op.batch_alter_table('customer') as batch_op:
+        batch_op.drop_column('wallet_seq')
@@ -9,10 +9,25 @@ class Customer(db.Model):
     address = db.Column(db.String(200), nullable=False)
     gender = db.Column(db.String(10), nullable=False)
     marital_status = db.Column(db.String(20), nullable=False)
+    # Wallet snapshot: the balance as of ledger entry ``wallet_seq``. The
+    # current balance adds the wallet entries after it (see wallet.py).
     wallet_balance = db.Column(db.Float, default=0)
+    wallet_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     is_admin = db.Column(db.Boolean, default=False)
+    # Bumped by every write of this row (wallet movements go to the ledger);
+    # part of the customer's ETag and checked against If-Match on updates
+    version = db.Column(db.Integer, nullable=False, server_default='1')
 
-    def to_dict(self):
+    __mapper_args__ = {'version_id_col': version}
+    # Never reuse the id of a deleted customer on SQLite (PostgreSQL
+    # sequences never do)
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def to_dict(self, wallet_balance, wallet_seq):
+        """
+        :param wallet_balance: The current balance, from :func:`wallet.current`.
+        :param wallet_seq: The last ledger entry the balance includes.
+        """
         return {
             "id": self.id,
             "full_name": self.full_name,
@@ -21,5 +36,31 @@ class Customer(db.Model):
             "address": self.address,
             "gender": self.gender,
             "marital_status": self.marital_status,
-            "wallet_balance": self.wallet_balance, 
+            "wallet_balance": wallet_balance,
+            "wallet_seq": wallet_seq,
+            "version": self.version,
+        }
+
+
+class WalletEntry(db.Model):
+    __tablename__ = 'wallet_entries'
+
+    # Append-only ledger of wallet movements; rows are never updated, and
+    # are deleted with their customer.
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    customer_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    operation_id = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    __table_args__ = (db.Index('ix_wallet_entries_customer_seq', 'customer_id', 'seq'),)
+
+    def to_dict(self):
+        return {
+            "seq": self.seq,
+            "amount": self.amount,
+            "kind": self.kind,
+            "operation_id": self.operation_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
         }
@@ -0,0 +1,282 @@
+"""
+Wallet ledger.
+
+Wallet movements are appended to ``wallet_entries`` and never changed, which
+keeps the history needed to reconcile failed sales. A customer's entries are
+deleted with the customer. Writes do not update the
+customer row, so charges and deductions don't queue on it. Every entry has a
+unique ``operation_id``: a retried request that reuses the id is reported as
+a duplicate instead of being applied twice.
+
+A customer's balance is the snapshot on the customer row (``wallet_balance``
+as of ledger entry ``wallet_seq``) plus the entries after it. :func:`compact`
+folds those entries into the snapshot, so reading a balance only sums the
+few entries since the last compaction. A :class:`WalletCompactor` thread
+runs it periodically; ``flask --app app compact-wallets`` runs it on demand.
+
+On PostgreSQL, two transaction-scoped advisory locks per customer keep the
+ledger consistent; SQLite serializes all writers anyway:
+
+- Compaction must never move a snapshot past an entry that is still being
+  written, or that entry would never be counted. Writes take the customer's
+  wallet lock shared and compaction takes it exclusively, so compaction
+  waits for the writes in flight while writes don't wait for each other.
+- The balance check of a deduction reads the committed entries, so two
+  concurrent deductions could both pass it. Deductions therefore also take
+  the customer's deduction lock, which orders them among themselves; a
+  charge never has to wait for it.
+"""
+import logging
+import threading
+import time
+import uuid
+
+from sqlalchemy import literal, text, true
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from models import Customer, WalletEntry
+
+logger = logging.getLogger(__name__)
+
+OPEN = 'open'
+CHARGE = 'charge'
+DEDUCT = 'deduct'
+
+RECORDED = 'recorded'
+DUPLICATE = 'duplicate'
+INSUFFICIENT = 'insufficient'
+
+WALLET_LOCK_NAMESPACE = 435002
+DEDUCTION_LOCK_NAMESPACE = 435003
+
+INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+class OperationConflict(Exception):
+    """The operation id was already used for a different wallet movement."""
+
+
+def _advisory_lock(namespace, customer_id, shared=False):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        function = 'pg_advisory_xact_lock_shared' if shared else 'pg_advisory_xact_lock'
+        db.session.execute(
+            text(f'SELECT {function}(:namespace, :customer_id)'),
+            {'namespace': namespace, 'customer_id': customer_id},
+        )
+
+
+def lock_wallet(customer_id, exclusive=False):
+    """
+    Take a customer's wallet lock until the end of the transaction
+    (PostgreSQL only): shared for a write, ``exclusive`` for compaction.
+    """
+    _advisory_lock(WALLET_LOCK_NAMESPACE, customer_id, shared=not exclusive)
+
+
+def lock_deductions(customer_id):
+    """
+    Order this transaction's deduction after the other deductions of the
+    same customer (PostgreSQL only).
+    """
+    _advisory_lock(DEDUCTION_LOCK_NAMESPACE, customer_id)
+
+
+# Current balance of a customer, and the last ledger entry it includes
+BALANCE = (db.func.coalesce(Customer.wallet_balance, 0.0)
+           + db.func.coalesce(db.func.sum(WalletEntry.amount), 0.0))
+SEQ = db.func.coalesce(db.func.max(WalletEntry.seq), Customer.wallet_seq)
+
+
+def _wallets(*columns):
+    """Select ``columns`` per customer, over its snapshot and the entries after it."""
+    return (
+        db.select(*columns)
+        .select_from(Customer)
+        .outerjoin(WalletEntry, db.and_(
+            WalletEntry.customer_id == Customer.id,
+            WalletEntry.seq > Customer.wallet_seq,
+        ))
+        .group_by(Customer.id, Customer.wallet_balance, Customer.wallet_seq)
+    )
+
+
+def current(customer_id):
+    """
+    Return a customer's wallet as ``(balance, seq)``, where ``seq`` is the
+    last ledger entry the balance includes; None if there is no such customer.
+    """
+    row = db.session.execute(_wallets(BALANCE, SEQ).where(Customer.id == customer_id)).first()
+    return None if row is None else tuple(row)
+
+
+def customers_with_wallets(*criteria):
+    """
+    Return ``(customer, balance, seq)`` for the customers matching
+    ``criteria``, in one query. The customers are read afresh, not taken
+    from the session.
+    """
+    return db.session.execute(
+        _wallets(Customer, BALANCE, SEQ)
+        .where(*criteria)
+        .order_by(Customer.id)
+        .execution_options(populate_existing=True)
+    ).all()
+
+
+def record(customer_id, amount, kind, operation_id=None):
+    """
+    Append a wallet movement in the current transaction.
+
+    A negative ``amount`` is only recorded if the balance covers it. The
+    check and the insert are one ``INSERT ... SELECT`` statement, run after
+    the other deductions of the customer committed, so concurrent
+    deductions cannot overdraw the wallet.
+
+    :param operation_id: Unique id of the movement; a random one if None.
+    :return: ``RECORDED``, ``DUPLICATE`` if the same movement was already
+        recorded under ``operation_id``, or ``INSUFFICIENT``.
+    :raises OperationConflict: If ``operation_id`` was used for a different movement.
+    """
+    operation_id = operation_id or uuid.uuid4().hex
+    lock_wallet(customer_id)
+    values = db.select(literal(customer_id), literal(amount), literal(kind), literal(operation_id))
+    if amount < 0:
+        lock_deductions(customer_id)
+        balance = _wallets(BALANCE).where(Customer.id == customer_id).scalar_subquery()
+        values = values.where(balance >= -amount)
+    else:
+        # SQLite only parses INSERT ... SELECT ... ON CONFLICT with a WHERE
+        values = values.where(true())
+    insert = INSERTS[db.session.get_bind().dialect.name]
+    statement = (insert(WalletEntry)
+                 .from_select(['customer_id', 'amount', 'kind', 'operation_id'], values)
+                 .on_conflict_do_nothing(index_elements=['operation_id']))
+    if db.session.execute(statement).rowcount:
+        return RECORDED
+    existing = db.session.scalar(db.select(WalletEntry).filter_by(operation_id=operation_id))
+    if existing is None:
+        return INSUFFICIENT
+    if (existing.customer_id, existing.amount, existing.kind) != (customer_id, amount, kind):
+        raise OperationConflict(f"Operation {operation_id} was already used for another wallet movement")
+    return DUPLICATE
+
+
+def history(customer_id, before=None, limit=50):
+    """
+    Return up to ``limit`` ledger entries of a customer, newest first,
+    starting below seq ``before`` if given.
+    """
+    query = db.select(WalletEntry).where(WalletEntry.customer_id == customer_id)
+    if before is not None:
+        query = query.where(WalletEntry.seq < before)
+    return db.session.scalars(query.order_by(WalletEntry.seq.desc()).limit(limit)).all()
+
+
+def compact(min_entries=1):
+    """
+    Fold the ledger entries after each customer's snapshot into the snapshot.
+
+    Each customer is compacted in its own short transaction. Compaction only
+    changes how the balance is stored, not the balance, so the customer's
+    version (and ETag) stays the same.
+
+    :param min_entries: Skip customers with fewer entries after their snapshot.
+    :return: The number of customers compacted.
+    """
+    customer_ids = db.session.scalars(
+        db.select(WalletEntry.customer_id)
+        .join(Customer, Customer.id == WalletEntry.customer_id)
+        .where(WalletEntry.seq > Customer.wallet_seq)
+        .group_by(WalletEntry.customer_id)
+        .having(db.func.count() >= min_entries)
+    ).all()
+    db.session.rollback()
+    compacted = 0
+    for customer_id in customer_ids:
+        try:
+            lock_wallet(customer_id, exclusive=True)
+            wallet = current(customer_id)
+            if wallet is not None:
+                balance, seq = wallet
+                # Conditional on the snapshot read above, so two compactions
+                # racing on a customer cannot fold its entries twice
+                compacted += db.session.execute(
+                    db.update(Customer)
+                    .where(Customer.id == customer_id, Customer.wallet_seq < seq)
+                    .values(wallet_balance=balance, wallet_seq=seq)
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return compacted
+
+
+class WalletCompactor:
+    """
+    Background thread that runs :func:`compact` every ``interval`` seconds.
+
+    :param app: The Flask app whose database is compacted.
+    :param interval: Seconds between compactions.
+    :param min_entries: Passed to :func:`compact`.
+    """
+
+    def __init__(self, app, interval=60.0, min_entries=1):
+        self.app = app
+        self.interval = interval
+        self.min_entries = min_entries
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.compacted = 0
+        self.errors = 0
+        self.last_run = None
+
+    def start(self):
+        """Start the background thread (idempotent)."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='wallet-compactor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        try:
+            with self.app.app_context():
+                compacted = compact(self.min_entries)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning("Wallet compaction failed: %s", e)
+            return
+        with self._lock:
+            self.runs += 1
+            self.compacted += compacted
+            self.last_run = time.time()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'min_entries': self.min_entries,
+                'running': self._thread is not None and not self._stop.is_set(),
+                'runs': self.runs,
+                'compacted': self.compacted,
+                'errors': self.errors,
+                'last_run': self.last_run,
+            }
@@ -1,14 +1,45 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify
 from sqlalchemy.exc import IntegrityError
 from models import Product
 from db import db, init_db
+from dbrouting import read_only
+from config import Config
+from resilience import init_resilience
+from codec import init_codec
+from compression import init_compression
+from tracing import init_tracing
+from changes import DELETE, changes_since, head_seq, record_change
+from combiner import GRANTED, NOT_FOUND, StockCombiner, StockConflictError
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://user:password@db/inventory_db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-init_db(app)
+COMPRESSION_MIN_SIZE = 1024
 
-@app.route('/inventory/validate/<int:product_id>', methods=['GET'])
+CHANGES_DEFAULT_LIMIT = 500
+CHANGES_MAX_LIMIT = 5000
+
+STOCK_COMBINE_WINDOW = 0.002
+STOCK_COMBINE_MAX_BATCH = 500
+
+stock_combiner = StockCombiner(STOCK_COMBINE_WINDOW, STOCK_COMBINE_MAX_BATCH)
+
+bp = Blueprint('inventory', __name__)
+
+# Fields a PUT may change; the version is only ever bumped by the server
+UPDATABLE_PRODUCT_FIELDS = frozenset(Product.__table__.columns.keys()) - {'id', 'version'}
+
+def if_match_versions():
+    """
+    Return the versions the request's ``If-Match`` header accepts.
+
+    :return: None if there is no header or it is ``*``; otherwise the set of
+        versions named by its strong entity tags (empty if none is a version).
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    return {int(tag) for tag in if_match.as_set() if tag.isdigit()}
+
+@bp.route('/inventory/validate/<int:product_id>', methods=['GET'])
+@read_only
 def validate_product(product_id):
     """
     Validate if a product exists in the database.
@@ -41,7 +72,7 @@ def validate_product(product_id):
             "product_id": product_id
         }), 404
     
-@app.route('/inventory', methods=['POST'])
+@bp.route('/inventory', methods=['POST'])
 def add_product():
     """
     Add a new product to the inventory.
@@ -68,13 +99,15 @@ def add_product():
         data = request.json
         product = Product(**data)
         db.session.add(product)
+        record_change(product)
         db.session.commit()
         return jsonify({"message": "Product added successfully"}), 201
     except IntegrityError:
         db.session.rollback()
         return jsonify({"error": "Product could not be added"}), 400
 
-@app.route('/inventory', methods=['GET'])
+@bp.route('/inventory', methods=['GET'])
+@read_only
 def get_all_products():
     """
     Get a list of all products in the inventory.
@@ -93,7 +126,8 @@ def get_all_products():
     products_list = [product.to_dict() for product in products] 
     return jsonify(products_list), 200
 
-@app.route('/inventory/<int:product_id>', methods=['GET'])
+@bp.route('/inventory/<int:product_id>', methods=['GET'])
+@read_only
 def get_product_details(product_id):
     """
     Get details of a specific product by its ID.
@@ -106,7 +140,8 @@ def get_product_details(product_id):
         - `product_id` (int): The ID of the product.
 
     **Responses:**
-        - 200: Product details.
+        - 200: Product details, with the product's version as ``ETag``.
+        - 304: The ``If-None-Match`` header names the current version.
         - 404: Product not found.
 
     :param product_id: The ID of the product.
@@ -116,11 +151,13 @@ def get_product_details(product_id):
     """
     product = Product.query.get(product_id)
     if product:
-        return jsonify(product.to_dict()), 200
+        response = jsonify(product.to_dict())
+        response.set_etag(str(product.version))
+        return response.make_conditional(request)
     else:
         return jsonify({"error": "Product not found"}), 404
 
-@app.route('/inventory/<int:product_id>', methods=['DELETE'])
+@bp.route('/inventory/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
     """
     Delete a specific product by its ID.
@@ -143,13 +180,14 @@ def delete_product(product_id):
     """
     product = Product.query.get(product_id)
     if product:
+        record_change(product, DELETE)
         db.session.delete(product)
         db.session.commit()
         return jsonify({"message": "Product deleted successfully"}), 200
     else:
         return jsonify({"error": "Product not found"}), 404
 
-@app.route('/inventory/<int:product_id>', methods=['PUT'])
+@bp.route('/inventory/<int:product_id>', methods=['PUT'])
 def update_product(product_id):
     """
     Update a specific product by its ID.
@@ -168,24 +206,184 @@ def update_product(product_id):
         - `description` (str, optional): The description of the product. (max 200 characters)
         - `count_in_stock` (int, optional): The quantity of the product in stock.
 
+    **Headers:**
+        - `If-Match` (optional): The product's ``ETag`` as read by the
+          client. The update is then a single ``UPDATE ... WHERE version = :v``:
+          no lock is held between the read and the write, and a concurrent
+          change (including a sale) fails it with 412 instead of being
+          overwritten. Without it the update is unconditional.
+
     **Responses:**
-        - 200: Product updated successfully.
+        - 200: Product updated successfully; returns the new `ETag`.
+        - 400: A field is unknown or read-only (`id`, `version`).
         - 404: Product not found.
+        - 412: The product changed since the `If-Match` version.
 
     :param product_id: The ID of the product.
     :type product_id: int
     :return: JSON response with a message or error message and status code.
     :rtype: tuple
     """
-    product = Product.query.get(product_id)
-    if product:
-        data = request.json
-        for key, value in data.items():
-            setattr(product, key, value)
-        db.session.commit()
-        return jsonify({"message": "Product updated successfully"}), 200
-    else:
+    data = request.json
+    unknown = set(data) - UPDATABLE_PRODUCT_FIELDS
+    if unknown:
+        return jsonify({"error": f"Unknown or read-only fields: {', '.join(sorted(unknown))}"}), 400
+    versions = if_match_versions()
+    statement = (db.update(Product)
+                 .where(Product.id == product_id)
+                 .values(**data, version=Product.version + 1)
+                 .execution_options(synchronize_session=False))
+    if versions is not None:
+        statement = statement.where(Product.version.in_(versions))
+    if not db.session.execute(statement).rowcount:
+        db.session.rollback()
+        if db.session.get(Product, product_id) is None:
+            return jsonify({"error": "Product not found"}), 404
+        return jsonify({"error": "Product was modified since the If-Match version"}), 412
+    product = db.session.get(Product, product_id, populate_existing=True)
+    record_change(product)
+    version = product.version
+    db.session.commit()
+    response = jsonify({"message": "Product updated successfully"})
+    response.set_etag(str(version))
+    return response, 200
+
+@bp.route('/inventory/<int:product_id>/decrement', methods=['POST'])
+def decrement_stock(product_id):
+    """
+    Take units of a product out of stock, if enough are left.
+
+    Concurrent decrements of the same product are combined and committed
+    together; units go to requests in arrival order.
+
+    **Endpoint:** ``/inventory/<product_id>/decrement``
+
+    **Method:** ``POST``
+
+    **URL Parameters:**
+        - `product_id` (int): The ID of the product.
+
+    **Request Body:**
+        - `quantity` (int): The number of units to take (at least 1).
+
+    **Responses:**
+        - 200: Stock decremented; returns the remaining `count_in_stock`.
+        - 400: Invalid quantity, or insufficient stock.
+        - 404: Product not found.
+        - 409: The stock kept changing concurrently; nothing was taken.
+
+    :param product_id: The ID of the product.
+    :type product_id: int
+    :return: JSON response with the remaining stock or an error message and status code.
+    :rtype: tuple
+    """
+    quantity = request.json.get('quantity')
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+        return jsonify({"error": "quantity must be a positive integer"}), 400
+    try:
+        outcome, count_in_stock = stock_combiner.decrement(product_id, quantity)
+    except StockConflictError as e:
+        return jsonify({"error": str(e)}), 409
+    if outcome == NOT_FOUND:
         return jsonify({"error": "Product not found"}), 404
+    if outcome != GRANTED:
+        return jsonify({"error": "Insufficient stock", "count_in_stock": count_in_stock}), 400
+    return jsonify({"message": "Stock updated successfully", "count_in_stock": count_in_stock}), 200
+
+@bp.route('/inventory/changes', methods=['GET'])
+@read_only
+def get_changes():
+    """
+    Get the product change feed.
+
+    Every add, update and delete of a product is recorded with a
+    monotonically increasing sequence number. Consumers keep the ``last_seq``
+    of the previous page and pass it as ``since`` to receive only newer
+    changes, in order.
+
+    **Endpoint:** ``/inventory/changes``
+
+    **Method:** ``GET``
+
+    **Query Parameters:**
+        - `since` (int, optional): Return changes with a greater sequence number. Defaults to 0.
+        - `limit` (int, optional): Maximum number of changes, at most 5000. Defaults to 500.
+
+    **Responses:**
+        - 200: ``{"changes": [...], "last_seq": <int>, "head_seq": <int>}``. Each
+          change has `seq`, `product_id`, `operation` (``upsert`` or ``delete``)
+          and `data` (the full product for upserts).
+        - 400: Invalid parameters.
+
+    :return: JSON response with the changes and status code.
+    :rtype: tuple
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', CHANGES_DEFAULT_LIMIT, type=int)
+    if since is None or since < 0 or limit is None or not (1 <= limit <= CHANGES_MAX_LIMIT):
+        return jsonify({"error": "Invalid since or limit"}), 400
+    head = head_seq()
+    changes = changes_since(since, limit)
+    return jsonify({
+        "changes": [change.to_dict() for change in changes],
+        "last_seq": changes[-1].seq if changes else since,
+        "head_seq": head
+    }), 200
+
+@bp.route('/inventory/snapshot', methods=['GET'])
+@read_only
+def get_snapshot():
+    """
+    Get all products together with the change feed position they reflect.
+
+    Used to bootstrap a replica of the catalog: load ``products``, then tail
+    ``/inventory/changes`` from ``head_seq``. The head is read before the
+    products, so the snapshot is never older than ``head_seq``; replaying
+    changes that are already reflected is harmless because every change
+    carries the full product.
+
+    **Endpoint:** ``/inventory/snapshot``
+
+    **Method:** ``GET``
+
+    **Responses:**
+        - 200: ``{"head_seq": <int>, "products": [...]}``.
+
+    :return: JSON response with the snapshot and status code.
+    :rtype: tuple
+    """
+    head = head_seq()
+    products = Product.query.all()
+    return jsonify({
+        "head_seq": head,
+        "products": [product.to_dict() for product in products]
+    }), 200
+
+def create_app(config=None):
+    """
+    Create the inventory service app.
+
+    Creating the app does not connect to the database; see :mod:`config` for
+    the settings and :func:`db.init_db` for schema creation.
+
+    :param config: Settings overriding :class:`config.Config`: a mapping, or
+        an object with upper-case attributes such as :class:`config.TestingConfig`.
+    :return: The Flask app.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    init_db(app)
+
+    init_tracing(app, 'inventory')
+    init_resilience(app)
+    init_codec(app)
+    init_compression(app, min_size=COMPRESSION_MIN_SIZE)
+    app.register_blueprint(bp)
+    return app
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""
+Product change feed.
+
+Every write to a :class:`Product` also appends a :class:`ProductChange` row in
+the same transaction, carrying the full new state of the product (or a
+delete marker). Consumers tail the feed with ``GET /inventory/changes`` and
+apply changes in ``seq`` order to keep a local copy of the catalog.
+
+A reader must never see seq ``n + 1`` committed while ``n`` is still in
+flight, or it would move its cursor past ``n`` and lose that change. On
+PostgreSQL, writers therefore take a transaction-scoped advisory lock before
+appending, so changes commit in sequence order; SQLite already serializes
+writers.
+"""
+from sqlalchemy import text
+
+from db import db
+from models import ProductChange
+
+UPSERT = 'upsert'
+DELETE = 'delete'
+
+CHANGE_FEED_LOCK_ID = 435001
+
+
+def record_change(product, operation=UPSERT):
+    """
+    Append a change for ``product`` to the feed in the current transaction.
+
+    :param product: The :class:`Product` that was written. New products are
+        flushed first so that they have an ID.
+    :param operation: ``UPSERT`` or ``DELETE``.
+    :return: The pending :class:`ProductChange`.
+    """
+    if product.id is None:
+        db.session.flush()
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:lock_id)'), {'lock_id': CHANGE_FEED_LOCK_ID})
+    change = ProductChange(
+        product_id=product.id,
+        operation=operation,
+        data=product.to_dict() if operation == UPSERT else None,
+    )
+    db.session.add(change)
+    return change
+
+
+def head_seq():
+    """
+    Return the sequence number of the latest committed change (0 if none).
+    """
+    return db.session.scalar(db.select(db.func.max(ProductChange.seq))) or 0
+
+
+def changes_since(since, limit):
+    """
+    Return up to ``limit`` changes with ``seq > since``, oldest first.
+    """
+    return (ProductChange.query
+            .filter(ProductChange.seq > since)
+            .order_by(ProductChange.seq)
+            .limit(limit)
+            .all())
@@ -0,0 +1,166 @@
+"""
+Group commit for stock decrements.
+
+During a flash sale many requests decrement the same product at once. Run one
+transaction each and they queue on that product's row lock, so throughput is
+capped at one commit per unit sold. :class:`StockCombiner` instead gathers
+the decrements for a product that arrive within a short window and applies
+them in a single transaction. The units are handed out in arrival order.
+Decrements that no longer fit are rejected. The stock is written with one
+conditional UPDATE and one change-feed entry, and each caller gets its own
+answer.
+
+The first request of a window is its leader. It waits ``window`` seconds,
+then waits for the previous batch of the same product to commit, and applies
+the whole batch in its own request context. Decrements keep joining the batch
+until then, so the batches grow with the load. The other requests of the
+batch wait for the result. Combining happens within one process; batches of
+different worker processes are kept apart by a row lock (PostgreSQL) and by
+the UPDATE being conditional on the stock that was read.
+
+Batches of the same product commit one after another, under one of a fixed
+set of ``commit_stripes`` locks chosen by product id. Products sharing a lock
+also take turns, which the batching makes up for; in exchange the locks
+don't grow with the number of products ever sold.
+"""
+import threading
+import time
+from concurrent.futures import Future
+
+from db import db
+from models import Product
+from changes import record_change
+
+GRANTED = 'granted'
+INSUFFICIENT = 'insufficient'
+NOT_FOUND = 'not_found'
+
+MAX_CONFLICT_RETRIES = 5
+
+
+class StockConflictError(Exception):
+    """The stock kept changing under a batch; no decrement was applied."""
+
+
+class _Decrement:
+    def __init__(self, quantity):
+        self.quantity = quantity
+        self.future = Future()
+
+
+class StockCombiner:
+    """
+    Batches concurrent stock decrements per product.
+
+    :param window: Seconds the leader of a batch waits for more decrements.
+    :param max_batch: A batch that reaches this size closes early; with
+        ``max_batch=1`` every decrement commits on its own.
+    :param commit_stripes: Number of locks ordering the commits of batches.
+    """
+
+    def __init__(self, window=0.002, max_batch=500, commit_stripes=64):
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._commit_locks = [threading.Lock() for _ in range(commit_stripes)]
+        self.batches = 0
+        self.decrements = 0
+        self.conflicts = 0
+
+    def decrement(self, product_id, quantity, timeout=None):
+        """
+        Decrement the stock of a product by ``quantity``.
+
+        Must be called in an application context.
+
+        :param timeout: Seconds to wait for a batch led by another request.
+        :return: ``(outcome, count_in_stock)``: ``GRANTED`` with the stock
+            left after the batch, ``INSUFFICIENT`` with the stock left, or
+            ``NOT_FOUND`` with None.
+        :raises StockConflictError: If the batch could not be applied.
+        :raises concurrent.futures.TimeoutError: If ``timeout`` elapses first.
+        """
+        decrement = _Decrement(quantity)
+        with self._lock:
+            batch = self._pending.get(product_id)
+            leader = batch is None
+            if leader:
+                batch = self._pending[product_id] = []
+            batch.append(decrement)
+            if len(batch) >= self.max_batch:
+                del self._pending[product_id]
+        if leader:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self._commit_lock(product_id):
+                with self._lock:
+                    if self._pending.get(product_id) is batch:
+                        del self._pending[product_id]
+                self._apply(product_id, batch)
+        return decrement.future.result(timeout)
+
+    def _commit_lock(self, product_id):
+        return self._commit_locks[hash(product_id) % len(self._commit_locks)]
+
+    def _apply(self, product_id, batch):
+        try:
+            results = self._commit(product_id, [d.quantity for d in batch])
+        except BaseException as e:
+            db.session.rollback()
+            for d in batch:
+                d.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        with self._lock:
+            self.batches += 1
+            self.decrements += len(batch)
+        for d, result in zip(batch, results):
+            d.future.set_result(result)
+
+    def _commit(self, product_id, quantities):
+        for _ in range(MAX_CONFLICT_RETRIES):
+            product = db.session.get(Product, product_id, populate_existing=True, with_for_update=True)
+            if product is None:
+                return [(NOT_FOUND, None)] * len(quantities)
+
+            available = product.count_in_stock
+            granted = []
+            for quantity in quantities:
+                ok = quantity <= available
+                granted.append(ok)
+                if ok:
+                    available -= quantity
+            if available == product.count_in_stock:
+                db.session.rollback()
+                return [(INSUFFICIENT, available)] * len(quantities)
+
+            # Conditional on the stock read above, so a concurrent writer
+            # (another batch or a PUT) makes this batch retry instead of
+            # overselling.
+            result = db.session.execute(
+                db.update(Product)
+                .where(Product.id == product_id, Product.count_in_stock == product.count_in_stock)
+                .values(count_in_stock=available, version=Product.version + 1)
+            )
+            if result.rowcount == 1:
+                record_change(product)
+                db.session.commit()
+                return [(GRANTED if ok else INSUFFICIENT, available) for ok in granted]
+            db.session.rollback()
+            with self._lock:
+                self.conflicts += 1
+        raise StockConflictError(f"Stock of product {product_id} changed concurrently")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "window": self.window,
+                "max_batch": self.max_batch,
+                "commit_stripes": len(self._commit_locks),
+                "batches": self.batches,
+                "decrements": self.decrements,
+                "avg_batch": self.decrements / self.batches if self.batches else 0.0,
+                "conflicts": self.conflicts,
+            }
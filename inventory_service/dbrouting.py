@@ -0,0 +1,139 @@
+"""
+Routing of read-only requests to a read replica.
+
+When ``SQLALCHEMY_BINDS`` has a ``replica`` entry (set from
+``DATABASE_REPLICA_URL``), routes decorated with :func:`read_only` run their
+queries on the replica engine; everything else, and anything a read-only
+route flushes, uses the primary. A :class:`ReplicaMonitor` measures the
+replica's lag at most once per ``REPLICA_LAG_CHECK_INTERVAL`` seconds; while
+it is above ``REPLICA_MAX_LAG`` or cannot be measured, read-only routes fall
+back to the primary.
+
+Reads that must observe the caller's own writes (wallet balances, anything
+that fills a cache) stay on the primary by not being marked read-only.
+
+This module is identical in every service.
+"""
+import logging
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND = 'replica'
+DEFAULT_MAX_LAG = 5.0
+DEFAULT_LAG_CHECK_INTERVAL = 1.0
+
+LAG_QUERIES = {
+    # Caught up when everything received has been replayed; otherwise the age
+    # of the last replayed transaction. 0 on a server that is not a standby.
+    'postgresql': text(
+        'SELECT CASE WHEN NOT pg_is_in_recovery() '
+        'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+        'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+    ),
+}
+
+
+class RoutingSession(Session):
+    """
+    Session that sends the queries of read-only routes to the replica engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('use_replica'):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaMonitor:
+    """
+    Tracks the replication lag of the replica engine.
+
+    :param engine: The replica engine.
+    :param max_lag: Largest lag in seconds at which the replica is used.
+    :param check_interval: Seconds a measurement is reused for.
+    """
+
+    def __init__(self, engine, max_lag=DEFAULT_MAX_LAG, check_interval=DEFAULT_LAG_CHECK_INTERVAL):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._lag = None
+        self._checked_at = None
+        self.reads = 0
+        self.fallbacks = 0
+        self.check_errors = 0
+
+    def _measure(self):
+        query = LAG_QUERIES.get(self.engine.dialect.name)
+        if query is None:
+            # Nothing to measure (e.g. two SQLite files standing in for
+            # primary and replica); treat the replica as current
+            return 0.0
+        with self.engine.connect() as conn:
+            return float(conn.execute(query).scalar() or 0.0)
+
+    def lag(self):
+        """
+        Return the replica's lag in seconds, or None if it could not be measured.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= self.check_interval:
+                try:
+                    self._lag = self._measure()
+                except Exception as e:  # An unreachable replica must not fail reads
+                    self.check_errors += 1
+                    logger.warning("Measuring replica lag failed: %s", e)
+                    self._lag = None
+                self._checked_at = now
+            return self._lag
+
+    def usable(self):
+        """Whether reads may go to the replica now; counts the decision."""
+        lag = self.lag()
+        ok = lag is not None and lag <= self.max_lag
+        with self._lock:
+            if ok:
+                self.reads += 1
+            else:
+                self.fallbacks += 1
+        return ok
+
+    def status(self):
+        lag = self.lag()
+        with self._lock:
+            return {
+                'configured': True,
+                'lag': lag,
+                'max_lag': self.max_lag,
+                'reads': self.reads,
+                'fallbacks': self.fallbacks,
+                'check_errors': self.check_errors,
+            }
+
+
+def read_only(func):
+    """
+    Run a route's queries on the replica, if one is configured and current.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        monitor = current_app.extensions.get('db_replica')
+        previous = g.get('use_replica', False)
+        g.use_replica = monitor is not None and monitor.usable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.use_replica = previous
+
+    return wrapper
@@ -0,0 +1,29 @@
+"""Add product.version for conditional updates
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 09:00:00.000000
+
+``PUT /inventory/<product_id>`` compares ``If-Match`` against this version; existing
+products start at version 1.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('product')}
+    if 'version' not in columns:
+        op.add_column('product', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('product') as batch_op:
+        batch_op.drop_column('version')
@@ -7,6 +7,11 @@ class Product(db.Model):
     price_per_item = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(200), nullable=True)
     count_in_stock = db.Column(db.Integer, nullable=False)
+    # Bumped by every write; sent as the ETag of the product and checked
+    # against If-Match on updates
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def to_dict(self):
         return {
@@ -15,5 +20,26 @@ class Product(db.Model):
             "category": self.category,
             "price_per_item": self.price_per_item,
             "description": self.description,
-            "count_in_stock": self.count_in_stock
+            "count_in_stock": self.count_in_stock,
+            "version": self.version
+        }
+
+
+class ProductChange(db.Model):
+    __tablename__ = 'product_changes'
+
+    # Change feed consumed by other services: one row per product write,
+    # numbered by a monotonically increasing sequence.
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    def to_dict(self):
+        return {
+            "seq": self.seq,
+            "product_id": self.product_id,
+            "operation": self.operation,
+            "data": self.data
         }
@@ -0,0 +1,409 @@
+"""
+Resilience layer for calls between services.
+
+* :class:`CircuitBreaker` stops calling a failing dependency for a while and
+  then lets a limited number of probe calls through (half-open) to detect
+  recovery.
+* :class:`Bulkhead` bounds the number of concurrent calls to one dependency,
+  so a slow dependency can tie up at most that many workers.
+* :class:`SingleFlight` lets concurrent identical GETs share one call to the
+  dependency, so a burst of requests for the same resource costs one
+  downstream request.
+* Request deadlines travel in the ``X-Request-Deadline`` header (absolute
+  epoch milliseconds). :func:`init_resilience` makes a service reject requests
+  whose deadline already passed, and :class:`Downstream` forwards the
+  deadline of the current request and caps each call's timeout by it.
+* Each call made by :class:`Downstream` inside a traced request is recorded
+  as a client span and carries the ``traceparent`` header (see
+  :mod:`tracing`).
+
+This module is identical in every service.
+"""
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import requests
+from flask import g, has_request_context, jsonify, request
+
+from tracing import TRACEPARENT_HEADER, start_span, unsampled_traceparent
+
+DEADLINE_HEADER = "X-Request-Deadline"
+
+
+class DownstreamUnavailable(Exception):
+    """A downstream call was not attempted or did not complete."""
+
+    status_code = 503
+
+
+class CircuitOpenError(DownstreamUnavailable):
+    """The dependency's circuit breaker is open."""
+
+
+class BulkheadFullError(DownstreamUnavailable):
+    """Too many calls to the dependency are already in flight."""
+
+
+class DeadlineExceeded(DownstreamUnavailable):
+    """The deadline of the current request has passed."""
+
+    status_code = 504
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker with half-open probing.
+
+    ``closed``: calls pass; ``failure_threshold`` consecutive failures open the
+    circuit. ``open``: calls are rejected until ``reset_timeout`` seconds have
+    passed. ``half_open``: up to ``half_open_max_calls`` probes pass; a
+    successful probe closes the circuit, a failed one opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, half_open_max_calls=1, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+        self.trips = 0
+        self.rejections = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def allow(self):
+        """
+        Ask permission for one call; every allowed call must be followed by
+        :meth:`record_success` or :meth:`record_failure`.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            self.rejections += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.trips += 1
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self._failures = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._current_state(),
+                "trips": self.trips,
+                "rejections": self.rejections,
+            }
+
+
+class Bulkhead:
+    """
+    Limit on concurrent calls to one dependency.
+
+    :param max_concurrent: Calls allowed in flight at once.
+    :param max_wait: Seconds a call may wait for a free slot before being rejected.
+    """
+
+    def __init__(self, max_concurrent=20, max_wait=0.1):
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejections = 0
+
+    def acquire(self, timeout=None):
+        wait = self.max_wait if timeout is None else min(self.max_wait, timeout)
+        if not self._semaphore.acquire(timeout=max(wait, 0)):
+            with self._lock:
+                self.rejections += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "in_flight": self.in_flight,
+                "rejections": self.rejections,
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution.
+
+    The first caller for a key (the leader) runs the call; callers arriving
+    while it is in flight wait for and share its result or exception. A call
+    arriving after the leader finished starts a new execution, so results are
+    never reused once they have been delivered.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run ``fn()`` for ``key``, or wait for the in-flight run of the same key.
+
+        :param timeout: Seconds a waiting caller waits for the leader.
+        :raises concurrent.futures.TimeoutError: If ``timeout`` elapses first.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result(timeout)
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._inflight),
+            }
+
+
+def current_deadline():
+    """
+    Return the deadline (epoch seconds) of the request being handled, or None.
+    """
+    if has_request_context():
+        return g.get("deadline")
+    return None
+
+
+def remaining_time(deadline=None):
+    """
+    Seconds left until ``deadline`` (default: the current request's), or None.
+    """
+    deadline = current_deadline() if deadline is None else deadline
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+class Downstream:
+    """
+    HTTP client for one dependency, guarded by a circuit breaker and a bulkhead.
+
+    Connection errors, timeouts and 5xx answers count as failures for the
+    breaker; any other answer is returned to the caller as is. Each thread
+    reuses its own keep-alive :class:`requests.Session`.
+
+    With ``coalesce_gets``, concurrent GETs of the same path and query
+    parameters share one call (see :class:`SingleFlight`); callers receive the
+    same :class:`requests.Response` object and must treat it as read-only.
+
+    :param name: Name of the dependency, used in errors and stats.
+    :param base_url: Base URL of the dependency.
+    :param timeout: Default timeout in seconds of a call.
+    :param coalesce_gets: Whether to coalesce identical concurrent GETs.
+    :param headers: Headers sent with every call, e.g. ``Accept`` and
+        ``Accept-Encoding``; per-call headers take precedence.
+    """
+
+    def __init__(self, name, base_url, timeout=5.0, breaker=None, bulkhead=None, coalesce_gets=False,
+                 headers=None):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self.breaker = breaker or CircuitBreaker()
+        self.bulkhead = bulkhead or Bulkhead()
+        self.single_flight = SingleFlight() if coalesce_gets else None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def request(self, method, path, deadline=None, **kwargs):
+        """
+        Call the dependency.
+
+        :param method: HTTP method.
+        :param path: Path relative to the base URL.
+        :param deadline: Absolute deadline (epoch seconds); defaults to the
+            current request's deadline.
+        :param kwargs: Passed on to :meth:`requests.Session.request`.
+        :return: The :class:`requests.Response`.
+        :raises DownstreamUnavailable: If the call was rejected or failed
+            without a response.
+        """
+        deadline = current_deadline() if deadline is None else deadline
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Deadline exceeded before calling {self.name}")
+
+        if method == "GET" and self.single_flight is not None and not kwargs.get("headers"):
+            params = kwargs.get("params") or {}
+            key = (path, tuple(sorted(params.items())))
+            try:
+                return self.single_flight.do(
+                    key, lambda: self._call(method, path, deadline, **kwargs), timeout=remaining
+                )
+            except FutureTimeoutError:
+                raise DeadlineExceeded(f"Deadline exceeded waiting for {self.name}") from None
+        return self._call(method, path, deadline, **kwargs)
+
+    def _call(self, method, path, deadline, **kwargs):
+        timeout = kwargs.pop("timeout", self.timeout)
+        headers = dict(self.headers, **(kwargs.pop("headers", None) or {}))
+        if deadline is not None:
+            timeout = min(timeout, max(deadline - time.time(), 0.001))
+            headers[DEADLINE_HEADER] = str(int(deadline * 1000))
+
+        if not self.bulkhead.acquire(timeout):
+            raise BulkheadFullError(f"Too many concurrent calls to {self.name}")
+        if not self.breaker.allow():
+            self.bulkhead.release()
+            raise CircuitOpenError(f"Circuit breaker for {self.name} is open")
+        with self._lock:
+            self.calls += 1
+        try:
+            with start_span(f"{method} {self.name}", "client", {"http.method": method, "http.target": path}) as span:
+                headers[TRACEPARENT_HEADER] = span.traceparent() if span is not None else unsampled_traceparent()
+                response = self._session().request(
+                    method, f"{self.base_url}{path}", headers=headers, timeout=timeout, **kwargs
+                )
+                if span is not None:
+                    span.set_attribute("http.status_code", response.status_code)
+        except Exception as e:
+            # Any error, not only a failed request, has to resolve the call
+            # for the breaker, or a half-open probe would never complete
+            self._record_failure()
+            if isinstance(e, requests.RequestException):
+                raise DownstreamUnavailable(f"Call to {self.name} failed: {e}") from e
+            raise
+        finally:
+            self.bulkhead.release()
+        if response.status_code >= 500:
+            self._record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _record_failure(self):
+        with self._lock:
+            self.failures += 1
+        self.breaker.record_failure()
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            calls, failures = self.calls, self.failures
+        return {
+            "base_url": self.base_url,
+            "calls": calls,
+            "failures": failures,
+            "circuit_breaker": self.breaker.stats(),
+            "bulkhead": self.bulkhead.stats(),
+            "single_flight": self.single_flight.stats() if self.single_flight else None,
+        }
+
+
+def init_resilience(app, default_budget=None):
+    """
+    Install deadline handling and error responses on a Flask app.
+
+    Incoming requests carrying an expired ``X-Request-Deadline`` are answered
+    with 504 without running the handler. Requests without the header get a
+    deadline of ``default_budget`` seconds from arrival, if given.
+    :class:`DownstreamUnavailable` errors raised by handlers become 503
+    (504 for deadlines) JSON responses.
+    """
+    @app.before_request
+    def read_deadline():
+        header = request.headers.get(DEADLINE_HEADER)
+        deadline = None
+        if header:
+            try:
+                deadline = int(header) / 1000.0
+            except ValueError:
+                deadline = None
+        if deadline is None and default_budget is not None:
+            deadline = time.time() + default_budget
+        g.deadline = deadline
+        if deadline is not None and deadline <= time.time():
+            return jsonify({"error": "Deadline exceeded"}), 504
+
+    @app.errorhandler(DownstreamUnavailable)
+    def downstream_unavailable(e):
+        return jsonify({"error": str(e)}), e.status_code
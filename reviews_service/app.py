@@ -1,18 +1,193 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, literal_column, or_
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
 from models import Review
 from db import db, init_db
-import requests
+from dbrouting import read_only
+from config import Config
+from moderation import RescanJob, TermMatcher, apply_moderation, get_matcher, rescan_status, set_terms
+from search import REINDEX_CHUNK_SIZE, index_review, rebuild_index, search_reviews, unindex_review
+from resilience import Bulkhead, CircuitBreaker, Downstream, init_resilience
+from codec import ACCEPT_MSGPACK, decode_response, init_codec
+from tracing import init_tracing
+from compression import ACCEPT_ENCODING, init_compression
+from jobs import Report, init_jobs
+import reports
+import base64
+import click
+import datetime
+import threading
+
+REQUEST_BUDGET = 10.0
+DOWNSTREAM_TIMEOUT = 5.0
+DOWNSTREAM_MAX_CONCURRENT = 20
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+COMPRESSION_MIN_SIZE = 1024
+DOWNSTREAM_HEADERS = {
+    'Accept': ACCEPT_MSGPACK,
+    'Accept-Encoding': ACCEPT_ENCODING,
+}
+
+
+def make_client(name, base_url):
+    """Create the guarded client for a downstream service."""
+    return Downstream(
+        name,
+        base_url,
+        timeout=DOWNSTREAM_TIMEOUT,
+        breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT),
+        bulkhead=Bulkhead(DOWNSTREAM_MAX_CONCURRENT),
+        headers=DOWNSTREAM_HEADERS,
+    )
+
+
+MODERATION_QUEUE_DEFAULT_LIMIT = 50
+MODERATION_QUEUE_MAX_LIMIT = 500
+BULK_MODERATION_MAX_IDS = 5000
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+REPORT_WORKERS = 2
+REPORT_MAX_QUEUED = 16
+REPORT_MEMORY_LIMIT = 1024 * 1024 * 1024
+REPORT_TIME_LIMIT = 120.0
+REPORT_CACHE_TTL = 300.0
+REPORT_CACHE_SIZE = 100
+
+# Attempts of an upsert racing with concurrent inserts and deletes of the review
+UPSERT_ATTEMPTS = 3
+
+# Serializes rescan starts within a worker; RescanJob.claim does so across workers
+rescan_lock = threading.Lock()
+
+bp = Blueprint('reviews', __name__)
+
+
+def authenticate_admin(username, password):
+    """
+    Check admin credentials against the customer service.
+
+    :param username: The admin's username (must be "admin").
+    :param password: The admin's password.
+    :return: True if the credentials belong to the admin account.
+    :rtype: bool
+    """
+    if username != "admin":
+        return False
+    response = current_app.extensions['customers_client'].post('/auth', json={"username" : username, "password" : password})
+    return response.status_code == 200
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://user:password@db/reviews_db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-init_db(app)
 
-CUSTOMERS_SERVICE_URL = 'http://customers_service:5000'
-INVENTORY_SERVICE_URL = 'http://inventory_service:5000'
+def upsert_review(review):
+    """
+    Insert a review, or update the customer's existing review of the product.
+
+    On PostgreSQL this is one ``INSERT ... ON CONFLICT (customer_id,
+    product_id) DO UPDATE`` statement returning the stored row; ``xmax = 0``
+    tells whether the row was inserted. On SQLite an ``INSERT ... ON CONFLICT
+    DO NOTHING`` returns the row only if it inserted it, and an ``UPDATE``
+    follows otherwise. Other databases lock the existing review with
+    ``SELECT ... FOR UPDATE`` and insert in a savepoint. Both retry if a
+    concurrent insert or delete gets in between. An updated review goes back
+    to the moderation queue.
+
+    :param review: A transient :class:`Review` holding the new values.
+    :return: ``(review, created)`` where ``created`` is False if an existing
+        review was updated.
+    :rtype: tuple
+    """
+    dialect = db.session.get_bind().dialect.name
+    now = datetime.datetime.utcnow()
+    key = {'customer_id': review.customer_id, 'product_id': review.product_id}
+    changes = {
+        'rating': review.rating,
+        'comment': review.comment,
+        'moderated': False,
+        'flagged': review.flagged,
+        'flag_score': review.flag_score,
+        'updated_at': now,
+    }
+    populate = {'populate_existing': True}
+
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(Review).values(**key, **changes, created_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Review.customer_id, Review.product_id],
+            set_={name: stmt.excluded[name] for name in changes},
+        ).returning(Review, literal_column('xmax = 0').label('created'))
+        stored, created = db.session.execute(stmt, execution_options=populate).one()
+        return stored, created
+
+    update_existing = (
+        db.update(Review)
+        .where(Review.customer_id == review.customer_id, Review.product_id == review.product_id)
+        .values(**changes)
+        .returning(Review)
+    )
+    for _ in range(UPSERT_ATTEMPTS):
+        if dialect == 'sqlite':
+            inserted = db.session.scalars(
+                sqlite.insert(Review).values(**key, **changes, created_at=now)
+                .on_conflict_do_nothing(index_elements=[Review.customer_id, Review.product_id])
+                .returning(Review),
+                execution_options=populate,
+            ).first()
+            if inserted is not None:
+                return inserted, True
+            stored = db.session.scalars(update_existing, execution_options=populate).first()
+            if stored is not None:
+                return stored, False
+            continue
+
+        stored = db.session.scalars(
+            db.select(Review).filter_by(**key).with_for_update(),
+            execution_options=populate,
+        ).first()
+        if stored is not None:
+            for name, value in changes.items():
+                setattr(stored, name, value)
+            db.session.flush()
+            return stored, False
+        created = Review(**key, **changes, created_at=now)
+        try:
+            with db.session.begin_nested():
+                db.session.add(created)
+            return created, True
+        except IntegrityError:
+            # A concurrent request inserted the review first; update it
+            continue
+    raise IntegrityError(None, None, Exception('The review kept changing during the upsert'))
+
+
+def encode_queue_cursor(review):
+    """
+    Build an opaque pagination cursor pointing just after ``review``.
+
+    The moderation queue is ordered by ``(created_at, id)``, so the cursor
+    carries both values of the last review on a page.
+    """
+    raw = f"{review.created_at.isoformat()}|{review.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_queue_cursor(cursor):
+    """
+    Decode a cursor produced by :func:`encode_queue_cursor`.
+
+    :return: A ``(created_at, id)`` tuple.
+    :raises ValueError: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, review_id = raw.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(created_at), int(review_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
 
-@app.route('/reviews', methods=['POST'])
+@bp.route('/reviews', methods=['POST'])
 def submit_review():
     """
     Submit a new review for a product.
@@ -29,12 +204,20 @@ def submit_review():
         - username (str): The customer's username.
         - password (str): The customer's password.
         - comment (str, optional): An optional comment for the review.
+        - upsert (bool, optional): If true, replace the customer's existing
+          review of this product instead of failing. Defaults to false.
+
+    A customer can hold only one review per product. In upsert mode the
+    insert-or-update is a single atomic ``INSERT ... ON CONFLICT`` statement,
+    so clients editing their review don't need to look up its ID first.
 
     **Response**:
         - 201 Created: Review successfully added.
+        - 200 OK: Existing review replaced (upsert mode only).
         - 400 Bad Request: Missing required fields or invalid data (e.g., rating not between 0-5).
         - 403 Forbidden: Unauthorized customer or invalid credentials.
         - 404 Not Found: Product not found.
+        - 409 Conflict: The customer already reviewed this product (without upsert).
     """
     data = request.get_json()
     
@@ -51,16 +234,13 @@ def submit_review():
     rating = data.get('rating')
 
     # Authenticate and get customer's id
-    response = requests.post(f'{CUSTOMERS_SERVICE_URL}/auth', json={"username" : username, "password" : password})
-    response_data = response.json()
-    print("RESPONSE DATAAAAAAAA")
-    print("response data ", response_data)
-    customer_id = response_data['id']
+    response = current_app.extensions['customers_client'].post('/auth', json={"username" : username, "password" : password})
     if response.status_code != 200:
         return jsonify({"message" : "Unauthorized"}), 403
+    customer_id = decode_response(response)['id']
     
     # Check if product_id exists
-    response = requests.get(f'{INVENTORY_SERVICE_URL}/inventory/validate/{product_id}')
+    response = current_app.extensions['inventory_client'].get(f'/inventory/validate/{product_id}')
     if response.status_code != 200:
         return jsonify({"message" : "Product not found or does not exist."}), 404
 
@@ -76,16 +256,23 @@ def submit_review():
             rating=data['rating'],
             comment=data.get('comment', '')
         )
+        apply_moderation(review)
+        if data.get('upsert') == True:
+            review, created = upsert_review(review)
+            index_review(review)
+            db.session.commit()
+            return jsonify(review.to_dict()), 201 if created else 200
         db.session.add(review)
+        index_review(review)
         db.session.commit()
         return jsonify(review.to_dict()), 201
     except IntegrityError:
         db.session.rollback()
         return jsonify({
-            'error': 'Failed to create review'
-        }), 400
+            'error': 'Customer has already reviewed this product'
+        }), 409
 
-@app.route('/reviews/<int:review_id>', methods=['PUT'])
+@bp.route('/reviews/<int:review_id>', methods=['PUT'])
 def update_review(review_id):
     """
     Update an existing review.
@@ -118,10 +305,10 @@ def update_review(review_id):
     password = data.get("password")
 
     #Get customer's id after authenticating
-    response = requests.post(f'{CUSTOMERS_SERVICE_URL}/auth', json={"username" : username, "password" : password})
+    response = current_app.extensions['customers_client'].post('/auth', json={"username" : username, "password" : password})
     if response.status_code != 200:
         return jsonify({"message" : "Unauthorized"}), 403
-    customer_id = response.json()["id"]
+    customer_id = decode_response(response)["id"]
 
     # Verify customer owns this review
     if customer_id != review.customer_id:
@@ -139,6 +326,8 @@ def update_review(review_id):
     if 'comment' in data:
         review.comment = data['comment']
         review.moderated = False  # Reset moderation status on update
+        apply_moderation(review)
+        index_review(review)
         
     try:
         db.session.commit()
@@ -149,7 +338,7 @@ def update_review(review_id):
             'error': 'Failed to update review'
         }), 400
 
-@app.route('/reviews/<int:review_id>', methods=['DELETE'])
+@bp.route('/reviews/<int:review_id>', methods=['DELETE'])
 def delete_review(review_id):
     """
     Delete a review.
@@ -180,11 +369,12 @@ def delete_review(review_id):
     password = data.get("password")
 
     #Get customer's id after authenticating
-    response = requests.post(f'{CUSTOMERS_SERVICE_URL}/auth', json={"username" : username, "password" : password})
+    response = current_app.extensions['customers_client'].post('/auth', json={"username" : username, "password" : password})
     if response.status_code != 200:
         return jsonify({"message" : "Unauthorized"}), 403
     
     try:
+        unindex_review(review.id)
         db.session.delete(review)
         db.session.commit()
         return '', 200
@@ -194,7 +384,8 @@ def delete_review(review_id):
             'error': 'Failed to delete review'
         }), 400
 
-@app.route('/products/<int:product_id>/reviews', methods=['GET'])
+@bp.route('/products/<int:product_id>/reviews', methods=['GET'])
+@read_only
 def get_product_reviews(product_id):
     """
     Get all reviews for a specific product.
@@ -208,7 +399,8 @@ def get_product_reviews(product_id):
     reviews = Review.query.filter_by(product_id=product_id).all()
     return jsonify([review.to_dict() for review in reviews]), 200
 
-@app.route('/customers/<int:customer_id>/reviews', methods=['GET'])
+@bp.route('/customers/<int:customer_id>/reviews', methods=['GET'])
+@read_only
 def get_customer_reviews(customer_id):
     """
     Get all reviews by a specific customer.
@@ -223,7 +415,7 @@ def get_customer_reviews(customer_id):
     reviews = Review.query.filter_by(customer_id=customer_id).all()
     return jsonify([review.to_dict() for review in reviews]), 200
 
-@app.route('/reviews/<int:review_id>/moderate', methods=['POST'])
+@bp.route('/reviews/<int:review_id>/moderate', methods=['POST'])
 def moderate_review(review_id):
     """
     Moderate a review (admin only).
@@ -254,12 +446,8 @@ def moderate_review(review_id):
     username = data.get("username")
     password = data.get("password")
 
-    if username != "admin":
-        return jsonify({"message" : "Unauthorized"}), 403
-
     #Authenticate admin
-    response = requests.post(f'{CUSTOMERS_SERVICE_URL}/auth', json={"username" : username, "password" : password})
-    if response.status_code != 200:
+    if not authenticate_admin(username, password):
         return jsonify({"message" : "Unauthorized"}), 403
     
     if 'moderated' in data:
@@ -274,7 +462,8 @@ def moderate_review(review_id):
             'error': 'Failed to moderate review'
         }), 400
 
-@app.route('/reviews/<int:review_id>', methods=['GET'])
+@bp.route('/reviews/<int:review_id>', methods=['GET'])
+@read_only
 def get_review_details(review_id):
     """
     Get detailed information about a specific review.
@@ -288,6 +477,312 @@ def get_review_details(review_id):
     review = Review.query.get_or_404(review_id)
     return jsonify(review.to_dict()), 200
 
+@bp.route('/reviews/unmoderated', methods=['GET'])
+def get_unmoderated_reviews():
+    """
+    List the moderation work queue.
+
+    This endpoint returns unmoderated reviews, oldest first, using keyset
+    (cursor) pagination so that draining a large backlog stays cheap no matter
+    how deep into the queue a moderator is. The query is served by the partial
+    index on unmoderated reviews.
+
+    **Query parameters**:
+        - limit (int, optional): Page size, at most 500. Defaults to 50.
+        - cursor (str, optional): The ``next_cursor`` value from the previous page.
+
+    **Response**:
+        - 200 OK: ``{"reviews": [...], "next_cursor": <str or null>}``.
+        - 400 Bad Request: Invalid limit or cursor.
+    """
+    limit = request.args.get('limit', MODERATION_QUEUE_DEFAULT_LIMIT, type=int)
+    if limit is None or not (1 <= limit <= MODERATION_QUEUE_MAX_LIMIT):
+        return jsonify({
+            'error': f'Limit must be between 1 and {MODERATION_QUEUE_MAX_LIMIT}'
+        }), 400
+
+    query = Review.query.filter(Review.moderated == False)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            created_at, review_id = decode_queue_cursor(cursor)
+        except ValueError:
+            return jsonify({
+                'error': 'Invalid cursor'
+            }), 400
+        query = query.filter(or_(
+            Review.created_at > created_at,
+            and_(Review.created_at == created_at, Review.id > review_id),
+        ))
+
+    # Fetch one extra row to know whether another page exists
+    reviews = query.order_by(Review.created_at, Review.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        next_cursor = encode_queue_cursor(reviews[-1])
+
+    return jsonify({
+        'reviews': [review.to_dict() for review in reviews],
+        'next_cursor': next_cursor,
+    }), 200
+
+@bp.route('/reviews/moderate', methods=['POST'])
+def bulk_moderate_reviews():
+    """
+    Moderate many reviews at once (admin only).
+
+    The admin is authenticated once for the whole batch and all the listed
+    reviews are updated with a single set-based ``UPDATE`` statement.
+
+    **Request JSON body**:
+        - username (str): The admin's username (must be "admin").
+        - password (str): The admin's password.
+        - review_ids (list of int): IDs of the reviews to moderate (at most 5000).
+        - moderated (bool, optional): New moderation status. Defaults to true.
+
+    **Response**:
+        - 200 OK: ``{"moderated": <bool>, "requested": <int>, "updated": <int>}``.
+        - 400 Bad Request: Missing required fields or invalid review IDs.
+        - 403 Forbidden: Unauthorized or invalid admin credentials.
+    """
+    data = request.get_json()
+
+    required_fields = ['username', 'password', 'review_ids']
+    if not all(field in data for field in required_fields):
+        return jsonify({
+            'error': 'Missing required fields'
+        }), 400
+
+    review_ids = data['review_ids']
+    if (not isinstance(review_ids, list) or not review_ids
+            or not all(isinstance(i, int) and not isinstance(i, bool) for i in review_ids)):
+        return jsonify({
+            'error': 'review_ids must be a non-empty list of integers'
+        }), 400
+    review_ids = set(review_ids)
+    if len(review_ids) > BULK_MODERATION_MAX_IDS:
+        return jsonify({
+            'error': f'At most {BULK_MODERATION_MAX_IDS} reviews can be moderated at once'
+        }), 400
+
+    if not authenticate_admin(data.get("username"), data.get("password")):
+        return jsonify({"message" : "Unauthorized"}), 403
+
+    moderated = data.get('moderated', True) == True
+    try:
+        updated = Review.query.filter(Review.id.in_(review_ids)).update(
+            {Review.moderated: moderated}, synchronize_session=False
+        )
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({
+            'error': 'Failed to moderate reviews'
+        }), 400
+
+    return jsonify({
+        'moderated': moderated,
+        'requested': len(review_ids),
+        'updated': updated,
+    }), 200
+
+@bp.route('/reviews/rescan', methods=['POST'])
+def rescan_reviews():
+    """
+    Re-score all stored reviews against the moderation term list (admin only).
+
+    Optionally replaces the term list first; it is stored in the database and
+    every worker picks it up within a few seconds. The rescan runs in the
+    background in chunks; its progress, stored in the database too, is
+    available from ``GET /reviews/rescan`` on any worker.
+
+    **Request JSON body**:
+        - username (str): The admin's username (must be "admin").
+        - password (str): The admin's password.
+        - terms (list of str, optional): New term list to compile before rescanning.
+
+    **Response**:
+        - 202 Accepted: Rescan started; body is the job status.
+        - 400 Bad Request: Missing required fields or invalid term list.
+        - 403 Forbidden: Unauthorized or invalid admin credentials.
+        - 409 Conflict: A rescan is already running.
+    """
+    data = request.get_json()
+
+    required_fields = ['username', 'password']
+    if not all(field in data for field in required_fields):
+        return jsonify({
+            'error': 'Missing required fields'
+        }), 400
+
+    terms = data.get('terms')
+    if terms is not None and (not isinstance(terms, list)
+                              or not all(isinstance(term, str) for term in terms)):
+        return jsonify({
+            'error': 'terms must be a list of strings'
+        }), 400
+
+    if not authenticate_admin(data.get("username"), data.get("password")):
+        return jsonify({"message" : "Unauthorized"}), 403
+
+    with rescan_lock:
+        rescan_job = RescanJob(TermMatcher(terms) if terms is not None else get_matcher())
+        if not rescan_job.claim():
+            return jsonify({
+                'error': 'A rescan is already running'
+            }), 409
+        if terms is not None:
+            set_terms(terms)
+        rescan_job.start(current_app._get_current_object())
+    return jsonify(rescan_job.status()), 202
+
+@bp.route('/reviews/rescan', methods=['GET'])
+def get_rescan_status():
+    """
+    Get the progress of the latest moderation rescan.
+
+    **Response**:
+        - 200 OK: Job status (state, terms, scanned, changed, error).
+        - 404 Not Found: No rescan has been started.
+    """
+    status = rescan_status()
+    if status is None:
+        return jsonify({
+            'error': 'No rescan has been started'
+        }), 404
+    return jsonify(status), 200
+
+@bp.route('/reviews/search', methods=['GET'])
+@read_only
+def search_review_comments():
+    """
+    Search review comments.
+
+    This endpoint performs a ranked full-text search over review comments
+    using the inverted index maintained on every review write.
+
+    **Query parameters**:
+        - q (str): The search text.
+        - product_id (int, optional): Only return reviews of this product.
+        - limit (int, optional): Page size, at most 100. Defaults to 20.
+        - offset (int, optional): Number of results to skip. Defaults to 0.
+
+    **Response**:
+        - 200 OK: ``{"query": ..., "total": <int>, "results": [...]}``; each
+          result is a review with an extra ``score`` field, best match first.
+        - 400 Bad Request: Missing query or invalid paging parameters.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({
+            'error': 'Missing search query'
+        }), 400
+    limit = request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if limit is None or not (1 <= limit <= SEARCH_MAX_LIMIT) or offset is None or offset < 0:
+        return jsonify({
+            'error': f'Limit must be between 1 and {SEARCH_MAX_LIMIT} and offset must not be negative'
+        }), 400
+    product_id = request.args.get('product_id', type=int)
+
+    total, results = search_reviews(query, product_id=product_id, limit=limit, offset=offset)
+    return jsonify({
+        'query': query,
+        'total': total,
+        'results': [dict(review.to_dict(), score=score) for review, score in results],
+    }), 200
+
+@bp.route('/downstreams', methods=['GET'])
+def downstream_status():
+    """
+    Report the state of the clients for downstream services.
+
+    **Response**:
+        - 200 OK: Per dependency: call and failure counts, circuit breaker
+          state, trips and rejections, and bulkhead usage.
+    """
+    extensions = current_app.extensions
+    return jsonify({
+        client.name: client.stats()
+        for client in (extensions['customers_client'], extensions['inventory_client'])
+    }), 200
+
+
+def prepare_rating_report(params):
+    """
+    Check the parameters of the ``rating-distribution`` report.
+
+    :raises ValueError: On unknown or invalid parameters.
+    """
+    unknown = set(params) - {'product_id', 'moderated_only'}
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    product_id = params.get('product_id')
+    if product_id is not None and (not isinstance(product_id, int) or isinstance(product_id, bool)):
+        raise ValueError('product_id must be an integer')
+    moderated_only = params.get('moderated_only', False)
+    if not isinstance(moderated_only, bool):
+        raise ValueError('moderated_only must be a boolean')
+    return {'product_id': product_id, 'moderated_only': moderated_only}
+
+REPORTS = {
+    'rating-distribution': Report(
+        reports.rating_distribution,
+        prepare=prepare_rating_report,
+        description='Reviews per rating, overall and per product; optional product_id and moderated_only.',
+    ),
+}
+
+
+@click.command('reindex-reviews')
+@with_appcontext
+@click.option('--chunk-size', default=REINDEX_CHUNK_SIZE, show_default=True, help='Reviews indexed per transaction.')
+def reindex_reviews_command(chunk_size):
+    """Rebuild the review search index from the reviews table."""
+    click.echo(f'Indexed {rebuild_index(chunk_size)} reviews.')
+
+def create_app(config=None):
+    """
+    Create the reviews service app.
+
+    Creating the app does not connect to the database; see :mod:`config` for
+    the settings and :func:`db.init_db` for schema creation.
+
+    :param config: Settings overriding :class:`config.Config`: a mapping, or
+        an object with upper-case attributes such as :class:`config.TestingConfig`.
+    :return: The Flask app.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    init_db(app)
+    app.cli.add_command(reindex_reviews_command)
+    init_jobs(
+        app,
+        create_app,
+        REPORTS,
+        workers=REPORT_WORKERS,
+        max_queued=REPORT_MAX_QUEUED,
+        memory_limit=REPORT_MEMORY_LIMIT,
+        time_limit=REPORT_TIME_LIMIT,
+        cache_ttl=REPORT_CACHE_TTL,
+        cache_size=REPORT_CACHE_SIZE,
+    )
+
+    init_tracing(app, 'reviews')
+    init_resilience(app, default_budget=REQUEST_BUDGET)
+    init_codec(app)
+    init_compression(app, min_size=COMPRESSION_MIN_SIZE)
+
+    # Looked up through current_app by the routes
+    app.extensions['customers_client'] = make_client('customers', app.config['CUSTOMERS_SERVICE_URL'])
+    app.extensions['inventory_client'] = make_client('inventory', app.config['INVENTORY_SERVICE_URL'])
+    app.register_blueprint(bp)
+    return app
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000)
+    create_app().run(host='0.0.0.0', port=5000)
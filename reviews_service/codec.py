@@ -0,0 +1,92 @@
+"""
+Content negotiation between JSON and MessagePack.
+
+JSON stays the default. A client that sends ``Accept: application/msgpack``
+gets every ``jsonify`` response MessagePack-encoded instead, and request
+bodies sent with ``Content-Type: application/msgpack`` are decoded by
+``request.get_json()``, so route handlers don't change. The internal clients
+of the sales and reviews services opt in, because large payloads such as the
+catalog are several times cheaper to encode and decode as MessagePack.
+
+MessagePack is optional: without the ``msgpack`` package everything is JSON.
+
+This module is identical in every service.
+"""
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from flask.wrappers import Request
+from werkzeug.exceptions import BadRequest
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+MSGPACK_MIMETYPE = "application/msgpack"
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, "application/x-msgpack")
+JSON_MIMETYPE = "application/json"
+
+# Accept header sent by internal clients: MessagePack if the server can
+# produce it, JSON otherwise.
+ACCEPT_MSGPACK = f"{MSGPACK_MIMETYPE}, {JSON_MIMETYPE};q=0.9"
+
+
+def wants_msgpack(req):
+    """Whether the request's ``Accept`` header prefers MessagePack over JSON."""
+    if msgpack is None:
+        return False
+    best = req.accept_mimetypes.best_match((JSON_MIMETYPE,) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider whose ``response()`` (used by ``jsonify``) honours ``Accept``.
+    """
+
+    def response(self, *args, **kwargs):
+        if has_request_context() and wants_msgpack(request):
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(
+                msgpack.packb(obj, default=self.default, use_bin_type=True),
+                mimetype=MSGPACK_MIMETYPE,
+            )
+        else:
+            response = super().response(*args, **kwargs)
+        response.vary.add("Accept")
+        return response
+
+
+class NegotiatingRequest(Request):
+    """
+    Request class whose ``get_json()`` also decodes MessagePack bodies.
+    """
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if msgpack is not None and self.mimetype in MSGPACK_MIMETYPES:
+            try:
+                return msgpack.unpackb(self.get_data(cache=cache), raw=False)
+            except (ValueError, msgpack.UnpackException) as e:
+                if silent:
+                    return None
+                raise BadRequest("Failed to decode MessagePack body") from e
+        return super().get_json(force=force, silent=silent, cache=cache)
+
+
+def init_codec(app):
+    """Enable MessagePack negotiation on a Flask app."""
+    app.json = NegotiatingJSONProvider(app)
+    app.request_class = NegotiatingRequest
+
+
+def decode_response(response):
+    """
+    Decode the body of a :class:`requests.Response` according to its content type.
+
+    Use instead of ``response.json()`` for responses to requests that may have
+    negotiated MessagePack.
+    """
+    mimetype = response.headers.get("Content-Type", "").split(";", 1)[0].strip()
+    if mimetype in MSGPACK_MIMETYPES:
+        return msgpack.unpackb(response.content, raw=False)
+    return response.json()
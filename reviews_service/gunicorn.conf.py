@@ -0,0 +1,40 @@
+"""
+Gunicorn settings for running the service in production.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Worker processes and threads per worker come from ``WEB_CONCURRENCY`` and
+``GUNICORN_THREADS``. The app is loaded once in the master (``preload_app``)
+so workers fork with the code already imported. The database engines created
+in the master are then discarded in each worker after the fork, so that no
+two processes share a pooled connection.
+
+Process-local state (caches, replicas, combiners, write-behind journals) is
+per worker; see the services' Readmes for settings that depend on that.
+
+This file is identical in every service.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+preload_app = True
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    from db import db
+
+    app = worker.app.wsgi()
+    with app.app_context():
+        for engine in db.engines.values():
+            # close=False: the connections belong to the master; only drop
+            # this process's references to them.
+            engine.dispose(close=False)
@@ -0,0 +1,33 @@
+"""Add the partial index of the moderation queue
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 09:00:00.000000
+
+Only unmoderated reviews are indexed, in the order the queue is drained.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    indexes = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('reviews')}
+    if 'ix_reviews_unmoderated_created_at' in indexes:
+        return
+    unmoderated = sa.column('moderated') == sa.false()
+    op.create_index(
+        'ix_reviews_unmoderated_created_at', 'reviews', ['created_at', 'id'],
+        postgresql_where=unmoderated,
+        sqlite_where=unmoderated,
+    )
+
+
+def downgrade():
+    op.drop_index('ix_reviews_unmoderated_created_at', table_name='reviews')
@@ -0,0 +1,60 @@
+"""Add automatic flagging of review comments
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 09:00:00.000000
+
+Adds the flag of each review and the tables shared by the workers: the term
+list and the progress of the rescan. Existing reviews start unflagged; they
+are scored by the rescan that follows the next change of the term list.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('reviews')}
+    if 'flagged' not in columns:
+        op.add_column('reviews', sa.Column('flagged', sa.Boolean(), nullable=True))
+        op.execute(sa.table('reviews', sa.column('flagged')).update().values(flagged=False))
+    if 'flag_score' not in columns:
+        op.add_column('reviews', sa.Column('flag_score', sa.Integer(), nullable=True))
+        op.execute(sa.table('reviews', sa.column('flag_score')).update().values(flag_score=0))
+    if not inspector.has_table('moderation_terms'):
+        op.create_table(
+            'moderation_terms',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('terms', sa.Text(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    if not inspector.has_table('moderation_rescans'):
+        op.create_table(
+            'moderation_rescans',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('state', sa.String(length=16), nullable=False),
+            sa.Column('terms', sa.Integer(), nullable=False),
+            sa.Column('scanned', sa.Integer(), nullable=False),
+            sa.Column('changed', sa.Integer(), nullable=False),
+            sa.Column('error', sa.Text(), nullable=True),
+            sa.Column('pid', sa.Integer(), nullable=True),
+            sa.Column('heartbeat', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+        )
+
+
+def downgrade():
+    op.drop_table('moderation_rescans')
+    op.drop_table('moderation_terms')
+    with op.batch_alter_table('reviews') as batch_op:
+        batch_op.drop_column('flag_score')
+        batch_op.drop_column('flagged')
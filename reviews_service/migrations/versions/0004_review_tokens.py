@@ -0,0 +1,40 @@
+"""Add the full-text index of review comments
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 09:00:00.000000
+
+Reviews written from now on are indexed as they are written; run
+``flask --app app reindex-reviews`` once to index the existing ones.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('review_tokens'):
+        return
+    op.create_table(
+        'review_tokens',
+        sa.Column('token', sa.String(length=64), nullable=False),
+        sa.Column('review_id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('frequency', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['review_id'], ['reviews.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('token', 'review_id'),
+    )
+    op.create_index('ix_review_tokens_token_product', 'review_tokens', ['token', 'product_id'])
+    op.create_index('ix_review_tokens_review_id', 'review_tokens', ['review_id'])
+
+
+def downgrade():
+    op.drop_index('ix_review_tokens_review_id', table_name='review_tokens')
+    op.drop_index('ix_review_tokens_token_product', table_name='review_tokens')
+    op.drop_table('review_tokens')
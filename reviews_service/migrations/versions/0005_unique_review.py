@@ -0,0 +1,48 @@
+"""Allow one review per customer and product
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 09:00:00.000000
+
+Reviews submitted twice before the constraint existed are deduplicated
+first: the latest review of each customer and product is kept (the one
+created last, the highest id on ties) and the others are deleted with their
+search index entries.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+# Reviews other than the latest of their customer and product; reviews
+# without a creation time count as the oldest
+DUPLICATE_REVIEWS = """
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY customer_id, product_id
+            ORDER BY CASE WHEN created_at IS NULL THEN 1 ELSE 0 END, created_at DESC, id DESC
+        ) AS position
+        FROM reviews
+    ) ranked
+    WHERE position > 1
+"""
+
+
+def upgrade():
+    constraints = {constraint['name'] for constraint in sa.inspect(op.get_bind()).get_unique_constraints('reviews')}
+    if 'uq_reviews_customer_product' in constraints:
+        return
+    op.execute(f"DELETE FROM review_tokens WHERE review_id IN ({DUPLICATE_REVIEWS})")
+    op.execute(f"DELETE FROM reviews WHERE id IN ({DUPLICATE_REVIEWS})")
+    with op.batch_alter_table('reviews') as batch_op:
+        batch_op.create_unique_constraint('uq_reviews_customer_product', ['customer_id', 'product_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('reviews') as batch_op:
+        batch_op.drop_constraint('uq_reviews_customer_product', type_='unique')
@@ -10,9 +10,25 @@ class Review(db.Model):
     rating = db.Column(db.Float, nullable=False)
     comment = db.Column(db.String(500), nullable=True)
     moderated = db.Column(db.Boolean, default=False)
+    flagged = db.Column(db.Boolean, default=False)
+    flag_score = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        # One review per customer and product; also the conflict target of
+        # the review upsert.
+        db.UniqueConstraint('customer_id', 'product_id', name='uq_reviews_customer_product'),
+        # Partial index backing the moderation work queue: only unmoderated
+        # reviews are indexed, in the order the queue is drained.
+        db.Index(
+            'ix_reviews_unmoderated_created_at',
+            'created_at', 'id',
+            postgresql_where=(moderated == False),
+            sqlite_where=(moderated == False),
+        ),
+    )
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -21,6 +37,49 @@ class Review(db.Model):
             "rating": self.rating,
             "comment": self.comment,
             "moderated": self.moderated,
+            "flagged": self.flagged,
+            "flag_score": self.flag_score,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
-        }
\ No newline at end of file
+        }
+
+class ReviewToken(db.Model):
+    __tablename__ = 'review_tokens'
+
+    # Inverted index over review comments: one row per (token, review) pair.
+    # The primary key doubles as the posting list for each token.
+    token = db.Column(db.String(64), primary_key=True)
+    review_id = db.Column(db.Integer, db.ForeignKey('reviews.id', ondelete='CASCADE'), primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    frequency = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_review_tokens_token_product', 'token', 'product_id'),
+        db.Index('ix_review_tokens_review_id', 'review_id'),
+    )
+
+class ModerationTerms(db.Model):
+    __tablename__ = 'moderation_terms'
+
+    # A single row (id 1) holding the term list shared by all workers. Every
+    # change bumps the version, which workers poll to reload their matcher.
+    id = db.Column(db.Integer, primary_key=True)
+    terms = db.Column(db.Text, nullable=False)  # JSON list of strings
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class ModerationRescan(db.Model):
+    __tablename__ = 'moderation_rescans'
+
+    # A single row (id 1) with the progress of the latest rescan, so that any
+    # worker can report it and only one worker runs a rescan at a time.
+    id = db.Column(db.Integer, primary_key=True)
+    state = db.Column(db.String(16), nullable=False)
+    terms = db.Column(db.Integer, nullable=False, default=0)
+    scanned = db.Column(db.Integer, nullable=False, default=0)
+    changed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    pid = db.Column(db.Integer, nullable=True)
+    # Updated after every chunk; a running rescan without a recent heartbeat
+    # belonged to a worker that died
+    heartbeat = db.Column(db.DateTime, nullable=True)
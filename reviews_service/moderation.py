@@ -0,0 +1,398 @@
+"""
+Automatic flagging of review comments.
+
+The configured term list is compiled into a single Aho-Corasick automaton, so
+a comment is scanned in one pass whose cost depends on the length of the
+comment and not on the number of terms. The automaton is rebuilt only when
+the term list changes; existing reviews are then re-scored by a chunked
+rescan job.
+
+The term list and the rescan progress are stored in the database rather than
+in the worker, so that every gunicorn worker flags with the same terms and
+reports the same rescan.
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from flask import has_app_context
+from sqlalchemy import bindparam, or_, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from db import db
+from models import ModerationRescan, ModerationTerms, Review
+
+logger = logging.getLogger(__name__)
+
+TERMS_FILE = os.environ.get(
+    'MODERATION_TERMS_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'banned_terms.txt'),
+)
+RESCAN_CHUNK_SIZE = 500
+
+
+class TermMatcher:
+    """
+    Multi-pattern matcher over a fixed set of terms (Aho-Corasick).
+
+    Matching is case-insensitive and only whole words count, so ``"scam"``
+    flags ``"what a scam!"`` but not ``"scampi"``.
+
+    :param terms: Iterable of terms; blank entries are ignored.
+    """
+
+    def __init__(self, terms):
+        self.terms = sorted({term.strip().casefold() for term in terms if term and term.strip()})
+        # State 0 is the root. Each state has its transitions, a failure link
+        # and the lengths of all terms ending there (including via failure links).
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for term in self.terms:
+            self._add(term)
+        self._link()
+
+    def _add(self, term):
+        state = 0
+        for char in term:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+        self._out[state] = self._out[state] + (len(term),)
+
+    def _link(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text):
+        """
+        Find every whole-word occurrence of a term in ``text``.
+
+        :param text: The text to scan.
+        :return: List of ``(start, term)`` tuples in order of their end position.
+        :rtype: list
+        """
+        if not text or not self.terms:
+            return []
+        folded = text.casefold()
+        size = len(folded)
+        goto, fail, out = self._goto, self._fail, self._out
+        matches = []
+        state = 0
+        for end, char in enumerate(folded):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length in out[state]:
+                start = end - length + 1
+                if start > 0 and folded[start - 1].isalnum():
+                    continue
+                if end + 1 < size and folded[end + 1].isalnum():
+                    continue
+                matches.append((start, folded[start:end + 1]))
+        return matches
+
+    def score(self, text):
+        """
+        Return the number of term occurrences in ``text``.
+
+        :rtype: int
+        """
+        return len(self.find(text))
+
+
+def load_terms(path=TERMS_FILE):
+    """
+    Read a term list file: one term per line, ``#`` starts a comment.
+
+    A missing file yields an empty term list.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            lines = [line.split('#', 1)[0].strip() for line in f]
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line]
+
+
+TERMS_ROW_ID = 1
+# Seconds a worker keeps using its matcher before checking the term list version
+TERMS_RELOAD_INTERVAL = 5.0
+
+_matcher_lock = threading.Lock()
+_matcher = None
+_matcher_version = None
+_matcher_checked = 0.0
+
+
+def _stored_terms(known_version):
+    """
+    Return ``(version, terms)`` of the stored term list: ``(0, None)`` if
+    none is stored, and ``terms`` None if the version is ``known_version``.
+    Returns None outside an application context.
+    """
+    if not has_app_context():
+        return None
+    with db.session.no_autoflush:
+        version = db.session.scalar(
+            db.select(ModerationTerms.version).where(ModerationTerms.id == TERMS_ROW_ID)
+        ) or 0
+        if not version or version == known_version:
+            return version, None
+        terms = db.session.scalar(
+            db.select(ModerationTerms.terms).where(ModerationTerms.id == TERMS_ROW_ID)
+        )
+    return version, json.loads(terms)
+
+
+def get_matcher():
+    """
+    Return the active matcher.
+
+    The term list is stored in the database, so a change made by one worker
+    reaches the others: each worker checks the stored version at most every
+    :data:`TERMS_RELOAD_INTERVAL` seconds and recompiles its matcher when it
+    changed. Until a term list is stored, the terms come from :data:`TERMS_FILE`.
+    """
+    global _matcher, _matcher_version, _matcher_checked
+    if _matcher is not None and time.monotonic() - _matcher_checked < TERMS_RELOAD_INTERVAL:
+        return _matcher
+    with _matcher_lock:
+        if _matcher is not None and time.monotonic() - _matcher_checked < TERMS_RELOAD_INTERVAL:
+            return _matcher
+        stored = _stored_terms(_matcher_version)
+        if stored is None:
+            # Outside an application context: keep the current matcher
+            if _matcher is None:
+                _matcher = TermMatcher(load_terms())
+        else:
+            version, terms = stored
+            if terms is not None:
+                _matcher = TermMatcher(terms)
+            elif version != _matcher_version or _matcher is None:
+                _matcher = TermMatcher(load_terms())
+            _matcher_version = version
+        _matcher_checked = time.monotonic()
+    return _matcher
+
+
+def set_terms(terms):
+    """
+    Replace the term list of all workers. Must be called in an application
+    context; commits the session.
+
+    :param terms: The new list of terms.
+    :return: The newly compiled matcher.
+    :rtype: TermMatcher
+    """
+    global _matcher, _matcher_version, _matcher_checked
+    matcher = TermMatcher(terms)
+    row = db.session.get(ModerationTerms, TERMS_ROW_ID, with_for_update=True)
+    if row is None:
+        row = ModerationTerms(id=TERMS_ROW_ID, version=0)
+        db.session.add(row)
+    row.terms = json.dumps(matcher.terms)
+    row.version += 1
+    try:
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    with _matcher_lock:
+        _matcher, _matcher_version, _matcher_checked = matcher, row.version, time.monotonic()
+    return matcher
+
+
+def apply_moderation(review, matcher=None):
+    """
+    Score a review's comment and set its ``flag_score`` and ``flagged`` fields.
+
+    :param review: The :class:`Review` to update (not committed).
+    :param matcher: Matcher to use; defaults to the active one.
+    """
+    score = (matcher or get_matcher()).score(review.comment)
+    review.flag_score = score
+    review.flagged = score > 0
+
+
+RESCAN_ROW_ID = 1
+# A running rescan whose heartbeat is older than this belonged to a dead worker
+RESCAN_STALE_AFTER = 60.0
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+
+def rescan_status():
+    """
+    Return the progress of the latest rescan as a dict, or None if there
+    was none. A rescan whose worker stopped sending heartbeats is reported
+    as failed.
+    """
+    row = db.session.get(ModerationRescan, RESCAN_ROW_ID, populate_existing=True)
+    if row is None:
+        return None
+    status = {
+        'state': row.state,
+        'terms': row.terms,
+        'scanned': row.scanned,
+        'changed': row.changed,
+        'error': row.error,
+    }
+    if row.state in ('pending', 'running') and _is_stale(row.heartbeat):
+        status.update(state='failed', error='The worker running the rescan exited')
+    return status
+
+
+def _is_stale(heartbeat):
+    return heartbeat is None or (_utcnow() - heartbeat).total_seconds() > RESCAN_STALE_AFTER
+
+
+class RescanJob:
+    """
+    Re-score every stored review against a matcher, in chunks.
+
+    Reviews are walked in primary-key order using keyset pagination, and only
+    reviews whose score changed are written back, one transaction per chunk.
+    A score is only written while the comment is still the one it was computed
+    from: a review edited in the meantime keeps the score its edit gave it.
+    The progress is stored in ``moderation_rescans`` after every chunk, so
+    :func:`rescan_status` answers in any worker, and :meth:`claim` lets only
+    one rescan run at a time across workers.
+    """
+
+    def __init__(self, matcher, chunk_size=RESCAN_CHUNK_SIZE):
+        self.matcher = matcher
+        self.chunk_size = chunk_size
+        self.state = 'pending'
+        self.scanned = 0
+        self.changed = 0
+        self.error = None
+
+    def claim(self):
+        """
+        Record this job as the running rescan, unless another rescan is
+        still running. Must be called in an application context.
+
+        :return: True if the job may start.
+        """
+        values = dict(state='pending', terms=len(self.matcher.terms), scanned=0, changed=0,
+                      error=None, pid=os.getpid(), heartbeat=_utcnow())
+        stale_before = _utcnow() - datetime.timedelta(seconds=RESCAN_STALE_AFTER)
+        try:
+            claimed = db.session.execute(
+                db.update(ModerationRescan)
+                .where(
+                    ModerationRescan.id == RESCAN_ROW_ID,
+                    or_(ModerationRescan.state.notin_(('pending', 'running')),
+                        ModerationRescan.heartbeat < stale_before),
+                )
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not claimed and db.session.get(ModerationRescan, RESCAN_ROW_ID) is None:
+                db.session.add(ModerationRescan(id=RESCAN_ROW_ID, **values))
+                claimed = 1
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created the row first, and with it the rescan
+            db.session.rollback()
+            return False
+        return bool(claimed)
+
+    def _save(self):
+        db.session.execute(
+            db.update(ModerationRescan)
+            .where(ModerationRescan.id == RESCAN_ROW_ID, ModerationRescan.pid == os.getpid())
+            .values(state=self.state, scanned=self.scanned, changed=self.changed,
+                    error=self.error, heartbeat=_utcnow())
+            .execution_options(synchronize_session=False)
+        )
+
+    def run(self):
+        """Run the rescan; must be called inside an application context."""
+        self.state = 'running'
+        last_id = 0
+        try:
+            self._save()
+            db.session.commit()
+            while True:
+                rows = db.session.execute(
+                    db.select(Review.id, Review.comment, Review.flag_score)
+                    .where(Review.id > last_id)
+                    .order_by(Review.id)
+                    .limit(self.chunk_size)
+                ).all()
+                if not rows:
+                    break
+                changes = []
+                for review_id, comment, old_score in rows:
+                    score = self.matcher.score(comment)
+                    if score != old_score:
+                        changes.append({'review_id': review_id, 'scanned_comment': comment,
+                                        'score': score, 'is_flagged': score > 0})
+                if changes:
+                    reviews = Review.__table__
+                    db.session.execute(
+                        update(reviews)
+                        .where(reviews.c.id == bindparam('review_id'),
+                               reviews.c.comment.is_not_distinct_from(bindparam('scanned_comment')))
+                        .values(flag_score=bindparam('score'), flagged=bindparam('is_flagged')),
+                        changes,
+                    )
+                self.scanned += len(rows)
+                self.changed += len(changes)
+                self._save()
+                db.session.commit()
+                last_id = rows[-1][0]
+            self.state = 'finished'
+            self._save()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.state = 'failed'
+            self.error = str(e)
+            try:
+                self._save()
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+                logger.warning("Could not record the failed rescan: %s", e)
+
+    def start(self, app):
+        """Run the job on a background thread with its own application context."""
+        def target():
+            with app.app_context():
+                self.run()
+
+        thread = threading.Thread(target=target, name='review-rescan', daemon=True)
+        thread.start()
+        return thread
+
+    def status(self):
+        return {
+            'state': self.state,
+            'terms': len(self.matcher.terms),
+            'scanned': self.scanned,
+            'changed': self.changed,
+            'error': self.error,
+        }
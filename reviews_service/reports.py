@@ -0,0 +1,49 @@
+"""
+Reports of the reviews service, run as jobs by :mod:`jobs`.
+
+Each report runs in its own process, in an application context of an app
+built with the service's settings.
+"""
+from db import db
+from models import Review
+
+
+def rating_distribution(product_id=None, moderated_only=False):
+    """
+    Count the reviews per rating, overall and per product.
+
+    :param product_id: Only count the reviews of this product.
+    :param moderated_only: Only count moderated reviews.
+    :return: ``{reviews, average, histogram, products}``: the histogram has
+        one ``{rating, reviews}`` entry per rating given, and ``products``
+        one ``{product_id, reviews, average}`` entry per product, most
+        reviewed first.
+    """
+    criteria = []
+    if product_id is not None:
+        criteria.append(Review.product_id == product_id)
+    if moderated_only:
+        criteria.append(Review.moderated == True)
+
+    histogram = db.session.execute(
+        db.select(Review.rating, db.func.count())
+        .where(*criteria)
+        .group_by(Review.rating)
+        .order_by(Review.rating)
+    ).all()
+    products = db.session.execute(
+        db.select(Review.product_id, db.func.count(), db.func.avg(Review.rating))
+        .where(*criteria)
+        .group_by(Review.product_id)
+        .order_by(db.func.count().desc(), Review.product_id)
+    ).all()
+    total = sum(count for _, count in histogram)
+    return {
+        'reviews': total,
+        'average': round(sum(rating * count for rating, count in histogram) / total, 3) if total else None,
+        'histogram': [{'rating': rating, 'reviews': count} for rating, count in histogram],
+        'products': [
+            {'product_id': product, 'reviews': count, 'average': round(average, 3)}
+            for product, count, average in products
+        ],
+    }
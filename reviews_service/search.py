@@ -0,0 +1,162 @@
+"""
+Full-text search over review comments.
+
+Comments are tokenized into an inverted index (:class:`ReviewToken`) that is
+kept up to date in the same transaction as every review insert, edit and
+delete. Queries read only the posting lists of the query terms and rank the
+matching reviews by TF-IDF inside the database, so the index works the same on
+PostgreSQL and on SQLite.
+"""
+import math
+import re
+from collections import Counter
+
+from sqlalchemy import case, delete, func, insert, select
+
+from db import db
+from models import Review, ReviewToken
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+MAX_TOKEN_LENGTH = 64
+REINDEX_CHUNK_SIZE = 500
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have i in is it its my of on or so
+that the this to was were will with
+""".split())
+
+
+def tokenize(text):
+    """
+    Split text into normalized search tokens.
+
+    Tokens are case-folded words; stopwords and over-long tokens are dropped.
+
+    :param text: The text to tokenize (may be None).
+    :return: List of tokens, in order of appearance.
+    :rtype: list
+    """
+    if not text:
+        return []
+    return [
+        token for token in TOKEN_PATTERN.findall(text.casefold())
+        if token not in STOPWORDS and len(token) <= MAX_TOKEN_LENGTH
+    ]
+
+
+def index_review(review):
+    """
+    (Re)build the index entries of a single review.
+
+    Must run in the same session as the review change; the review is flushed
+    first so that a new review has an ID.
+
+    :param review: The :class:`Review` to index.
+    """
+    if review.id is None:
+        db.session.flush()
+    unindex_review(review.id)
+    counts = Counter(tokenize(review.comment))
+    if counts:
+        db.session.execute(insert(ReviewToken), [
+            {
+                'token': token,
+                'review_id': review.id,
+                'product_id': review.product_id,
+                'frequency': frequency,
+            }
+            for token, frequency in counts.items()
+        ])
+
+
+def unindex_review(review_id):
+    """
+    Remove a review from the index.
+
+    :param review_id: The ID of the review.
+    """
+    db.session.execute(delete(ReviewToken).where(ReviewToken.review_id == review_id))
+
+
+def search_reviews(query, product_id=None, limit=20, offset=0):
+    """
+    Search review comments.
+
+    A review matches if its comment contains any query term. Results are
+    ranked by the sum over matched terms of ``frequency * idf``, where
+    ``idf = log(1 + N / df)``, so rarer terms and reviews matching more terms
+    rank higher. ``N`` and ``df`` count the reviews searched: those of the
+    product if one is given, all reviews otherwise.
+
+    :param query: The free-text query.
+    :param product_id: Restrict results to one product, if given.
+    :param limit: Maximum number of results.
+    :param offset: Number of ranked results to skip.
+    :return: ``(total, [(review, score), ...])``.
+    :rtype: tuple
+    """
+    tokens = sorted(set(tokenize(query)))
+    if not tokens:
+        return 0, []
+
+    filters = [ReviewToken.token.in_(tokens)]
+    documents = select(func.count()).select_from(Review)
+    if product_id is not None:
+        filters.append(ReviewToken.product_id == product_id)
+        documents = documents.where(Review.product_id == product_id)
+
+    document_count = db.session.scalar(documents) or 1
+    frequencies = dict(db.session.execute(
+        select(ReviewToken.token, func.count())
+        .where(*filters)
+        .group_by(ReviewToken.token)
+    ).all())
+    if not frequencies:
+        return 0, []
+    weights = {
+        token: math.log(1 + document_count / df) for token, df in frequencies.items()
+    }
+
+    total = db.session.scalar(
+        select(func.count(func.distinct(ReviewToken.review_id))).where(*filters)
+    )
+    score = func.sum(ReviewToken.frequency * case(weights, value=ReviewToken.token, else_=0)).label('score')
+    ranked = db.session.execute(
+        select(ReviewToken.review_id, score)
+        .where(*filters)
+        .group_by(ReviewToken.review_id)
+        .order_by(score.desc(), ReviewToken.review_id)
+        .limit(limit)
+        .offset(offset)
+    ).all()
+
+    reviews = {
+        review.id: review
+        for review in Review.query.filter(Review.id.in_([review_id for review_id, _ in ranked]))
+    }
+    return total, [
+        (reviews[review_id], float(score)) for review_id, score in ranked if review_id in reviews
+    ]
+
+
+def rebuild_index(chunk_size=REINDEX_CHUNK_SIZE):
+    """
+    Rebuild the whole index from the ``reviews`` table, one chunk per transaction.
+
+    Only needed to backfill reviews written before the index existed; normal
+    writes keep the index up to date incrementally.
+
+    :return: The number of reviews indexed.
+    :rtype: int
+    """
+    indexed = 0
+    last_id = 0
+    while True:
+        reviews = (Review.query.filter(Review.id > last_id)
+                   .order_by(Review.id).limit(chunk_size).all())
+        if not reviews:
+            return indexed
+        for review in reviews:
+            index_review(review)
+        db.session.commit()
+        indexed += len(reviews)
+        last_id = reviews[-1].id
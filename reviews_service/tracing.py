@@ -0,0 +1,303 @@
+"""
+Distributed request tracing.
+
+Trace context travels between services in the W3C ``traceparent`` header
+(``00-<trace id>-<parent span id>-<flags>``). :func:`init_tracing` makes a
+Flask app record one server span per request, continuing the caller's trace
+when the header is present, and one span per SQL statement. Outbound calls
+made through :class:`resilience.Downstream` record client spans and forward
+the header. Spans are only recorded inside a sampled request; calls made
+outside one (e.g. by background threads) send an unsampled ``traceparent``, so
+they are not traced downstream either.
+
+Finished spans go to an exporter: :class:`InMemoryExporter` (queried through
+``GET /traces/<trace_id>``) or :class:`FileExporter` (one JSON object per
+line). ``benchmarks/trace_critical_path.py`` reads either and prints the critical
+path of a trace. Unless given to :func:`init_tracing`, the exporter and the
+sample rate come from the app's ``TRACE_FILE`` and ``TRACE_SAMPLE_RATE``
+settings. The sample rate defaults to 0: a service then only records the
+traces its callers sampled, and does not serve ``GET /traces/<trace_id>``,
+since spans carry request paths and SQL statements.
+
+This module is identical in every service.
+"""
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed operation within a trace.
+    """
+
+    def __init__(self, tracer, name, kind, trace_id, parent_id, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        """Header value that makes a downstream span a child of this one."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.time()
+            self.tracer.exporter.export(self.to_dict())
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": self.tracer.service,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": (self.end - self.start) * 1000,
+            "attributes": self.attributes,
+        }
+
+
+class InMemoryExporter:
+    """
+    Keeps the spans of the most recent ``max_traces`` traces in memory.
+
+    A trace keeps its first ``max_spans_per_trace`` spans; later ones (e.g.
+    the statements of a request issuing thousands of queries) are only
+    counted in ``dropped_spans``.
+    """
+
+    def __init__(self, max_traces=1000, max_spans_per_trace=100):
+        self.max_traces = max_traces
+        self.max_spans_per_trace = max_spans_per_trace
+        self._lock = threading.Lock()
+        self._traces = OrderedDict()
+        self.dropped_spans = 0
+
+    def export(self, span):
+        with self._lock:
+            spans = self._traces.get(span["trace_id"])
+            if spans is None:
+                spans = self._traces[span["trace_id"]] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            if len(spans) >= self.max_spans_per_trace:
+                self.dropped_spans += 1
+                return
+            spans.append(span)
+
+    def get_trace(self, trace_id):
+        with self._lock:
+            return list(self._traces.get(trace_id, ()))
+
+    def trace_ids(self):
+        with self._lock:
+            return list(self._traces)
+
+
+class FileExporter:
+    """
+    Appends spans to a file, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+class Tracer:
+    """
+    Creates spans for one service.
+
+    :param service: Service name recorded on every span.
+    :param exporter: Where finished spans go.
+    :param sample_rate: Fraction of new traces (requests without an incoming
+        ``traceparent``) that are recorded.
+    """
+
+    def __init__(self, service, exporter, sample_rate=0.0):
+        self.service = service
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_server_span(self, name, traceparent=None, attributes=None):
+        """
+        Start the root span of a request; returns None if it is not sampled.
+        """
+        match = TRACEPARENT_PATTERN.match(traceparent or "")
+        if match:
+            trace_id, parent_id, flags = match.groups()
+            if not int(flags, 16) & 1:
+                return None
+        else:
+            if random.random() >= self.sample_rate:
+                return None
+            trace_id, parent_id = os.urandom(16).hex(), None
+        return Span(self, name, "server", trace_id, parent_id, attributes)
+
+
+def unsampled_traceparent():
+    """Header value asking downstream services not to record the call."""
+    return f"00-{os.urandom(16).hex()}-{os.urandom(8).hex()}-00"
+
+
+def current_span():
+    """Return the active span of this thread/context, or None."""
+    return _current_span.get()
+
+
+@contextmanager
+def start_span(name, kind="internal", attributes=None):
+    """
+    Record a child span of the active span for the duration of the block.
+
+    Yields None, and records nothing, when there is no active span.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = Span(parent.tracer, name, kind, parent.trace_id, parent.span_id, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_attribute("error", repr(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        span.finish()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = _current_span.get()
+    if parent is None:
+        return
+    span = Span(parent.tracer, "db.query", "db", parent.trace_id, parent.span_id, {
+        "db.statement": statement,
+        "db.executemany": executemany,
+    })
+    conn.info.setdefault("trace_spans", []).append(span)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("trace_spans")
+    if spans:
+        span = spans.pop()
+        span.set_attribute("db.rowcount", cursor.rowcount)
+        span.finish()
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    spans = conn.info.get("trace_spans") if conn is not None else None
+    if spans:
+        span = spans.pop()
+        span.set_attribute("error", repr(exception_context.original_exception))
+        span.finish()
+
+
+def init_tracing(app, service, exporter=None, sample_rate=None):
+    """
+    Trace the requests and SQL statements of a Flask app.
+
+    :param service: Name of the service, recorded on every span.
+    :param exporter: Span exporter; defaults to a :class:`FileExporter` if
+        the ``TRACE_FILE`` setting is set, else to an :class:`InMemoryExporter`.
+    :param sample_rate: Fraction of new traces to record; defaults to the
+        ``TRACE_SAMPLE_RATE`` setting, or 0.
+    :return: The :class:`Tracer`.
+
+    ``GET /traces/<trace_id>`` serves the spans of an :class:`InMemoryExporter`
+    only when tracing is enabled with a sample rate above 0.
+    """
+    if exporter is None:
+        trace_file = app.config.get("TRACE_FILE")
+        exporter = FileExporter(trace_file) if trace_file else InMemoryExporter()
+    if sample_rate is None:
+        sample_rate = app.config.get("TRACE_SAMPLE_RATE", 0.0)
+    tracer = Tracer(service, exporter, sample_rate)
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+    @app.before_request
+    def start_request_span():
+        rule = request.url_rule.rule if request.url_rule else request.path
+        span = tracer.start_server_span(
+            f"{request.method} {rule}",
+            request.headers.get(TRACEPARENT_HEADER),
+            {"http.method": request.method, "http.target": request.full_path.rstrip("?")},
+        )
+        if span is not None:
+            g.trace_span = span
+            g.trace_token = _current_span.set(span)
+
+    @app.after_request
+    def record_response(response):
+        span = g.get("trace_span")
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            response.headers[TRACEPARENT_HEADER] = span.traceparent()
+        return response
+
+    @app.teardown_request
+    def finish_request_span(exc):
+        span = g.pop("trace_span", None)
+        if span is None:
+            return
+        if exc is not None:
+            span.set_attribute("error", repr(exc))
+        _current_span.reset(g.pop("trace_token"))
+        span.finish()
+
+    if isinstance(exporter, InMemoryExporter) and sample_rate > 0:
+        @app.route("/traces/<trace_id>", methods=["GET"])
+        def get_trace(trace_id):
+            """
+            Get the spans this service recorded for a trace.
+
+            **Responses:**
+                - 200: List of spans.
+                - 404: No spans recorded for the trace.
+            """
+            spans = exporter.get_trace(trace_id)
+            if not spans:
+                return jsonify({"error": "Trace not found"}), 404
+            return jsonify(spans), 200
+
+    return tracer
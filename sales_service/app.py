@@ -1,11 +1,39 @@
-from flask import Flask, request, jsonify
-import requests
+from flask import Blueprint, Flask, current_app, request, jsonify, make_response
+from flask.cli import with_appcontext
 from models import Sale
 from db import db, init_db
+from dbrouting import read_only
+from config import Config
+from replica import CatalogReplica
+from codec import ACCEPT_MSGPACK, decode_response, init_codec
+from compression import ACCEPT_ENCODING, init_compression
+from resilience import (
+    Bulkhead,
+    BulkheadFullError,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    Downstream,
+    DownstreamUnavailable,
+    init_resilience,
+)
+from swr_cache import StaleWhileRevalidateCache
+from sale_writer import SaleWriter
+from archive import ROLLUP_KEYS, ArchiveNotPersistent, SaleArchive, sales_history, sales_rollup
+from recommendations import CoPurchaseIndex
+from jobs import Report, init_jobs
+import compensation
+from compensation import Compensator, RefundFailed
+import reports
+from tracing import init_tracing, start_span
+import click
 import cProfile
+import datetime
 import pstats
 import io
 import os
+import time
+import uuid
 from functools import wraps
 from memory_profiler import profile
 
@@ -50,10 +78,12 @@ def profile_route(func):
         pr = cProfile.Profile()
         pr.enable()
 
-        # Call the actual route handler
-        response = func(*args, **kwargs)
-
-        pr.disable()
+        # Call the actual route handler; errors handled by the app (e.g.
+        # unavailable downstream services) still have to stop the profiler
+        try:
+            response = func(*args, **kwargs)
+        finally:
+            pr.disable()
 
         # Prepare the profiling data
         s = io.StringIO()
@@ -77,16 +107,169 @@ def profile_route(func):
     return wrapper
 
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql://user:password@db/sales_db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-init_db(app)
+REQUEST_BUDGET = 10.0
+DOWNSTREAM_TIMEOUT = 5.0
+DOWNSTREAM_MAX_CONCURRENT = 20
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+COMPRESSION_MIN_SIZE = 1024
+DOWNSTREAM_HEADERS = {
+    "Accept": ACCEPT_MSGPACK,
+    "Accept-Encoding": ACCEPT_ENCODING,
+}
+
+CATALOG_POLL_INTERVAL = 1.0
+CATALOG_MAX_STALENESS = 10.0
+
+INVENTORY_CACHE_SOFT_TTL = 5.0
+INVENTORY_CACHE_HARD_TTL = 300.0
+
+# Attempts of a wallet deduction that got no answer, under the same operation id
+SALE_DEDUCT_ATTEMPTS = 3
+COMPENSATION_INTERVAL = 10.0
+COMPENSATION_GRACE = 60.0
+
+SALE_WRITE_BATCH_SIZE = 500
+SALE_WRITE_FLUSH_INTERVAL = 0.5
+
+SALES_HISTORY_DEFAULT_LIMIT = 50
+SALES_HISTORY_MAX_LIMIT = 500
+
+SALES_ARCHIVE_BATCH_SIZE = 10000
+SALES_ARCHIVE_CACHED_COLUMNS = 64
+
+RECOMMENDATIONS_REFRESH_INTERVAL = 30.0
+RECOMMENDATIONS_TOP_K = 50
+RELATED_DEFAULT_LIMIT = 10
+
+REPORT_WORKERS = 2
+REPORT_MAX_QUEUED = 16
+REPORT_MEMORY_LIMIT = 1024 * 1024 * 1024
+REPORT_TIME_LIMIT = 120.0
+REPORT_CACHE_TTL = 300.0
+REPORT_CACHE_SIZE = 100
+
+
+def make_client(name, base_url):
+    """Create the guarded client for a downstream service."""
+    return Downstream(
+        name,
+        base_url,
+        timeout=DOWNSTREAM_TIMEOUT,
+        breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT),
+        bulkhead=Bulkhead(DOWNSTREAM_MAX_CONCURRENT),
+        coalesce_gets=True,
+        headers=DOWNSTREAM_HEADERS,
+    )
+
 
-CUSTOMERS_SERVICE_URL = "http://customers_service:5000"
-INVENTORY_SERVICE_URL = "http://inventory_service:5000"
+# Fallback for catalog reads while the replica is not fresh
+inventory_cache = StaleWhileRevalidateCache(
+    soft_ttl=INVENTORY_CACHE_SOFT_TTL,
+    hard_ttl=INVENTORY_CACHE_HARD_TTL,
+)
 
+bp = Blueprint("sales", __name__)
 
-@app.route("/goods", methods=["GET"])
+
+class InventoryUnavailable(Exception):
+    """The inventory service answered with an unexpected status."""
+
+
+def load_inventory(client, path):
+    """
+    Read a catalog resource from the inventory service for the cache.
+
+    ``200`` and ``404`` answers are both cacheable results; anything else is
+    treated as a failure so that a cached copy keeps being served instead.
+
+    :param client: The app's inventory client; the cache may call the loader
+        on a background thread, outside the application context.
+    :param path: Path on the inventory service, e.g. ``/inventory``.
+    :return: ``(status_code, body)``.
+    :raises InventoryUnavailable: On any other status code.
+    :raises DownstreamUnavailable: If the service cannot be reached.
+    """
+    response = client.get(path)
+    if response.status_code in (200, 404):
+        return response.status_code, decode_response(response)
+    raise InventoryUnavailable(f"GET {path} returned {response.status_code}")
+
+
+def cached_inventory(path):
+    """
+    Read a catalog resource through the stale-while-revalidate cache.
+
+    :return: A :class:`swr_cache.CachedValue` whose value is ``(status_code, body)``.
+    """
+    client = current_app.extensions["inventory_client"]
+    return inventory_cache.get(path, lambda: load_inventory(client, path))
+
+
+def cached_response(body, status, cached):
+    """
+    Build a response from cached data, with ``Age`` and, if stale, ``Warning`` headers.
+    """
+    response = make_response(jsonify(body), status)
+    response.headers["Age"] = str(int(cached.age))
+    if cached.stale:
+        response.headers["Warning"] = '110 - "Response is Stale"'
+    return response
+
+
+@bp.before_app_request
+def start_background_workers():
+    # Started lazily so that each worker process runs its own tailer, sale
+    # writer and recommendation index
+    extensions = current_app.extensions
+    extensions["catalog"].start()
+    extensions["co_purchases"].start()
+    extensions["compensator"].start()
+    if extensions["sale_writer"] is not None:
+        extensions["sale_writer"].start()
+
+
+def fetch_product_by_name(product_name):
+    """
+    Look up a product by name for a sale.
+
+    The name is resolved against the local catalog replica when it is fresh,
+    and only the matching product is then read from the inventory service so
+    that stock and price are current. Without a fresh replica the whole
+    catalog is fetched from the inventory service instead.
+
+    :param product_name: The product name (case-insensitive).
+    :return: ``(product, error)`` where ``error`` is a ``(message, status)``
+        tuple if the lookup failed.
+    :rtype: tuple
+    """
+    catalog = current_app.extensions["catalog"]
+    inventory_client = current_app.extensions["inventory_client"]
+    if catalog.is_fresh():
+        replica_product = catalog.find_by_name(product_name)
+        if not replica_product:
+            return None, ("Product not found", 404)
+        product_response = inventory_client.get(f"/inventory/{replica_product['id']}")
+        if product_response.status_code == 404:
+            return None, ("Product not found", 404)
+        if product_response.status_code != 200:
+            return None, ("Failed to fetch products from inventory", 500)
+        return decode_response(product_response), None
+
+    product_response = inventory_client.get("/inventory")
+    if product_response.status_code != 200:
+        return None, ("Failed to fetch products from inventory", 500)
+
+    products = decode_response(product_response)
+    product = next(
+        (p for p in products if p["name"].lower() == product_name.lower()), None
+    )
+    if not product:
+        return None, ("Product not found", 404)
+    return product, None
+
+
+@bp.route("/goods", methods=["GET"])
 @profile_route
 @memory_profile_route
 def display_goods():
@@ -97,6 +280,12 @@ def display_goods():
 
     **Method:** ``GET``
 
+    Goods are served from the local catalog replica while it is fresh.
+    Otherwise they come from a stale-while-revalidate cache of the inventory
+    service's answer: a copy older than the soft TTL is refreshed in the
+    background, and while the inventory service is down a copy is still served
+    up to the hard TTL, with a ``Warning: 110`` header marking it stale.
+
     **Responses:**
         - 200: A list of all goods with their names and prices.
         - 500: Unable to fetch goods.
@@ -104,18 +293,30 @@ def display_goods():
     :return: JSON response with a list of goods or error message and status code.
     :rtype: tuple
     """
-    response = requests.get(f"{INVENTORY_SERVICE_URL}/inventory")
-    if response.status_code == 200:
-        products = response.json()
+    catalog = current_app.extensions["catalog"]
+    if catalog.is_fresh():
+        products = catalog.all_products()
         goods = [
             {"name": product["name"], "price": product["price_per_item"]}
             for product in products
         ]
         return jsonify(goods), 200
+
+    try:
+        cached = cached_inventory("/inventory")
+    except (DownstreamUnavailable, InventoryUnavailable):
+        return jsonify({"error": "Unable to fetch goods"}), 500
+    status, products = cached.value
+    if status == 200:
+        goods = [
+            {"name": product["name"], "price": product["price_per_item"]}
+            for product in products
+        ]
+        return cached_response(goods, 200, cached)
     return jsonify({"error": "Unable to fetch goods"}), 500
 
 
-@app.route("/goods/<int:product_id>", methods=["GET"])
+@bp.route("/goods/<int:product_id>", methods=["GET"])
 @profile_route
 @memory_profile_route
 def get_goods_details(product_id):
@@ -129,6 +330,10 @@ def get_goods_details(product_id):
     **URL Parameters:**
         - `product_id` (int): The ID of the product.
 
+    Details are served from the local catalog replica while it is fresh, and
+    from the stale-while-revalidate inventory cache otherwise (see
+    :func:`display_goods`).
+
     **Responses:**
         - 200: Product details.
         - 404: Product not found.
@@ -138,13 +343,104 @@ def get_goods_details(product_id):
     :return: JSON response with product details or error message and status code.
     :rtype: tuple
     """
-    response = requests.get(f"{INVENTORY_SERVICE_URL}/inventory/{product_id}")
-    if response.status_code == 200:
-        return jsonify(response.json()), 200
-    return jsonify({"error": "Product was not found"}), 404
+    catalog = current_app.extensions["catalog"]
+    if catalog.is_fresh():
+        product = catalog.get(product_id)
+        if product:
+            return jsonify(product), 200
+        return jsonify({"error": "Product was not found"}), 404
 
+    try:
+        cached = cached_inventory(f"/inventory/{product_id}")
+    except (DownstreamUnavailable, InventoryUnavailable):
+        return jsonify({"error": "Product was not found"}), 404
+    status, product = cached.value
+    if status == 200:
+        return cached_response(product, 200, cached)
+    return cached_response({"error": "Product was not found"}, 404, cached)
 
-@app.route("/sale", methods=["POST"])
+
+@bp.route("/goods/<int:product_id>/related", methods=["GET"])
+def get_related_goods(product_id):
+    """
+    Get the products most often bought by the customers who bought a product.
+
+    Served from an in-memory index that each worker refreshes every 30
+    seconds, so recent sales take that long to count.
+
+    **Endpoint:** ``/goods/<product_id>/related``
+
+    **Method:** ``GET``
+
+    **Query Parameters:**
+        - `limit` (int, optional): Maximum number of products to return
+          (default 10, max 50).
+
+    **Responses:**
+        - 200: The related product IDs with the number of customers who
+          bought both, most customers first.
+        - 400: Invalid limit.
+        - 503: The index is still being built.
+
+    :return: JSON response with the related products and status code.
+    :rtype: tuple
+    """
+    limit = request.args.get("limit", RELATED_DEFAULT_LIMIT, type=int)
+    if limit is None or not (1 <= limit <= RECOMMENDATIONS_TOP_K):
+        return jsonify({"error": "Invalid limit"}), 400
+    co_purchases = current_app.extensions["co_purchases"]
+    if not co_purchases.ready:
+        return jsonify({"error": "Recommendations are not available yet"}), 503
+    return jsonify({
+        "product_id": product_id,
+        "related": [
+            {"product_id": related_id, "customers": customers}
+            for related_id, customers in co_purchases.related(product_id, limit)
+        ],
+    }), 200
+
+
+def deduct_for_sale(username, amount, sale_uid):
+    """
+    Deduct the price of a sale from the customer's wallet.
+
+    A deduction that got no answer (or a 5xx) may still have been applied,
+    so it is retried under the same operation id ``sale-<uid>``, which the
+    customer service applies at most once. The retries get their own
+    deadline, like refunds. If no attempt gets an answer, the sale is
+    recorded as a compensation for :class:`compensation.Compensator` to
+    settle once the outcome is known.
+
+    :return: The answer of the customer service.
+    :raises DownstreamUnavailable: If no attempt got an answer below 500.
+    """
+    customers_client = current_app.extensions["customers_client"]
+    sent = False
+    for attempt in range(SALE_DEDUCT_ATTEMPTS):
+        try:
+            response = customers_client.post(
+                f"/customers/{username}/deduct",
+                json={"amount": amount, "operation_id": f"sale-{sale_uid}"},
+                deadline=None if attempt == 0 else time.time() + DOWNSTREAM_TIMEOUT,
+            )
+        except (BulkheadFullError, CircuitOpenError, DeadlineExceeded) as e:
+            # Rejected before being sent
+            error = e
+        except DownstreamUnavailable as e:
+            sent, error = True, e
+        else:
+            if response.status_code < 500 or attempt == SALE_DEDUCT_ATTEMPTS - 1:
+                if response.status_code >= 500:
+                    compensation.owe(sale_uid, username, amount, compensation.DEDUCT,
+                                     f"Deduction answered {response.status_code}")
+                return response
+            sent, error = True, None
+    if sent:
+        compensation.owe(sale_uid, username, amount, compensation.DEDUCT, error)
+    raise error
+
+
+@bp.route("/sale", methods=["POST"])
 @profile_route
 @memory_profile_route
 def make_sale():
@@ -167,41 +463,47 @@ def make_sale():
         - 400: Insufficient stock or funds.
         - 404: Customer or product not found.
         - 500: Failed to update customer wallet or product stock.
+        - 503: A downstream service is unavailable (circuit open, too many
+          concurrent calls, or no response).
+        - 504: The request deadline passed.
 
     **Process:**
-        - Fetch product details from the inventory service.
+        - Resolve the product by name (from the catalog replica when fresh) and
+          fetch its current details from the inventory service.
         - Fetch customer details from the customer service.
         - Check if the product is in stock and if the customer has sufficient funds.
-        - Deduct the total price from the customer's wallet.
-        - Update the product stock in the inventory.
-        - Create a sale record in the database.
+        - Deduct the total price from the customer's wallet, under the
+          operation id ``sale-<uid>`` (``refund-<uid>`` for a refund), where
+          ``uid`` is also stored on the sale. Unanswered deductions are
+          retried; see :func:`deduct_for_sale`.
+        - Decrement the product stock in the inventory, refunding the customer
+          if the stock ran out in the meantime. A refund that fails is
+          recorded for the compensator to send again.
+        - Create a sale record in the database, or journal it for a bulk
+          insert when write-behind is enabled.
 
     :return: JSON response with a message and status code.
     :rtype: tuple
     """
+    customers_client = current_app.extensions["customers_client"]
+    inventory_client = current_app.extensions["inventory_client"]
+    sale_writer = current_app.extensions["sale_writer"]
     try:
         data = request.json
         product_name = data.get("product_name")
         username = data.get("username")
         quantity = data.get("quantity", 1)
 
-        product_response = requests.get(f"{INVENTORY_SERVICE_URL}/inventory")
-        if product_response.status_code != 200:
-            return jsonify({"error": "Failed to fetch products from inventory"}), 500
+        with start_span("catalog.lookup", attributes={"product_name": product_name}):
+            product, error = fetch_product_by_name(product_name)
+        if error:
+            message, status = error
+            return jsonify({"error": message}), status
 
-        products = product_response.json()
-        product = next(
-            (p for p in products if p["name"].lower() == product_name.lower()), None
-        )
-        if not product:
-            return jsonify({"error": "Product not found"}), 404
-
-        customer_response = requests.get(
-            f"{CUSTOMERS_SERVICE_URL}/customers/{username}"
-        )
+        customer_response = customers_client.get(f"/customers/{username}")
         if customer_response.status_code != 200:
             return jsonify({"error": "Customer not found"}), 404
-        customer = customer_response.json()
+        customer = decode_response(customer_response)
 
         if product["count_in_stock"] < quantity:
             return jsonify({"error": "Insufficient stock"}), 400
@@ -209,32 +511,46 @@ def make_sale():
         if customer["wallet_balance"] < total_price:
             return jsonify({"error": "Insufficient funds"}), 400
 
-        wallet_deduction_response = requests.post(
-            f"{CUSTOMERS_SERVICE_URL}/customers/{username}/deduct",
-            json={"amount": total_price},
-        )
+        # The wallet ledger entries are named after the sale, so the sale can
+        # be reconciled with them and a repeated call is not applied twice.
+        sale_uid = uuid.uuid4().hex
+        wallet_deduction_response = deduct_for_sale(username, total_price, sale_uid)
         if wallet_deduction_response.status_code != 200:
             return jsonify({"error": "Failed to update customer wallet"}), 500
 
-        stock_update_response = requests.put(
-            f'{INVENTORY_SERVICE_URL}/inventory/{product["id"]}',
-            json={"count_in_stock": product["count_in_stock"] - quantity},
-        )
-        if stock_update_response.status_code != 200:
-            requests.post(
-                f"{CUSTOMERS_SERVICE_URL}/customers/{username}/add",
-                json={"amount": total_price},
+        # The decrement is conditional on the stock left at commit time, so
+        # concurrent sales of the same product cannot oversell it.
+        try:
+            stock_update_response = inventory_client.post(
+                f'/inventory/{product["id"]}/decrement',
+                json={"quantity": quantity},
             )
+            stock_status = stock_update_response.status_code
+        except DownstreamUnavailable:
+            stock_status = None
+        if stock_status != 200:
+            # Refund the customer, or leave the refund to the compensator
+            try:
+                compensation.refund(customers_client, username, total_price, sale_uid, DOWNSTREAM_TIMEOUT)
+            except RefundFailed as e:
+                compensation.owe(sale_uid, username, total_price, compensation.REFUND, e)
+            if stock_status == 400:
+                return jsonify({"error": "Insufficient stock"}), 400
             return jsonify({"error": "Failed to update product stock"}), 500
 
-        sale = Sale(
-            customer_id=customer["id"],
-            product_id=product["id"],
-            quantity=quantity,
-            total_price=total_price,
-        )
-        db.session.add(sale)
-        db.session.commit()
+        with start_span("sale.commit"):
+            if sale_writer is not None:
+                sale_writer.submit(customer["id"], product["id"], quantity, total_price, uid=sale_uid)
+            else:
+                sale = Sale(
+                    uid=sale_uid,
+                    customer_id=customer["id"],
+                    product_id=product["id"],
+                    quantity=quantity,
+                    total_price=total_price,
+                )
+                db.session.add(sale)
+                db.session.commit()
 
         return (
             jsonify(
@@ -246,10 +562,371 @@ def make_sale():
             200,
         )
 
+    except DownstreamUnavailable:
+        db.session.rollback()
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/sales/customer/<int:customer_id>", methods=["GET"])
+@read_only
+def get_sales_history(customer_id):
+    """
+    Get the sales of a customer, newest first.
+
+    Served from the read replica when one is configured. With write-behind
+    enabled, a sale appears once the writer has flushed it.
+
+    **Endpoint:** ``/sales/customer/<customer_id>``
+
+    **Method:** ``GET``
+
+    **Query Parameters:**
+        - `limit` (int, optional): Maximum number of sales to return
+          (default 50, max 500).
+        - `before` (int, optional): Only return sales with a smaller ID; pass
+          the `next_before` of the previous page.
+
+    **Responses:**
+        - 200: The sales and the `next_before` cursor (null on the last page).
+        - 400: Invalid limit or cursor.
+
+    :return: JSON response with the sales and status code.
+    :rtype: tuple
+    """
+    limit = request.args.get("limit", SALES_HISTORY_DEFAULT_LIMIT, type=int)
+    before = request.args.get("before", type=int)
+    if limit is None or not (1 <= limit <= SALES_HISTORY_MAX_LIMIT):
+        return jsonify({"error": "Invalid limit"}), 400
+    if "before" in request.args and before is None:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    sales = sales_history(current_app.extensions["sale_archive"], customer_id, before, limit)
+    return jsonify({
+        "sales": sales,
+        "next_before": sales[-1]["id"] if len(sales) == limit else None,
+    }), 200
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO 8601 timestamp into a naive UTC datetime, like the ones
+    stored in the database.
+
+    :raises ValueError: If ``value`` is not a valid timestamp.
+    """
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+@bp.route("/sales/rollup", methods=["GET"])
+@read_only
+def get_sales_rollup():
+    """
+    Get the number of sales, units sold and revenue per product or customer.
+
+    Includes archived sales. Served from the read replica when one is configured.
+
+    **Endpoint:** ``/sales/rollup``
+
+    **Method:** ``GET``
+
+    **Query Parameters:**
+        - `by` (str, optional): `product` (default) or `customer`.
+        - `start` (str, optional): Only count sales at or after this ISO 8601 time.
+        - `end` (str, optional): Only count sales before this ISO 8601 time.
+
+    **Responses:**
+        - 200: One row per product or customer, by revenue descending.
+        - 400: Invalid grouping or timestamp.
+
+    :return: JSON response with the rollup and status code.
+    :rtype: tuple
+    """
+    key = f"{request.args.get('by', 'product')}_id"
+    if key not in ROLLUP_KEYS:
+        return jsonify({"error": "by must be product or customer"}), 400
+    try:
+        start, end = (
+            parse_timestamp(request.args[name]) if name in request.args else None
+            for name in ("start", "end")
+        )
+    except ValueError:
+        return jsonify({"error": "Invalid timestamp"}), 400
+    return jsonify({"rollup": sales_rollup(current_app.extensions["sale_archive"], key, start, end)}), 200
+
+
+@bp.route("/catalog/status", methods=["GET"])
+def catalog_status():
+    """
+    Report the state of the local catalog replica.
+
+    **Endpoint:** ``/catalog/status``
+
+    **Method:** ``GET``
+
+    **Responses:**
+        - 200: Replica freshness, feed position, product count and counters,
+          plus the counters of the fallback inventory cache.
+
+    :return: JSON response with the replica status and status code.
+    :rtype: tuple
+    """
+    return jsonify(dict(current_app.extensions["catalog"].status(), inventory_cache=inventory_cache.stats())), 200
+
+
+@bp.route("/downstreams", methods=["GET"])
+def downstream_status():
+    """
+    Report the state of the clients for downstream services.
+
+    **Endpoint:** ``/downstreams``
+
+    **Method:** ``GET``
+
+    **Responses:**
+        - 200: Per dependency: call and failure counts, circuit breaker state,
+          trips and rejections, bulkhead usage, and how many GETs were
+          coalesced into an in-flight call.
+
+    :return: JSON response with the client states and status code.
+    :rtype: tuple
+    """
+    extensions = current_app.extensions
+    return jsonify({
+        client.name: client.stats()
+        for client in (extensions["customers_client"], extensions["inventory_client"])
+    }), 200
+
+
+@bp.route("/sales/writer", methods=["GET"])
+def sale_writer_status():
+    """
+    Report the state of the write-behind sale writer.
+
+    **Endpoint:** ``/sales/writer``
+
+    **Method:** ``GET``
+
+    **Responses:**
+        - 200: Whether write-behind is enabled and, if so, pending, written
+          and recovered sale counts, flush counters and journal fsyncs.
+
+    :return: JSON response with the writer status and status code.
+    :rtype: tuple
+    """
+    sale_writer = current_app.extensions["sale_writer"]
+    if sale_writer is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(sale_writer.stats(), enabled=True)), 200
+
+
+@bp.route("/sales/compensations", methods=["GET"])
+def compensations_status():
+    """
+    Report the refunds owed by failed sales.
+
+    **Endpoint:** ``/sales/compensations``
+
+    **Method:** ``GET``
+
+    **Responses:**
+        - 200: The number of open compensations and this worker's
+          compensator counters.
+
+    :return: JSON response with the compensator status and status code.
+    :rtype: tuple
+    """
+    return jsonify(current_app.extensions["compensator"].stats()), 200
+
+
+@bp.route("/recommendations/status", methods=["GET"])
+def recommendations_status():
+    """
+    Report the state of this worker's recommendation index.
+
+    **Endpoint:** ``/recommendations/status``
+
+    **Method:** ``GET``
+
+    **Responses:**
+        - 200: Whether the index is built, the last sale it includes, its
+          customer, product and pair counts, and build and update counters.
+
+    :return: JSON response with the index status and status code.
+    :rtype: tuple
+    """
+    return jsonify(current_app.extensions["co_purchases"].stats()), 200
+
+
+@bp.route("/sales/archive", methods=["GET"])
+def sale_archive_status():
+    """
+    Report the state of the sales archive.
+
+    **Endpoint:** ``/sales/archive``
+
+    **Method:** ``GET``
+
+    **Responses:**
+        - 200: Archive directory, segment, row and byte counts, the archived
+          months, and the archival runs of this process.
+
+    :return: JSON response with the archive status and status code.
+    :rtype: tuple
+    """
+    return jsonify(current_app.extensions["sale_archive"].stats()), 200
+
+
+def prepare_revenue_report(params):
+    """
+    Check the parameters of the ``revenue-by-category`` report and add the
+    category of every product, which the sales database does not have.
+
+    :raises ValueError: On invalid parameters, or if the catalog cannot be read.
+    """
+    unknown = set(params) - {"start", "end"}
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    bounds = {}
+    for name in ("start", "end"):
+        if params.get(name) is not None:
+            try:
+                bounds[name] = parse_timestamp(params[name]).isoformat()
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid {name} timestamp")
+
+    catalog = current_app.extensions["catalog"]
+    if catalog.is_fresh():
+        products = catalog.all_products()
+    else:
+        try:
+            status, products = cached_inventory("/inventory").value
+        except (DownstreamUnavailable, InventoryUnavailable):
+            status = None
+        if status != 200:
+            raise ValueError("The product catalog is unavailable")
+    categories = {str(product["id"]): product["category"] for product in products}
+    return dict(bounds, categories=categories)
+
+
+REPORTS = {
+    "revenue-by-category": Report(
+        reports.revenue_by_category,
+        prepare=prepare_revenue_report,
+        description="Sales, units and revenue per product category; optional start and end timestamps.",
+    ),
+}
+
+
+@click.command("archive-sales")
+@click.option("--older-than-days", type=float,
+              help="Archive sales older than this many days [default: SALES_ARCHIVE_AFTER_DAYS].")
+@click.option("--batch-size", default=SALES_ARCHIVE_BATCH_SIZE, show_default=True,
+              help="Sales moved per transaction.")
+@with_appcontext
+def archive_sales_command(older_than_days, batch_size):
+    """Move old sales from the database to the columnar archive."""
+    if older_than_days is None:
+        older_than_days = current_app.config["SALES_ARCHIVE_AFTER_DAYS"]
+    cutoff = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=older_than_days)
+    try:
+        archived = current_app.extensions["sale_archive"].archive(cutoff, batch_size)
+    except ArchiveNotPersistent as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Archived {archived} sales older than {cutoff:%Y-%m-%d %H:%M:%S} UTC.")
+
+
+def create_app(config=None):
+    """
+    Create the sales service app.
+
+    Creating the app does not connect to the database or to other services;
+    the catalog replica, the sale writer and the recommendation index start
+    with the first request. See
+    :mod:`config` for the settings and :func:`db.init_db` for schema creation.
+
+    :param config: Settings overriding :class:`config.Config`: a mapping, or
+        an object with upper-case attributes such as :class:`config.TestingConfig`.
+    :return: The Flask app.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    init_db(app)
+
+    init_tracing(app, "sales")
+    init_resilience(app, default_budget=REQUEST_BUDGET)
+    init_codec(app)
+    init_compression(app, min_size=COMPRESSION_MIN_SIZE)
+
+    # Clients and background workers of this app, looked up through
+    # current_app; created here, started with the first request
+    customers_client = make_client("customers", app.config["CUSTOMERS_SERVICE_URL"])
+    inventory_client = make_client("inventory", app.config["INVENTORY_SERVICE_URL"])
+    catalog = CatalogReplica(
+        inventory_client,
+        poll_interval=CATALOG_POLL_INTERVAL,
+        max_staleness=CATALOG_MAX_STALENESS,
+    )
+    if app.config["SALES_WRITE_BEHIND"]:
+        sale_writer = SaleWriter(
+            app,
+            app.config["SALES_JOURNAL_DIR"],
+            batch_size=SALE_WRITE_BATCH_SIZE,
+            flush_interval=SALE_WRITE_FLUSH_INTERVAL,
+        )
+    else:
+        sale_writer = None
+    sale_archive = SaleArchive(app.config["SALES_ARCHIVE_DIR"], cache_size=SALES_ARCHIVE_CACHED_COLUMNS)
+    co_purchases = CoPurchaseIndex(
+        app,
+        sale_archive,
+        interval=RECOMMENDATIONS_REFRESH_INTERVAL,
+        top_k=RECOMMENDATIONS_TOP_K,
+    )
+    compensator = Compensator(
+        app,
+        customers_client,
+        interval=COMPENSATION_INTERVAL,
+        grace=COMPENSATION_GRACE,
+        timeout=DOWNSTREAM_TIMEOUT,
+    )
+    app.extensions.update(
+        customers_client=customers_client,
+        inventory_client=inventory_client,
+        catalog=catalog,
+        # Optional write-behind of sale records: journalled locally, inserted in bulk
+        sale_writer=sale_writer,
+        # Columnar files holding the sales moved out of the table by archive-sales
+        sale_archive=sale_archive,
+        # Per-worker "frequently bought together" index
+        co_purchases=co_purchases,
+        # Settles the refunds that failed sales may owe (see compensation.py)
+        compensator=compensator,
+    )
+    app.cli.add_command(archive_sales_command)
+    init_jobs(
+        app,
+        create_app,
+        REPORTS,
+        workers=REPORT_WORKERS,
+        max_queued=REPORT_MAX_QUEUED,
+        memory_limit=REPORT_MEMORY_LIMIT,
+        time_limit=REPORT_TIME_LIMIT,
+        cache_ttl=REPORT_CACHE_TTL,
+        cache_size=REPORT_CACHE_SIZE,
+    )
+    app.register_blueprint(bp)
+    return app
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    create_app().run(host="0.0.0.0", port=5000)
@@ -0,0 +1,417 @@
+"""
+Columnar archive of old sales.
+
+The ``sale`` table only grows, and so do its indexes. :meth:`SaleArchive.archive`
+moves sales older than a cutoff out of it into compressed columnar files on
+local disk, partitioned by month::
+
+    <archive dir>/2024-05/sales-<first id>-<last id>.col
+
+A segment file is immutable. It holds a JSON header followed by one
+zlib-compressed block per column (ids, customer, product, quantity and
+timestamp as 64-bit integers, price as doubles, uids as text). The header
+records each block's offset and min/max. Readers memory-map a segment and
+decompress only the columns a query needs, and only for segments whose
+min/max can match.
+
+An archival run writes a batch of sales to ``.pending`` files, deletes the
+batch from the table in one transaction and then renames the files into
+place. If a run dies halfway, the next run finishes the rename when the
+delete was committed and discards the files otherwise, so no sale is lost or
+archived twice. Runs are serialized by an ``flock`` on the archive
+directory. A run refuses to start when the directory is on a filesystem that
+does not outlive its container (the container's own overlay layer, or a
+tmpfs): the archived sales would be deleted from the table and lost with it.
+
+:func:`sales_history` and :func:`sales_rollup` answer queries over the live
+table and the archive together.
+"""
+import array
+import datetime
+import fcntl
+import glob
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from db import db
+from models import Sale
+
+MAGIC = b'SALECOL1'
+HEADER_LENGTH = struct.Struct('<I')
+
+# Name and array typecode of the numeric columns. Timestamps are stored as
+# microseconds since the epoch; the naive database timestamps are UTC.
+NUMERIC_COLUMNS = (
+    ('id', 'q'),
+    ('customer_id', 'q'),
+    ('product_id', 'q'),
+    ('quantity', 'q'),
+    ('total_price', 'd'),
+    ('timestamp', 'q'),
+)
+TEXT_COLUMNS = ('uid',)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+ROLLUP_KEYS = ('product_id', 'customer_id')
+
+# Filesystems whose files are gone once the container or host is
+EPHEMERAL_FILESYSTEMS = frozenset({'overlay', 'aufs', 'tmpfs', 'ramfs'})
+MOUNTINFO = '/proc/self/mountinfo'
+
+
+class ArchiveNotPersistent(Exception):
+    """The archive directory is not on persistent storage."""
+
+
+def filesystem_type(path):
+    """
+    Return the type of the filesystem ``path`` is on, from ``/proc/self/mountinfo``.
+
+    :return: The type, such as ``ext4`` or ``overlay``, or ``None`` when the
+        mount table cannot be read (outside Linux).
+    """
+    path = os.path.realpath(path)
+    found, found_type = None, None
+    try:
+        with open(MOUNTINFO) as f:
+            for line in f:
+                fields, _, rest = line.partition(' - ')
+                # Spaces and the like are octal escapes, such as \040
+                mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields.split()[4])
+                if not (mount_point == '/' or path == mount_point or path.startswith(mount_point + '/')):
+                    continue
+                # A later mount on the same point hides the earlier one
+                if found is None or len(mount_point) >= len(found):
+                    found, found_type = mount_point, rest.split()[0]
+    except OSError:
+        return None
+    return found_type
+
+
+def to_micros(timestamp):
+    return (timestamp - EPOCH) // ONE_MICROSECOND
+
+
+def from_micros(micros):
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def write_segment(path, sales):
+    """
+    Write ``sales`` (ordered by id) to a segment file and fsync it.
+    """
+    blocks, columns = [], {}
+    offset = 0
+
+    def add(name, kind, data, low=None, high=None):
+        nonlocal offset
+        block = zlib.compress(data)
+        columns[name] = {'type': kind, 'offset': offset, 'length': len(block), 'min': low, 'max': high}
+        blocks.append(block)
+        offset += len(block)
+
+    for name, typecode in NUMERIC_COLUMNS:
+        if name == 'timestamp':
+            values = [to_micros(sale.timestamp) for sale in sales]
+        else:
+            values = [getattr(sale, name) for sale in sales]
+        add(name, typecode, array.array(typecode, values).tobytes(), min(values), max(values))
+    for name in TEXT_COLUMNS:
+        add(name, 'text', '\n'.join(getattr(sale, name) or '' for sale in sales).encode())
+
+    header = json.dumps({'rows': len(sales), 'columns': columns}).encode()
+    with open(path, 'wb') as f:
+        f.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        for block in blocks:
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Segment:
+    """A memory-mapped segment file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a sales archive segment')
+        start = len(MAGIC) + HEADER_LENGTH.size
+        (length,) = HEADER_LENGTH.unpack(self._map[len(MAGIC):start])
+        header = json.loads(self._map[start:start + length])
+        self.rows = header['rows']
+        self.columns = header['columns']
+        self._data_start = start + length
+
+    def min(self, name):
+        return self.columns[name]['min']
+
+    def max(self, name):
+        return self.columns[name]['max']
+
+    def read(self, name):
+        """Decompress a column into an ``array`` (or a list of uids)."""
+        column = self.columns[name]
+        start = self._data_start + column['offset']
+        data = zlib.decompress(self._map[start:start + column['length']])
+        if column['type'] == 'text':
+            return [uid or None for uid in data.decode().split('\n')]
+        values = array.array(column['type'])
+        values.frombytes(data)
+        return values
+
+    def close(self):
+        self._map.close()
+
+
+class SaleArchive:
+    """
+    The archive directory of the sales service.
+
+    :param directory: Where the segment files live.
+    :param cache_size: Decompressed columns kept in memory, across segments.
+    """
+
+    def __init__(self, directory, cache_size=64):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._segments = {}
+        self._columns = OrderedDict()
+        self.archived = 0
+        self.runs = 0
+
+    # Archival
+
+    def archive(self, cutoff, batch_size=10000):
+        """
+        Move the sales older than ``cutoff`` from the table to the archive.
+
+        Must be called in an application context.
+
+        :param cutoff: A naive UTC datetime.
+        :param batch_size: Sales moved per transaction.
+        :return: The number of sales archived.
+        :raises ArchiveNotPersistent: If the directory is on an ephemeral
+            filesystem; nothing is archived.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        kind = filesystem_type(self.directory)
+        if kind in EPHEMERAL_FILESYSTEMS:
+            raise ArchiveNotPersistent(
+                f'{os.path.realpath(self.directory)} is on {kind}; mount a volume there before archiving')
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._recover()
+            archived = 0
+            while True:
+                sales = (Sale.query.filter(Sale.timestamp < cutoff)
+                         .order_by(Sale.id).limit(batch_size).all())
+                if not sales:
+                    break
+                archived += self._move(sales)
+        with self._lock:
+            self.archived += archived
+            self.runs += 1
+        return archived
+
+    def _move(self, sales):
+        by_month = {}
+        for sale in sales:
+            by_month.setdefault(sale.timestamp.strftime('%Y-%m'), []).append(sale)
+        pending = []
+        try:
+            for month, rows in by_month.items():
+                os.makedirs(os.path.join(self.directory, month), exist_ok=True)
+                path = os.path.join(self.directory, month, f'sales-{rows[0].id}-{rows[-1].id}.col')
+                write_segment(path + '.pending', rows)
+                pending.append(path)
+            ids = [sale.id for sale in sales]
+            for start in range(0, len(ids), 500):
+                db.session.execute(
+                    db.delete(Sale).where(Sale.id.in_(ids[start:start + 500])),
+                    execution_options={'synchronize_session': False},
+                )
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            for path in pending:
+                os.unlink(path + '.pending')
+            raise
+        db.session.expunge_all()
+        for path in pending:
+            os.rename(path + '.pending', path)
+        return len(sales)
+
+    def _recover(self):
+        """Finish or undo the segments of an interrupted run."""
+        for pending in glob.glob(os.path.join(self.directory, '*', '*.col.pending')):
+            segment = Segment(pending)
+            first_id = segment.min('id')
+            segment.close()
+            if db.session.get(Sale, first_id) is None:
+                # The batch was deleted from the table: the file is its only copy
+                os.rename(pending, pending[:-len('.pending')])
+            else:
+                os.unlink(pending)
+        db.session.rollback()
+
+    # Reading
+
+    def segments(self):
+        """Return the segments, oldest month first."""
+        paths = sorted(glob.glob(os.path.join(self.directory, '*', '*.col')))
+        with self._lock:
+            for path in paths:
+                if path not in self._segments:
+                    self._segments[path] = Segment(path)
+            return [self._segments[path] for path in paths]
+
+    def column(self, segment, name):
+        key = (segment.path, name)
+        with self._lock:
+            values = self._columns.get(key)
+            if values is not None:
+                self._columns.move_to_end(key)
+                return values
+        values = segment.read(name)
+        with self._lock:
+            self._columns[key] = values
+            while len(self._columns) > self.cache_size:
+                self._columns.popitem(last=False)
+        return values
+
+    def _rows(self, segment, indexes):
+        columns = {name: self.column(segment, name) for name, _ in NUMERIC_COLUMNS}
+        return [
+            {
+                'id': columns['id'][i],
+                'customer_id': columns['customer_id'][i],
+                'product_id': columns['product_id'][i],
+                'quantity': columns['quantity'][i],
+                'total_price': columns['total_price'][i],
+                'timestamp': from_micros(columns['timestamp'][i]),
+            }
+            for i in indexes
+        ]
+
+    def history(self, customer_id, before=None, limit=50):
+        """
+        Return up to ``limit`` archived sales of a customer with an id below
+        ``before``, newest first, as dicts like :meth:`Sale.to_dict`.
+        """
+        found = []
+        candidates = [
+            s for s in self.segments()
+            if s.min('customer_id') <= customer_id <= s.max('customer_id')
+            and (before is None or s.min('id') < before)
+        ]
+        for segment in sorted(candidates, key=lambda s: s.max('id'), reverse=True):
+            if len(found) >= limit and segment.max('id') < found[-1]['id']:
+                break
+            customers = self.column(segment, 'customer_id')
+            ids = self.column(segment, 'id')
+            indexes = [
+                i for i, customer in enumerate(customers)
+                if customer == customer_id and (before is None or ids[i] < before)
+            ]
+            if indexes:
+                found = sorted(found + self._rows(segment, indexes), key=lambda s: s['id'], reverse=True)[:limit]
+        return found
+
+    def rollup(self, key, start=None, end=None):
+        """
+        Sum the archived sales per ``key`` (a column of :data:`ROLLUP_KEYS`)
+        with ``start <= timestamp < end``.
+
+        :return: ``{key value: [sales, quantity, revenue]}``.
+        """
+        low = to_micros(start) if start else None
+        high = to_micros(end) if end else None
+        totals = {}
+        for segment in self.segments():
+            if (low is not None and segment.max('timestamp') < low) or \
+                    (high is not None and segment.min('timestamp') >= high):
+                continue
+            keys = self.column(segment, key)
+            quantities = self.column(segment, 'quantity')
+            prices = self.column(segment, 'total_price')
+            timestamps = self.column(segment, 'timestamp')
+            whole = (low is None or segment.min('timestamp') >= low) and \
+                    (high is None or segment.max('timestamp') < high)
+            for i, value in enumerate(keys):
+                if not whole and not ((low is None or timestamps[i] >= low) and
+                                      (high is None or timestamps[i] < high)):
+                    continue
+                total = totals.get(value)
+                if total is None:
+                    total = totals[value] = [0, 0, 0.0]
+                total[0] += 1
+                total[1] += quantities[i]
+                total[2] += prices[i]
+        return totals
+
+    def stats(self):
+        segments = self.segments()
+        months = sorted({os.path.basename(os.path.dirname(s.path)) for s in segments})
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'segments': len(segments),
+                'rows': sum(s.rows for s in segments),
+                'bytes': sum(os.path.getsize(s.path) for s in segments),
+                'months': months,
+                'cached_columns': len(self._columns),
+                'runs': self.runs,
+                'archived': self.archived,
+            }
+
+
+def sales_history(archive, customer_id, before=None, limit=50):
+    """
+    Return up to ``limit`` sales of a customer with an id below ``before``,
+    newest first, from the table and the archive.
+    """
+    query = Sale.query.filter(Sale.customer_id == customer_id)
+    if before is not None:
+        query = query.filter(Sale.id < before)
+    sales = [sale.to_dict() for sale in query.order_by(Sale.id.desc()).limit(limit)]
+    if archive is not None:
+        sales = sorted(sales + archive.history(customer_id, before, limit),
+                       key=lambda sale: sale['id'], reverse=True)[:limit]
+    return sales
+
+
+def sales_rollup(archive, key, start=None, end=None):
+    """
+    Sum the sales per ``key`` (``product_id`` or ``customer_id``) with
+    ``start <= timestamp < end``, over the table and the archive.
+
+    :return: A list of ``{key, sales, quantity, revenue}``, by revenue descending.
+    """
+    column = getattr(Sale, key)
+    query = db.select(column, db.func.count(), db.func.sum(Sale.quantity), db.func.sum(Sale.total_price))
+    if start is not None:
+        query = query.where(Sale.timestamp >= start)
+    if end is not None:
+        query = query.where(Sale.timestamp < end)
+    totals = archive.rollup(key, start, end) if archive is not None else {}
+    for value, count, quantity, revenue in db.session.execute(query.group_by(column)):
+        total = totals.setdefault(value, [0, 0, 0.0])
+        total[0] += count
+        total[1] += quantity
+        total[2] += revenue
+    rows = [
+        {key: value, 'sales': count, 'quantity': quantity, 'revenue': round(revenue, 2)}
+        for value, (count, quantity, revenue) in totals.items()
+    ]
+    return sorted(rows, key=lambda row: row['revenue'], reverse=True)
@@ -0,0 +1,241 @@
+"""
+Refunds owed by failed sales.
+
+``make_sale`` deducts the price from the customer's wallet before it
+decrements the stock, and refunds the customer if the decrement fails. Two
+things can leave the customer charged for a sale that did not happen:
+
+- The refund itself fails. It is then recorded as a ``refund`` compensation.
+- The deduction fails without an answer (a timeout, a dropped connection or
+  a 5xx), even after being retried under the same operation id. The
+  customer service may or may not have applied it, so it is recorded as a
+  ``deduct`` compensation.
+
+Compensations are rows of the ``sale_compensations`` table, keyed by the
+sale's ``uid``. A :class:`Compensator` thread settles them every
+``interval`` seconds. A ``refund`` is sent again under its operation id
+``refund-<uid>``, which the customer service applies at most once. A
+``deduct`` is first left alone for ``grace`` seconds, so that a deduction
+still in flight has landed (and a read replica caught up). Then the
+customer's ledger is searched for ``sale-<uid>``: the sale is refunded if
+the deduction was recorded and settled as ``not-deducted`` otherwise.
+Every worker runs a compensator over the shared table; two settling the same
+sale at once still refund it once, as the refunds share their operation id.
+"""
+import datetime
+import logging
+import threading
+import time
+
+from codec import decode_response
+from db import db
+from models import SaleCompensation
+from resilience import DownstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+REFUND = 'refund'
+DEDUCT = 'deduct'
+
+REFUNDED = 'refunded'
+NOT_DEDUCTED = 'not-deducted'
+
+# Ledger entries read per page, and pages read, when looking for a deduction
+LEDGER_PAGE_SIZE = 500
+LEDGER_MAX_PAGES = 20
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class RefundFailed(Exception):
+    """The customer service did not confirm a refund."""
+
+
+def refund(client, username, amount, sale_uid, timeout):
+    """
+    Refund a sale to the customer's wallet under the operation id ``refund-<uid>``.
+
+    The refund gets its own deadline of ``timeout`` seconds: it must not be
+    cut short by the deadline of a request that is failing anyway.
+
+    :raises RefundFailed: If the customer service did not answer 200.
+    """
+    try:
+        response = client.post(
+            f"/customers/{username}/charge",
+            json={"amount": amount, "operation_id": f"refund-{sale_uid}"},
+            deadline=time.time() + timeout,
+        )
+    except DownstreamUnavailable as e:
+        raise RefundFailed(str(e)) from e
+    if response.status_code != 200:
+        raise RefundFailed(f"Refund answered {response.status_code}")
+
+
+def was_deducted(client, username, sale_uid, timeout):
+    """
+    Return whether the customer's ledger holds the deduction ``sale-<uid>``.
+
+    :raises RefundFailed: If the ledger could not be read.
+    """
+    operation_id = f"sale-{sale_uid}"
+    params = {"limit": LEDGER_PAGE_SIZE}
+    for _ in range(LEDGER_MAX_PAGES):
+        try:
+            response = client.get(f"/customers/{username}/wallet", params=params,
+                                  deadline=time.time() + timeout)
+        except DownstreamUnavailable as e:
+            raise RefundFailed(str(e)) from e
+        if response.status_code == 404:
+            return False
+        if response.status_code != 200:
+            raise RefundFailed(f"Wallet history answered {response.status_code}")
+        page = decode_response(response)
+        if any(entry["operation_id"] == operation_id for entry in page["entries"]):
+            return True
+        if page["next_before"] is None:
+            return False
+        params = {"limit": LEDGER_PAGE_SIZE, "before": page["next_before"]}
+    raise RefundFailed(f"{operation_id} not found in the last {LEDGER_PAGE_SIZE * LEDGER_MAX_PAGES} ledger entries")
+
+
+def owe(sale_uid, username, amount, reason, error):
+    """
+    Record that a sale may owe its customer a refund, in its own transaction.
+
+    The compensation is logged first, so it is not lost if the database
+    cannot record it either.
+    """
+    logger.warning("Sale %s may owe %s a refund of %s (%s): %s", sale_uid, username, amount, reason, error)
+    try:
+        db.session.rollback()
+        db.session.add(SaleCompensation(
+            uid=sale_uid,
+            username=username,
+            amount=amount,
+            reason=reason,
+            last_error=str(error),
+            created_at=utcnow(),
+        ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception("Could not record the compensation of sale %s", sale_uid)
+
+
+class Compensator:
+    """
+    Background thread that settles the open compensations every ``interval`` seconds.
+
+    :param app: The Flask app whose compensations are settled.
+    :param client: The :class:`resilience.Downstream` of the customer service.
+    :param interval: Seconds between runs.
+    :param grace: Seconds before a ``deduct`` compensation is looked into.
+    :param timeout: Seconds allowed for each call to the customer service.
+    :param batch_size: Compensations settled per run.
+    """
+
+    def __init__(self, app, client, interval=10.0, grace=60.0, timeout=5.0, batch_size=100):
+        self.app = app
+        self.client = client
+        self.interval = interval
+        self.grace = grace
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.refunded = 0
+        self.not_deducted = 0
+        self.errors = 0
+        self.last_run = None
+
+    def start(self):
+        """Start the background thread (idempotent)."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='sale-compensator', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        """Settle the open compensations that are due; return how many were settled."""
+        settled = 0
+        try:
+            with self.app.app_context():
+                cutoff = utcnow() - datetime.timedelta(seconds=self.grace)
+                due = db.session.scalars(
+                    db.select(SaleCompensation)
+                    .where(SaleCompensation.settled_at.is_(None))
+                    .where(db.or_(SaleCompensation.reason == REFUND, SaleCompensation.created_at <= cutoff))
+                    .order_by(SaleCompensation.created_at)
+                    .limit(self.batch_size)
+                ).all()
+                for compensation in due:
+                    settled += self.settle(compensation)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning("Settling sale compensations failed: %s", e)
+        with self._lock:
+            self.runs += 1
+            self.last_run = time.time()
+        return settled
+
+    def settle(self, compensation):
+        """Refund or close one compensation; return whether it was settled."""
+        try:
+            if compensation.reason == DEDUCT and not was_deducted(
+                    self.client, compensation.username, compensation.uid, self.timeout):
+                outcome = NOT_DEDUCTED
+            else:
+                refund(self.client, compensation.username, compensation.amount, compensation.uid, self.timeout)
+                outcome = REFUNDED
+        except RefundFailed as e:
+            compensation.attempts += 1
+            compensation.last_error = str(e)
+            db.session.commit()
+            with self._lock:
+                self.errors += 1
+            logger.warning("Compensation of sale %s not settled: %s", compensation.uid, e)
+            return False
+        compensation.attempts += 1
+        compensation.outcome = outcome
+        compensation.settled_at = utcnow()
+        db.session.commit()
+        with self._lock:
+            if outcome == REFUNDED:
+                self.refunded += 1
+            else:
+                self.not_deducted += 1
+        return True
+
+    def stats(self):
+        """Return the counters of this worker and the open compensations. Must be called in an application context."""
+        open_count = db.session.scalar(
+            db.select(db.func.count()).select_from(SaleCompensation)
+            .where(SaleCompensation.settled_at.is_(None))
+        )
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'grace': self.grace,
+                'open': open_count,
+                'runs': self.runs,
+                'refunded': self.refunded,
+                'not_deducted': self.not_deducted,
+                'errors': self.errors,
+                'last_run': self.last_run,
+            }
@@ -0,0 +1,73 @@
+"""
+Settings of the sales service.
+
+:class:`Config` reads its values from the environment, with defaults that
+match the docker-compose setup. Pass another config object or a mapping to
+``create_app`` to override them, e.g. :class:`TestingConfig` to run the
+service in-process on an in-memory SQLite database.
+"""
+import os
+
+
+def pool_options(database_uri):
+    """
+    Connection pool settings of the SQLAlchemy engine, per worker process.
+
+    A service holds at most ``DB_POOL_SIZE + DB_MAX_OVERFLOW`` connections per
+    worker, so size them to the worker's threads and keep the total across
+    workers below the database's ``max_connections``. SQLite gets the
+    driver defaults (an in-memory database is a single shared connection).
+    """
+    if database_uri.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        # Connections idle for longer may have been dropped by the server or
+        # a proxy; pre-ping replaces dead ones instead of failing a request.
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://user:password@db/sales_db')
+    SQLALCHEMY_ENGINE_OPTIONS = pool_options(SQLALCHEMY_DATABASE_URI)
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Optional read replica for routes marked read-only (see dbrouting.py)
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    SQLALCHEMY_BINDS = (
+        {'replica': dict(pool_options(DATABASE_REPLICA_URL), url=DATABASE_REPLICA_URL)}
+        if DATABASE_REPLICA_URL else {}
+    )
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+    # Create missing tables when the app is created. Off by default: the
+    # schema is migrated by ``flask --app app db upgrade`` before the workers start.
+    CREATE_SCHEMA = os.environ.get('CREATE_SCHEMA') == '1'
+    SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION') == '1'
+    TRACE_FILE = os.environ.get('TRACE_FILE')
+    # Fraction of new traces recorded (see tracing.py); with 0, only traces
+    # sampled by a caller are, and GET /traces/<trace_id> is not served
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.0))
+    CUSTOMERS_SERVICE_URL = os.environ.get('CUSTOMERS_SERVICE_URL', 'http://customers_service:5000')
+    INVENTORY_SERVICE_URL = os.environ.get('INVENTORY_SERVICE_URL', 'http://inventory_service:5000')
+    SALES_WRITE_BEHIND = os.environ.get('SALES_WRITE_BEHIND') == '1'
+    # Journal of acknowledged sales not yet inserted (see sale_writer.py); on
+    # the sales_journal volume in docker-compose, so it outlives the container
+    SALES_JOURNAL_DIR = os.environ.get('SALES_JOURNAL_DIR', '/var/lib/sales/journal')
+    # Columnar archive of old sales (see archive.py), filled by archive-sales;
+    # on the sales_archive volume in docker-compose
+    SALES_ARCHIVE_DIR = os.environ.get('SALES_ARCHIVE_DIR', '/var/lib/sales/archive')
+    SALES_ARCHIVE_AFTER_DAYS = float(os.environ.get('SALES_ARCHIVE_AFTER_DAYS', 90))
+    # Job and result files of the report jobs (see jobs.py), shared by the
+    # workers; on the report_jobs volume in docker-compose
+    REPORT_JOBS_DIR = os.environ.get('REPORT_JOBS_DIR', '/var/lib/sales/report_jobs')
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    SQLALCHEMY_BINDS = {}
+    CREATE_SCHEMA = True
@@ -0,0 +1,442 @@
+"""
+Asynchronous report jobs.
+
+Analytics reports can take seconds or minutes and a lot of memory, which a
+request thread of the web worker cannot afford. ``POST /reports/<name>``
+queues a report instead and answers ``202`` with a job id. The job runs in a
+child process, and ``GET /reports/jobs/<id>`` returns its state and, once
+finished, its result. ``GET /reports/jobs/<id>/events`` streams the state
+changes and the result as server-sent events.
+
+Each worker process runs at most ``workers`` jobs at a time and queues at
+most ``max_queued`` more (``503`` beyond that). Every job gets a fresh
+process, started with ``spawn`` rather than forked from the threaded worker.
+The child limits its address space to ``memory_limit`` bytes, and the parent
+kills it after ``time_limit`` seconds. The child builds its own app with the
+service's ``create_app`` and the parent's settings, and runs the report in an
+application context.
+
+Jobs are files in a directory shared by the workers of a host, so any worker
+can answer for a job. A job whose worker died is reported as failed. The
+same report with the same parameters is only run once per ``cache_ttl``
+seconds: a submission while it is queued or running, or within ``cache_ttl``
+seconds after it finished, returns that job. Finished jobs are deleted
+``cache_ttl`` seconds after they finished, and the oldest are deleted early
+when more than ``cache_size`` are kept.
+"""
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, jsonify, request
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+TIMED_OUT = 'timed_out'
+DONE = (FINISHED, FAILED, TIMED_OUT)
+
+EVENTS_POLL_INTERVAL = 0.25
+EVENTS_HEARTBEAT = 15.0
+
+
+class QueueFull(Exception):
+    """This worker already has as many report jobs as it may queue."""
+
+
+class Report:
+    """
+    A report that can be run as a job.
+
+    :param run: Module-level function computing the report in the child
+        process, in an application context. It gets the keyword arguments
+        returned by ``prepare`` and returns a JSON-serializable result.
+    :param prepare: Called in the request with the submitted parameters (a
+        dict); returns the keyword arguments of ``run``. Raises ValueError
+        for invalid parameters. By default the parameters are passed as they are.
+    :param description: Shown by ``GET /reports``.
+    """
+
+    def __init__(self, run, prepare=None, description=''):
+        self.run = run
+        self.prepare = prepare or (lambda params: params)
+        self.description = description
+
+
+def _child(conn, factory, config, run, kwargs, memory_limit):
+    """Entry point of a job's process."""
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    try:
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard_limit))
+        app = factory(config)
+        with app.app_context():
+            result = run(**kwargs)
+        conn.send((FINISHED, json.dumps(result, default=str)))
+    except MemoryError:
+        # Lift the limit again, or reporting the error could fail as well
+        resource.setrlimit(resource.RLIMIT_AS, (hard_limit, hard_limit))
+        conn.send((FAILED, 'The report exceeded its memory limit'))
+    except Exception as e:
+        conn.send((FAILED, f'{type(e).__name__}: {e}'))
+    finally:
+        conn.close()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ReportJobs:
+    """
+    Job queue and result cache of the reports of one service.
+
+    :param app: The Flask app; its settings are passed to the jobs.
+    :param factory: The service's ``create_app``, run in each job's process.
+    :param reports: Dict of report name to :class:`Report`.
+    :param directory: Where job files are kept.
+    :param workers: Jobs run at the same time by this worker process.
+    :param max_queued: Jobs waiting for a slot in this worker process.
+    :param memory_limit: Address space limit of a job's process, in bytes.
+    :param time_limit: Seconds a job may run before its process is killed.
+    :param cache_ttl: Seconds a finished job is kept and reused.
+    :param cache_size: Finished jobs kept at most.
+    """
+
+    def __init__(self, app, factory, reports, directory, workers=2, max_queued=16,
+                 memory_limit=1 << 30, time_limit=120.0, cache_ttl=300.0, cache_size=100):
+        self.factory = factory
+        self.reports = reports
+        self.directory = directory
+        self.workers = workers
+        self.max_queued = max_queued
+        self.memory_limit = memory_limit
+        self.time_limit = time_limit
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # Settings of the job's app; it must not create tables or start workers
+        self.config = dict(
+            {key: value for key, value in app.config.items() if key.isupper()},
+            CREATE_SCHEMA=False,
+        )
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self.submitted = 0
+        self.cache_hits = 0
+        self.finished = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    # Job files
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f'job-{job_id}.json')
+
+    def _key_path(self, key):
+        return os.path.join(self.directory, f'key-{key}')
+
+    def _write(self, job):
+        path = self._path(job['id'])
+        with open(path + '.tmp', 'w') as f:
+            f.write(json.dumps(job))
+        os.replace(path + '.tmp', path)
+
+    def _read(self, job_id):
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get(self, job_id):
+        """Return a job as a dict (with its result once finished), or None."""
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        job = self._read(job_id)
+        if job is not None and job['state'] not in DONE and not _pid_alive(job['pid']):
+            job.update(state=FAILED, error='The worker running the job exited',
+                       finished=job['started'] or job['submitted'])
+        return job
+
+    # Submission
+
+    def submit(self, name, params):
+        """
+        Queue report ``name`` with ``params``, unless the same report is
+        queued, running or cached.
+
+        :return: ``(job, created)``.
+        :raises ValueError: If the report rejects the parameters.
+        :raises QueueFull: If this worker cannot queue more jobs.
+        """
+        report = self.reports[name]
+        kwargs = report.prepare(params)
+        key = hashlib.sha256(json.dumps([name, params], sort_keys=True).encode()).hexdigest()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._evict()
+            job = self._cached(key)
+            if job is not None:
+                with self._lock:
+                    self.cache_hits += 1
+                return job, False
+            with self._lock:
+                if self._pending >= self.workers + self.max_queued:
+                    raise QueueFull(f'{self._pending} report jobs are already queued or running')
+                self._pending += 1
+                self.submitted += 1
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='report-job')
+            job = {
+                'id': uuid.uuid4().hex,
+                'report': name,
+                'params': params,
+                'state': QUEUED,
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'error': None,
+                'pid': os.getpid(),
+            }
+            self._write(job)
+            with open(self._key_path(key), 'w') as f:
+                f.write(job['id'])
+        self._executor.submit(self._execute, job, report.run, kwargs)
+        return job, True
+
+    def _cached(self, key):
+        try:
+            with open(self._key_path(key)) as f:
+                job = self.get(f.read())
+        except FileNotFoundError:
+            return None
+        if job is None or job['state'] in (FAILED, TIMED_OUT):
+            return None
+        if job['state'] == FINISHED and time.time() - job['finished'] > self.cache_ttl:
+            return None
+        return job
+
+    def _evict(self):
+        """Delete expired jobs, and the oldest finished ones beyond ``cache_size``."""
+        now = time.time()
+        done = []
+        for path in glob.glob(os.path.join(self.directory, 'job-*.json')):
+            job_id = os.path.basename(path)[len('job-'):-len('.json')]
+            job = self.get(job_id)
+            if job is None or job['state'] not in DONE:
+                continue
+            if now - job['finished'] > self.cache_ttl:
+                os.unlink(path)
+            else:
+                done.append((job['finished'], path))
+        for _, path in sorted(done)[:max(0, len(done) - self.cache_size)]:
+            os.unlink(path)
+        for path in glob.glob(os.path.join(self.directory, 'key-*')):
+            with open(path) as f:
+                if not os.path.exists(self._path(f.read())):
+                    os.unlink(path)
+
+    # Execution
+
+    def _execute(self, job, run, kwargs):
+        try:
+            job.update(state=RUNNING, started=time.time())
+            self._write(job)
+            state, payload = self._run_process(run, kwargs)
+            job.update(state=state, finished=time.time())
+            if state == FINISHED:
+                job['result'] = json.loads(payload)
+            else:
+                job['error'] = payload
+            self._write(job)
+        except Exception as e:
+            logger.exception("Report job %s failed", job['id'])
+            job.update(state=FAILED, error=str(e), finished=time.time())
+            self._write(job)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if job['state'] == FINISHED:
+                    self.finished += 1
+                elif job['state'] == TIMED_OUT:
+                    self.timed_out += 1
+                else:
+                    self.failed += 1
+
+    def _run_process(self, run, kwargs):
+        """Run a report in a new process; returns ``(state, result JSON or error)``."""
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_child,
+            args=(sender, self.factory, self.config, run, kwargs, self.memory_limit),
+            name='report-job',
+            daemon=True,
+        )
+        process.start()
+        sender.close()
+        try:
+            # Receive before joining: a large result would fill the pipe and
+            # block the child
+            if not receiver.poll(self.time_limit):
+                process.kill()
+                return TIMED_OUT, f'The report did not finish within {self.time_limit:g} seconds'
+            try:
+                return receiver.recv()
+            except EOFError:
+                process.join()
+                return FAILED, f'The report process exited with code {process.exitcode}'
+        finally:
+            receiver.close()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    # Reading
+
+    def events(self, job_id):
+        """
+        Yield server-sent events for a job: a ``state`` event per state
+        change, then a ``result`` event with the finished job.
+        """
+        last_state = None
+        last_sent = time.monotonic()
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                yield f'event: error\ndata: {json.dumps({"error": "Job not found"})}\n\n'
+                return
+            if job['state'] in DONE:
+                yield f'event: result\ndata: {json.dumps(job)}\n\n'
+                return
+            if job['state'] != last_state:
+                last_state = job['state']
+                last_sent = time.monotonic()
+                yield f'event: state\ndata: {json.dumps(job)}\n\n'
+            elif time.monotonic() - last_sent > EVENTS_HEARTBEAT:
+                last_sent = time.monotonic()
+                yield ': keep-alive\n\n'
+            time.sleep(EVENTS_POLL_INTERVAL)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'reports': {name: report.description for name, report in self.reports.items()},
+                'workers': self.workers,
+                'max_queued': self.max_queued,
+                'memory_limit': self.memory_limit,
+                'time_limit': self.time_limit,
+                'cache_ttl': self.cache_ttl,
+                'cache_size': self.cache_size,
+                'pending': self._pending,
+                'submitted': self.submitted,
+                'cache_hits': self.cache_hits,
+                'finished': self.finished,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+            }
+
+
+def init_jobs(app, factory, reports, **options):
+    """
+    Register the report job routes on an app.
+
+    :param factory: The service's ``create_app``.
+    :param reports: Dict of report name to :class:`Report`.
+    :param options: Passed to :class:`ReportJobs`, which gets the
+        ``REPORT_JOBS_DIR`` setting as its directory.
+    :return: The :class:`ReportJobs`.
+    """
+    jobs = ReportJobs(app, factory, reports, app.config['REPORT_JOBS_DIR'], **options)
+    app.extensions['report_jobs'] = jobs
+
+    @app.route('/reports', methods=['GET'])
+    def get_reports():
+        """
+        List the reports and the state of this worker's job queue.
+
+        **Responses:**
+            - 200: Report names and descriptions, limits and job counters.
+        """
+        return jsonify(jobs.stats()), 200
+
+    @app.route('/reports/<name>', methods=['POST'])
+    def submit_report(name):
+        """
+        Queue a report.
+
+        **Request JSON body (optional)**: The report's parameters.
+
+        **Responses:**
+            - 202: The queued job, or the same report's job already queued or running.
+            - 200: The same report's finished job, with its result, from the cache.
+            - 400: Invalid parameters.
+            - 404: No such report.
+            - 503: Too many jobs queued; retry later.
+        """
+        if name not in jobs.reports:
+            return jsonify({'error': 'Report not found'}), 404
+        params = request.get_json(silent=True) or {}
+        if not isinstance(params, dict):
+            return jsonify({'error': 'Parameters must be a JSON object'}), 400
+        try:
+            job, created = jobs.submit(name, params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except QueueFull as e:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': str(int(jobs.time_limit))}
+        status = 200 if job['state'] == FINISHED else 202
+        return jsonify(dict(job, cached=not created)), status, {'Location': f'/reports/jobs/{job["id"]}'}
+
+    @app.route('/reports/jobs/<job_id>', methods=['GET'])
+    def get_report_job(job_id):
+        """
+        Get a report job.
+
+        **Responses:**
+            - 200: The job's state (queued, running, finished, failed or
+              timed_out), timestamps, and its result or error once done.
+            - 404: No such job, or it was evicted.
+        """
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job), 200
+
+    @app.route('/reports/jobs/<job_id>/events', methods=['GET'])
+    def stream_report_job(job_id):
+        """
+        Stream a report job's state changes and result as server-sent events.
+
+        **Responses:**
+            - 200: ``text/event-stream`` of ``state`` events and a final
+              ``result`` event holding the done job.
+            - 404: No such job, or it was evicted.
+        """
+        if jobs.get(job_id) is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return Response(jobs.events(job_id), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    return jobs
@@ -0,0 +1,33 @@
+"""Add sale.uid for idempotent journal replay
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 09:00:00.000000
+
+The write-behind writer inserts sales with ``ON CONFLICT (uid) DO NOTHING``;
+sales recorded before have no uid.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('sale')}
+    if 'uid' in columns:
+        return
+    with op.batch_alter_table('sale') as batch_op:
+        batch_op.add_column(sa.Column('uid', sa.String(length=32), nullable=True))
+        batch_op.create_unique_constraint('sale_uid_key', ['uid'])
+
+
+def downgrade():
+    with op.batch_alter_table('sale') as batch_op:
+        batch_op.drop_constraint('sale_uid_key', type_='unique')
+        batch_op.drop_column('uid')
@@ -0,0 +1,27 @@
+"""Index sales by customer
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 09:00:00.000000
+
+Backs ``GET /sales/customer/<customer_id>``.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    indexes = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('sale')}
+    if 'ix_sale_customer_id' not in indexes:
+        op.create_index('ix_sale_customer_id', 'sale', ['customer_id'])
+
+
+def downgrade():
+    op.drop_index('ix_sale_customer_id', table_name='sale')
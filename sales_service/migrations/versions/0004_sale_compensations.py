@@ -0,0 +1,39 @@
+"""Add the refunds owed by failed sales
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 09:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('sale_compensations'):
+        return
+    op.create_table(
+        'sale_compensations',
+        sa.Column('uid', sa.String(length=32), nullable=False),
+        sa.Column('username', sa.String(length=80), nullable=False),
+        sa.Column('amount', sa.Float(), nullable=False),
+        sa.Column('reason', sa.String(length=16), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('settled_at', sa.DateTime(), nullable=True),
+        sa.Column('outcome', sa.String(length=16), nullable=True),
+        sa.PrimaryKeyConstraint('uid'),
+    )
+    op.create_index('ix_sale_compensations_settled_at', 'sale_compensations', ['settled_at'])
+
+
+def downgrade():
+    op.drop_index('ix_sale_compensations_settled_at', table_name='sale_compensations')
+    op.drop_table('sale_compensations')
@@ -2,11 +2,13 @@ from db import db
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, nullable=False)
+    customer_id = db.Column(db.Integer, nullable=False, index=True)
     product_id = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     total_price = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, server_default=db.func.now())
+    # Set by the write-behind writer so that replaying its journal is idempotent
+    uid = db.Column(db.String(32), unique=True, nullable=True)
 
     def to_dict(self):
         return {
@@ -16,4 +18,31 @@ class Sale(db.Model):
             "quantity": self.quantity,
             "total_price": self.total_price,
             "timestamp": self.timestamp
-        }
\ No newline at end of file
+        }
+
+class SaleCompensation(db.Model):
+    """A refund that a failed sale may owe its customer, until it is settled (see compensation.py)."""
+    __tablename__ = 'sale_compensations'
+
+    uid = db.Column(db.String(32), primary_key=True)
+    username = db.Column(db.String(80), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    reason = db.Column(db.String(16), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    settled_at = db.Column(db.DateTime, nullable=True, index=True)
+    outcome = db.Column(db.String(16), nullable=True)
+
+    def to_dict(self):
+        return {
+            "uid": self.uid,
+            "username": self.username,
+            "amount": self.amount,
+            "reason": self.reason,
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+            "created_at": self.created_at,
+            "settled_at": self.settled_at,
+            "outcome": self.outcome,
+        }
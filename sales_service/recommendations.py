@@ -0,0 +1,229 @@
+"""
+"Frequently bought together" recommendations.
+
+Two products are bought together when the same customer bought both, and
+the more customers did, the more related they are. :class:`CoPurchaseIndex`
+keeps, per worker process:
+
+- the set of products each customer bought,
+- a sparse, symmetric product-by-product matrix of co-purchase counts, as a
+  dict of dicts holding only the non-zero cells, and
+- the ``top_k`` most related products of every product, so that serving
+  related products is a dict lookup and a slice.
+
+:meth:`CoPurchaseIndex.build` computes everything from scratch, from the
+``sale`` table and the sales archive. It counts the product pairs of all
+customers in one pass with a :class:`collections.Counter`.
+:meth:`CoPurchaseIndex.update` then only reads the sales added since the
+last read. For each product a customer buys for the first time, it adds one
+to the cells of the products the customer already had, and recomputes the
+top list of the products whose row changed.
+
+Updates read again the last ``overlap`` sale ids they have seen. Ids are
+assigned on insert but become visible on commit, so a sale can show up
+after a higher id was already read. Counting a customer's product again is
+a no-op, so reading a sale twice is harmless. A background thread runs the
+build once and then an update every ``interval`` seconds.
+"""
+import heapq
+import logging
+import threading
+import time
+from collections import Counter
+from itertools import combinations
+
+from db import db
+from models import Sale
+
+logger = logging.getLogger(__name__)
+
+
+class CoPurchaseIndex:
+    """
+    Co-purchase matrix and related-product index of one worker process.
+
+    :param app: The Flask app whose sales are read.
+    :param archive: The :class:`archive.SaleArchive` whose sales count too, or None.
+    :param interval: Seconds between incremental updates.
+    :param top_k: Related products kept per product.
+    :param overlap: Sale ids read again by each update; see the module docstring.
+    """
+
+    def __init__(self, app, archive=None, interval=30.0, top_k=50, overlap=1000):
+        self.app = app
+        self.archive = archive
+        self.interval = interval
+        self.top_k = top_k
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._baskets = {}
+        self._matrix = {}
+        self._top = {}
+        self._pairs = 0
+        self._last_id = None
+        self.builds = 0
+        self.updates = 0
+        self.errors = 0
+        self.last_build = None
+        self.last_update = None
+        self.build_seconds = None
+
+    @property
+    def ready(self):
+        return self._last_id is not None
+
+    def start(self):
+        """Start the background thread (idempotent)."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='co-purchase-index', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    if self.ready:
+                        self.update()
+                    else:
+                        self.build()
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logger.warning("Co-purchase index refresh failed: %s", e)
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+    # Computation
+
+    def _read_table(self, after=None):
+        """Return the distinct (customer, product) pairs with an id above ``after``, and the highest id."""
+        query = db.select(Sale.customer_id, Sale.product_id, db.func.max(Sale.id))
+        if after is not None:
+            query = query.where(Sale.id > after)
+        rows = db.session.execute(query.group_by(Sale.customer_id, Sale.product_id)).all()
+        db.session.rollback()
+        return [(customer, product) for customer, product, _ in rows], max((row[2] for row in rows), default=None)
+
+    def _read_archive(self):
+        purchases = set()
+        for segment in self.archive.segments():
+            purchases.update(zip(self.archive.column(segment, 'customer_id'),
+                                 self.archive.column(segment, 'product_id')))
+        return purchases
+
+    def _top_of(self, row):
+        # Most customers first, then lowest product id
+        return tuple(heapq.nlargest(self.top_k, row.items(), key=lambda cell: (cell[1], -cell[0])))
+
+    def build(self):
+        """
+        Recompute the index from all sales. Must be called in an application context.
+
+        The table is read before the archive: a sale archived in between is
+        then found in the archive rather than missed.
+        """
+        with self._update_lock:
+            started = time.perf_counter()
+            purchases, last_id = self._read_table()
+            if self.archive is not None:
+                purchases = self._read_archive().union(purchases)
+
+            baskets = {}
+            for customer, product in purchases:
+                baskets.setdefault(customer, set()).add(product)
+            pairs = Counter()
+            for products in baskets.values():
+                if len(products) > 1:
+                    pairs.update(combinations(sorted(products), 2))
+            matrix = {}
+            for (a, b), count in pairs.items():
+                matrix.setdefault(a, {})[b] = count
+                matrix.setdefault(b, {})[a] = count
+            top = {product: self._top_of(row) for product, row in matrix.items()}
+
+            with self._lock:
+                self._baskets, self._matrix, self._top = baskets, matrix, top
+                self._pairs = len(pairs)
+                self._last_id = last_id or 0
+                self.builds += 1
+                self.last_build = time.time()
+                self.build_seconds = time.perf_counter() - started
+
+    def update(self):
+        """
+        Add the sales since the last build or update. Must be called in an
+        application context.
+
+        :return: The number of new (customer, product) purchases.
+        """
+        if not self.ready:
+            self.build()
+            return 0
+        with self._update_lock:
+            purchases, last_id = self._read_table(max(0, self._last_id - self.overlap))
+            added = 0
+            dirty = set()
+            for customer, product in purchases:
+                basket = self._baskets.setdefault(customer, set())
+                if product in basket:
+                    continue
+                if basket:
+                    row = self._matrix.setdefault(product, {})
+                    for other in basket:
+                        count = row.get(other, 0) + 1
+                        if count == 1:
+                            self._pairs += 1
+                        row[other] = count
+                        self._matrix.setdefault(other, {})[product] = count
+                    dirty.update(basket)
+                    dirty.add(product)
+                basket.add(product)
+                added += 1
+            # Readers look up one product at a time, so each top list is
+            # replaced whole rather than locked
+            for product in dirty:
+                self._top[product] = self._top_of(self._matrix[product])
+
+            with self._lock:
+                self._last_id = max(self._last_id, last_id or 0)
+                self.updates += 1
+                self.last_update = time.time()
+            return added
+
+    # Reading
+
+    def related(self, product_id, limit=10):
+        """
+        Return up to ``limit`` (at most ``top_k``) products bought together
+        with ``product_id``, as ``(product id, customers)`` pairs, most
+        customers first.
+        """
+        return self._top.get(product_id, ())[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'interval': self.interval,
+                'top_k': self.top_k,
+                'last_sale_id': self._last_id,
+                'customers': len(self._baskets),
+                'products': len(self._matrix),
+                'pairs': self._pairs,
+                'builds': self.builds,
+                'build_seconds': self.build_seconds,
+                'last_build': self.last_build,
+                'updates': self.updates,
+                'last_update': self.last_update,
+                'errors': self.errors,
+            }
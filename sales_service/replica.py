@@ -0,0 +1,191 @@
+"""
+Local read replica of the inventory catalog.
+
+The replica is bootstrapped from ``/inventory/snapshot`` and then kept up to
+date by tailing the inventory change feed (``/inventory/changes``) on a
+background thread. Catalog reads in the sales service are served from memory
+as long as the replica synced successfully within ``max_staleness`` seconds;
+otherwise callers fall back to asking the inventory service directly.
+"""
+import logging
+import threading
+import time
+
+import requests
+
+from codec import decode_response
+from resilience import DownstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogReplica:
+    """
+    In-memory copy of the product catalog, fed by the inventory change feed.
+
+    :param client: :class:`resilience.Downstream` for the inventory service.
+    :param poll_interval: Seconds between polls of the change feed.
+    :param max_staleness: Reads are only served locally if the last successful
+        sync is at most this many seconds old.
+    :param batch_size: Number of changes requested per poll.
+    :param max_backoff: Longest wait, in seconds, between polls after
+        consecutive failed syncs; the wait doubles with each failure.
+    """
+
+    def __init__(self, client, poll_interval=1.0, max_staleness=10.0, batch_size=500, max_backoff=30.0):
+        self.client = client
+        self.poll_interval = poll_interval
+        self.max_staleness = max_staleness
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._products = {}
+        self._ids_by_name = {}
+        self._seq = None
+        self._last_sync = None
+        self._thread = None
+        self._started = threading.Event()
+        self._stop = threading.Event()
+        self.applied = 0
+        self.sync_errors = 0
+
+    def start(self):
+        """Start the background tailer if it is not running yet (idempotent)."""
+        if self._started.is_set():
+            return
+        with self._lock:
+            if self._started.is_set():
+                return
+            self._thread = threading.Thread(target=self._run, name='catalog-replica', daemon=True)
+            self._thread.start()
+            self._started.set()
+
+    def _run(self):
+        # Any error is logged and retried: an exception escaping here would
+        # end the thread and leave the replica stale until the worker restarts
+        failures = 0
+        while True:
+            try:
+                self.sync()
+                failures = 0
+            except (DownstreamUnavailable, requests.RequestException, ValueError, KeyError) as e:
+                failures += 1
+                self.sync_errors += 1
+                logger.warning("Catalog replica sync failed: %s", e)
+            except Exception:
+                failures += 1
+                self.sync_errors += 1
+                logger.exception("Catalog replica sync failed")
+            if self._stop.wait(self.retry_delay(failures)):
+                return
+
+    def retry_delay(self, failures):
+        """Seconds to wait before the next poll after ``failures`` consecutive failed syncs."""
+        if not failures:
+            return self.poll_interval
+        return min(self.poll_interval * 2 ** failures, max(self.max_backoff, self.poll_interval))
+
+    def stop(self):
+        """Stop the background tailer after its current poll."""
+        self._stop.set()
+
+    def sync(self):
+        """
+        Bring the replica up to date with the inventory service.
+
+        Bootstraps from a snapshot on first use, then applies all pending
+        changes until the feed is drained.
+
+        :raises DownstreamUnavailable: If the inventory service is unreachable.
+        :raises requests.HTTPError: If it answers with an error.
+        """
+        if self._seq is None:
+            self._bootstrap()
+        while True:
+            response = self.client.get(
+                "/inventory/changes",
+                params={"since": self._seq, "limit": self.batch_size},
+            )
+            response.raise_for_status()
+            page = decode_response(response)
+            with self._lock:
+                for change in page["changes"]:
+                    self._apply(change)
+                self._seq = page["last_seq"]
+            if len(page["changes"]) < self.batch_size:
+                break
+        self._last_sync = time.monotonic()
+
+    def _bootstrap(self):
+        response = self.client.get("/inventory/snapshot")
+        response.raise_for_status()
+        snapshot = decode_response(response)
+        with self._lock:
+            self._products = {}
+            self._ids_by_name = {}
+            for product in snapshot["products"]:
+                self._put(product)
+            self._seq = snapshot["head_seq"]
+
+    def _apply(self, change):
+        if change["operation"] == "delete":
+            self._remove(change["product_id"])
+        else:
+            self._put(change["data"])
+        self.applied += 1
+
+    def _put(self, product):
+        self._remove(product["id"])
+        self._products[product["id"]] = product
+        self._ids_by_name.setdefault(product["name"].lower(), set()).add(product["id"])
+
+    def _remove(self, product_id):
+        old = self._products.pop(product_id, None)
+        if old is not None:
+            ids = self._ids_by_name.get(old["name"].lower())
+            ids.discard(product_id)
+            if not ids:
+                del self._ids_by_name[old["name"].lower()]
+
+    def staleness(self):
+        """Seconds since the last successful sync, or None if never synced."""
+        if self._last_sync is None:
+            return None
+        return time.monotonic() - self._last_sync
+
+    def is_fresh(self):
+        """Whether reads may be served from the replica."""
+        staleness = self.staleness()
+        return staleness is not None and staleness <= self.max_staleness
+
+    def all_products(self):
+        """Return all products, ordered by ID."""
+        with self._lock:
+            return [self._products[product_id] for product_id in sorted(self._products)]
+
+    def get(self, product_id):
+        """Return a product by ID, or None."""
+        with self._lock:
+            return self._products.get(product_id)
+
+    def find_by_name(self, name):
+        """
+        Return the product with the given name (case-insensitive), or None.
+
+        If several products share the name, the one with the lowest ID wins,
+        matching the order of ``GET /inventory``.
+        """
+        with self._lock:
+            ids = self._ids_by_name.get(name.lower())
+            return self._products[min(ids)] if ids else None
+
+    def status(self):
+        return {
+            "fresh": self.is_fresh(),
+            "seq": self._seq,
+            "products": len(self._products),
+            "staleness": self.staleness(),
+            "max_staleness": self.max_staleness,
+            "applied": self.applied,
+            "sync_errors": self.sync_errors,
+        }
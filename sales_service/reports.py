@@ -0,0 +1,40 @@
+"""
+Reports of the sales service, run as jobs by :mod:`jobs`.
+
+Each report runs in its own process, in an application context of an app
+built with the service's settings.
+"""
+import datetime
+
+from flask import current_app
+
+from archive import SaleArchive, sales_rollup
+
+
+def revenue_by_category(categories, start=None, end=None):
+    """
+    Sum the sales per product category, over the table and the archive.
+
+    :param categories: Category of each product ID (a dict keyed by the IDs
+        as strings, as JSON has them). Products missing from it, e.g. deleted
+        ones, count as ``uncategorized``.
+    :param start: Only count sales at or after this naive UTC ISO timestamp.
+    :param end: Only count sales before this naive UTC ISO timestamp.
+    :return: A list of ``{category, products, sales, quantity, revenue}``,
+        by revenue descending.
+    """
+    start, end = (datetime.datetime.fromisoformat(value) if value else None for value in (start, end))
+    archive = SaleArchive(current_app.config['SALES_ARCHIVE_DIR'])
+    totals = {}
+    for row in sales_rollup(archive, 'product_id', start, end):
+        category = categories.get(str(row['product_id']), 'uncategorized')
+        total = totals.setdefault(category, {
+            'category': category, 'products': 0, 'sales': 0, 'quantity': 0, 'revenue': 0.0,
+        })
+        total['products'] += 1
+        total['sales'] += row['sales']
+        total['quantity'] += row['quantity']
+        total['revenue'] += row['revenue']
+    for total in totals.values():
+        total['revenue'] = round(total['revenue'], 2)
+    return sorted(totals.values(), key=lambda total: total['revenue'], reverse=True)
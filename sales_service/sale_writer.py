@@ -0,0 +1,293 @@
+"""
+Write-behind persistence of sales.
+
+Committing every sale in its own transaction makes the sales database spend
+its time on tiny single-row commits. With write-behind enabled, ``make_sale``
+hands the sale to :class:`SaleWriter` instead. The writer appends the sale to
+a local journal and fsyncs it before the call returns, so an acknowledged
+sale is durable. Concurrent sales share their fsyncs (group commit): the
+append happens under the writer's lock, the fsync outside it, and one fsync
+makes every sale appended before it durable. A background thread then
+inserts the journalled sales into the ``sale`` table in bulk, once
+``batch_size`` are pending or ``flush_interval`` seconds have passed.
+
+The journal is a directory of append-only JSON-lines segments. The writer
+rotates to a new segment at every flush and deletes a segment once its sales
+are committed. Each process holds an exclusive ``flock`` on the segments it
+owns. On start, a writer replays every segment that no live process holds,
+which covers both its own crashed predecessor and dead sibling workers. Each
+sale carries a unique ``uid`` and inserts skip uids that already exist, so
+replaying a segment whose sales were committed just before a crash does not
+duplicate them. :meth:`SaleWriter.close` (also run at exit) flushes
+everything still pending.
+"""
+import atexit
+import datetime
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from models import Sale
+
+logger = logging.getLogger(__name__)
+
+INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+class _Segment:
+    """One journal file, locked by this process while it exists."""
+
+    def __init__(self, path, file):
+        self.path = path
+        self.file = file
+        self.records = []
+        # Records written to the file, and how many of them are known to be
+        # on disk; a sync covers every record written before it started
+        self.appended = 0
+        self.synced = 0
+        self._sync_lock = threading.Lock()
+        self._removed = False
+
+    @classmethod
+    def create(cls, path):
+        file = open(path, 'a', encoding='utf-8')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return cls(path, file)
+
+    @classmethod
+    def claim(cls, path):
+        """Lock an existing segment, or return None if a live process holds it."""
+        file = open(path, 'r+', encoding='utf-8')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+        segment = cls(path, file)
+        for line in file:
+            try:
+                segment.records.append(json.loads(line))
+            except ValueError:
+                # A torn final line of a write that was never acknowledged
+                logger.warning("Skipping unreadable record in %s", path)
+        segment.appended = segment.synced = len(segment.records)
+        return segment
+
+    def append(self, record):
+        """Write a record to the file; return its position, to pass to :meth:`sync`."""
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.records.append(record)
+        self.appended += 1
+        return self.appended
+
+    def sync(self, position):
+        """
+        Wait until the records up to ``position`` are on disk.
+
+        Callers queue on the segment's lock while an fsync runs; the next one
+        fsyncs every record appended so far, and those it covered return
+        without another fsync.
+
+        :return: Whether this call ran an fsync.
+        """
+        with self._sync_lock:
+            # A removed segment's records are committed to the database
+            if self.synced >= position or self._removed:
+                return False
+            target = self.appended
+            os.fsync(self.file.fileno())
+            self.synced = target
+            return True
+
+    def remove(self):
+        with self._sync_lock:
+            self._removed = True
+            os.unlink(self.path)
+            self.file.close()
+
+
+class SaleWriter:
+    """
+    Durable queue of sales, flushed to the ``sale`` table in bulk.
+
+    :param app: The Flask app whose database receives the sales.
+    :param journal_dir: Directory of the journal segments.
+    :param batch_size: Pending sales that trigger a flush.
+    :param flush_interval: Longest time in seconds a sale waits for a flush.
+    """
+
+    def __init__(self, app, journal_dir, batch_size=500, flush_interval=0.5):
+        self.app = app
+        self.journal_dir = journal_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._segment = None
+        self._sealed = []
+        self._next_segment = 0
+        self._thread = None
+        self._stopping = False
+        self.submitted = 0
+        self.written = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.recovered = 0
+        self.fsyncs = 0
+
+    def start(self):
+        """
+        Replay orphaned segments and start the background writer (idempotent).
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.journal_dir, exist_ok=True)
+            self._recover()
+            self._segment = self._new_segment()
+            self._thread = threading.Thread(target=self._run, name='sale-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _new_segment(self):
+        self._next_segment += 1
+        name = f'sales-{os.getpid()}-{int(time.time() * 1000)}-{self._next_segment}.jsonl'
+        return _Segment.create(os.path.join(self.journal_dir, name))
+
+    def _recover(self):
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, 'sales-*.jsonl'))):
+            segment = _Segment.claim(path)
+            if segment is not None:
+                self._sealed.append(segment)
+                self.recovered += len(segment.records)
+        if self.recovered:
+            logger.info("Replaying %d journalled sales", self.recovered)
+
+    def submit(self, customer_id, product_id, quantity, total_price, uid=None):
+        """
+        Journal a sale durably and queue it for insertion.
+
+        :param uid: Unique id of the sale; a random one if None.
+        :return: The sale record, including its ``uid`` and ``timestamp``.
+        """
+        record = {
+            'uid': uid or uuid.uuid4().hex,
+            'customer_id': customer_id,
+            'product_id': product_id,
+            'quantity': quantity,
+            'total_price': total_price,
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat(),
+        }
+        with self._lock:
+            if self._segment is None:
+                raise RuntimeError('SaleWriter is not running')
+            segment = self._segment
+            position = segment.append(record)
+            self.submitted += 1
+            if len(segment.records) >= self.batch_size:
+                self._wakeup.notify()
+        if segment.sync(position):
+            with self._lock:
+                self.fsyncs += 1
+        return record
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(
+                    lambda: self._stopping or len(self._segment.records) >= self.batch_size,
+                    timeout=self.flush_interval,
+                )
+                if self._stopping:
+                    return
+            self.flush()
+
+    def flush(self):
+        """
+        Insert everything journalled so far.
+
+        :return: Whether all pending sales were committed; on failure they stay
+            journalled and are retried by the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._segment is not None and self._segment.records:
+                    self._sealed.append(self._segment)
+                    self._segment = self._new_segment()
+                sealed = list(self._sealed)
+            if not sealed:
+                return True
+            records = [record for segment in sealed for record in segment.records]
+            try:
+                with self.app.app_context():
+                    if records:
+                        self._insert(records)
+            except Exception as e:
+                with self._lock:
+                    self.flush_errors += 1
+                logger.warning("Flushing %d sales failed, will retry: %s", len(records), e)
+                return False
+            with self._lock:
+                for segment in sealed:
+                    self._sealed.remove(segment)
+                self.written += len(records)
+                self.flushes += 1
+            # Outside the writer's lock: removing waits for a running fsync
+            for segment in sealed:
+                segment.remove()
+            return True
+
+    def _insert(self, records):
+        insert = INSERTS[db.engine.dialect.name]
+        rows = [
+            dict(record, timestamp=datetime.datetime.fromisoformat(record['timestamp']))
+            for record in records
+        ]
+        try:
+            db.session.execute(insert(Sale).on_conflict_do_nothing(index_elements=['uid']), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def close(self):
+        """Stop the background writer and flush what is still pending."""
+        with self._lock:
+            if self._thread is None or self._stopping:
+                return
+            self._stopping = True
+            self._wakeup.notify()
+        self._thread.join()
+        self.flush()
+        with self._lock:
+            if self._segment is not None and not self._segment.records:
+                self._segment.remove()
+            self._segment = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': (len(self._segment.records) if self._segment else 0)
+                + sum(len(s.records) for s in self._sealed),
+                'submitted': self.submitted,
+                'written': self.written,
+                'flushes': self.flushes,
+                'flush_errors': self.flush_errors,
+                'recovered': self.recovered,
+                'fsyncs': self.fsyncs,
+            }
@@ -0,0 +1,225 @@
+"""
+Opt-in SQL instrumentation: per-request statement counts, slow-query log and
+N+1 detection.
+
+Enabled by ``init_db`` when the app config has ``SQL_INSTRUMENTATION`` set.
+Every statement run during a request is counted and timed by its shape (the
+SQL text with literals replaced by ``?``), and the totals are sent back in a
+``Server-Timing`` header. Statements slower than ``SQL_SLOW_QUERY_MS`` are
+logged with their parameters and, for queries, their plan. When one request
+runs the same shape more than ``SQL_N_PLUS_ONE_THRESHOLD`` times, a warning
+names the shape and the request, which is the usual sign of a lookup issued
+per row instead of once. ``GET /sql/stats`` lists the most expensive shapes
+since the process started.
+
+This module is identical in every service.
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import g, has_request_context, jsonify, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_QUERY_MS = 100.0
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+STATS_TOP = 20
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+EXPLAIN_PREFIXES = {
+    "postgresql": "EXPLAIN ",
+    "sqlite": "EXPLAIN QUERY PLAN ",
+}
+EXPLAIN_SAVEPOINT = "sqlstats_explain"
+
+
+def statement_shape(statement):
+    """
+    Normalize a statement so that executions differing only in literal values
+    (including the length of ``IN`` lists) compare equal.
+    """
+    shape = _LITERALS.sub("?", statement)
+    shape = _IN_LISTS.sub("(?)", shape)
+    return _WHITESPACE.sub(" ", shape).strip()
+
+
+class RequestQueries:
+    """
+    Statements run while handling one request.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.shapes = Counter()
+
+    def record(self, shape, duration_ms):
+        self.count += 1
+        self.total_ms += duration_ms
+        self.shapes[shape] += 1
+
+
+class QueryStats:
+    """
+    Process-wide totals per statement shape.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shapes = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        self.slow_queries = 0
+        self.n_plus_one_warnings = 0
+
+    def record(self, shape, duration_ms):
+        with self._lock:
+            entry = self._shapes[shape]
+            entry["count"] += 1
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+
+    def record_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def record_n_plus_one(self):
+        with self._lock:
+            self.n_plus_one_warnings += 1
+
+    def counters(self):
+        with self._lock:
+            return {"slow_queries": self.slow_queries, "n_plus_one_warnings": self.n_plus_one_warnings}
+
+    def top(self, n=STATS_TOP):
+        with self._lock:
+            shapes = sorted(self._shapes.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:n]
+            return [dict(entry, statement=shape) for shape, entry in shapes]
+
+
+def explain(conn, statement, parameters):
+    """
+    Return the plan of a query as text, or None if it cannot be explained.
+
+    Runs on the raw DBAPI connection so the ``EXPLAIN`` is not itself
+    instrumented, inside a savepoint of the request's transaction: on
+    PostgreSQL a failed ``EXPLAIN`` would otherwise abort the transaction,
+    and every later statement of the request would fail. Only plain queries
+    are explained; ``EXPLAIN`` of a write would not run it.
+    """
+    prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+        return None
+    try:
+        cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            cursor.execute(f"SAVEPOINT {EXPLAIN_SAVEPOINT}")
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+            except Exception:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}")
+                raise
+            finally:
+                cursor.execute(f"RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}")
+            return plan
+        finally:
+            cursor.close()
+    except Exception as e:  # The plan is best effort; never fail the request for it
+        logger.debug("Could not explain statement: %s", e)
+        return None
+
+
+def init_sqlstats(app, engines):
+    """
+    Instrument ``engines`` and the requests of ``app``.
+
+    Reads ``SQL_SLOW_QUERY_MS``, ``SQL_N_PLUS_ONE_THRESHOLD`` and
+    ``SQL_EXPLAIN_SLOW`` (default on) from the app config.
+
+    :return: The :class:`QueryStats` of the app.
+    """
+    slow_query_ms = app.config.get("SQL_SLOW_QUERY_MS", DEFAULT_SLOW_QUERY_MS)
+    n_plus_one_threshold = app.config.get("SQL_N_PLUS_ONE_THRESHOLD", DEFAULT_N_PLUS_ONE_THRESHOLD)
+    explain_slow = app.config.get("SQL_EXPLAIN_SLOW", True)
+    stats = QueryStats()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sqlstats_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("sqlstats_started")
+        if not started:
+            return
+        duration_ms = (time.perf_counter() - started.pop()) * 1000
+        shape = statement_shape(statement)
+        stats.record(shape, duration_ms)
+        if has_request_context():
+            queries = g.get("sql_queries")
+            if queries is not None:
+                queries.record(shape, duration_ms)
+        if duration_ms >= slow_query_ms:
+            stats.record_slow_query()
+            plan = explain(conn, statement, parameters) if explain_slow and not executemany else None
+            logger.warning(
+                "Slow query (%.1f ms)%s: %s\nParameters: %r%s",
+                duration_ms,
+                f" in {request.method} {request.path}" if has_request_context() else "",
+                statement,
+                parameters,
+                f"\nPlan:\n{plan}" if plan else "",
+            )
+
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        started = conn.info.get("sqlstats_started") if conn is not None else None
+        if started:
+            started.pop()
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(engine, "handle_error", handle_error)
+
+    @app.before_request
+    def start_request_queries():
+        g.sql_queries = RequestQueries()
+
+    @app.after_request
+    def report_request_queries(response):
+        queries = g.get("sql_queries")
+        if queries is None:
+            return response
+        response.headers.add(
+            "Server-Timing", f'db;dur={queries.total_ms:.1f};desc="{queries.count} queries"'
+        )
+        for shape, count in queries.shapes.items():
+            if count > n_plus_one_threshold:
+                stats.record_n_plus_one()
+                logger.warning(
+                    "Possible N+1: %s %s ran the same statement %d times: %s",
+                    request.method, request.path, count, shape,
+                )
+        return response
+
+    @app.route("/sql/stats", methods=["GET"])
+    def get_sql_stats():
+        """
+        Get the statement shapes with the highest total time in this process.
+
+        **Responses:**
+            - 200: Slow-query and N+1 counters and the top statement shapes.
+        """
+        return jsonify(dict(
+            stats.counters(),
+            slow_query_ms=slow_query_ms,
+            n_plus_one_threshold=n_plus_one_threshold,
+            statements=stats.top(),
+        )), 200
+
+    return stats
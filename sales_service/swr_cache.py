@@ -0,0 +1,148 @@
+"""
+Stale-while-revalidate cache for responses of downstream services.
+
+Entries younger than ``soft_ttl`` are served as is. Once an entry passes
+``soft_ttl`` it is still served immediately, marked stale, while a single
+background refresh replaces it. If the downstream service is failing, the
+entry keeps being served until it reaches ``hard_ttl``; after that the next
+read has to load it synchronously and errors propagate to the caller.
+
+Loads of the same key are coalesced: concurrent callers missing the same key,
+and background refreshes, share one call to the loader. After a failed
+refresh the key is not retried for ``retry_after`` seconds, so an outage does
+not turn every stale read into a downstream call.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+CachedValue = namedtuple("CachedValue", ["value", "age", "stale"])
+
+
+class StaleWhileRevalidateCache:
+    """
+    Bounded key/value cache with soft and hard expiry and coalesced loads.
+
+    :param soft_ttl: Age in seconds after which an entry is refreshed in the background.
+    :param hard_ttl: Age in seconds after which an entry is no longer served.
+    :param maxsize: Maximum number of entries (least recently used are evicted).
+    :param retry_after: Seconds to wait after a failed background refresh of a
+        key before trying again; defaults to ``soft_ttl``.
+    """
+
+    def __init__(self, soft_ttl, hard_ttl, maxsize=10000, retry_after=None, clock=time.monotonic):
+        if hard_ttl < soft_ttl:
+            raise ValueError("hard_ttl must not be smaller than soft_ttl")
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.maxsize = maxsize
+        self.retry_after = soft_ttl if retry_after is None else retry_after
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._failed_at = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.coalesced = 0
+
+    def get(self, key, loader):
+        """
+        Return the value for ``key``, loading it with ``loader()`` if needed.
+
+        :param key: Cache key.
+        :param loader: Zero-argument callable returning the fresh value. It
+            should raise to signal that the value could not be loaded.
+        :return: A :class:`CachedValue` (value, age in seconds, stale flag).
+        :raises Exception: Whatever ``loader`` raised, if no servable entry exists.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, loaded_at = entry
+                age = now - loaded_at
+                if age < self.hard_ttl:
+                    self._entries.move_to_end(key)
+                    if age < self.soft_ttl:
+                        self.hits += 1
+                        return CachedValue(value, age, False)
+                    self.stale_hits += 1
+                    failed_at = self._failed_at.get(key)
+                    if failed_at is None or now - failed_at >= self.retry_after:
+                        self._refresh_in_background(key, loader)
+                    return CachedValue(value, age, True)
+            self.misses += 1
+            future, leader = self._join(key)
+
+        if leader:
+            self._load(key, loader, future)
+        value = future.result()
+        return CachedValue(value, 0.0, False)
+
+    def _join(self, key):
+        # Caller holds the lock. Returns the in-flight load for ``key`` and
+        # whether the caller has to perform it.
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future, False
+        future = Future()
+        self._inflight[key] = future
+        return future, True
+
+    def _load(self, key, loader, future):
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if key in self._entries:
+                    self._failed_at[key] = self._clock()
+            future.set_exception(e)
+            return
+        with self._lock:
+            self._failed_at.pop(key, None)
+            self._entries[key] = (value, self._clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                evicted, _ = self._entries.popitem(last=False)
+                self._failed_at.pop(evicted, None)
+            self._inflight.pop(key, None)
+        future.set_result(value)
+
+    def _refresh_in_background(self, key, loader):
+        # Caller holds the lock
+        if key in self._inflight:
+            self.coalesced += 1
+            return
+        future = Future()
+        self._inflight[key] = future
+        self.refreshes += 1
+
+        def refresh():
+            self._load(key, loader, future)
+            if future.exception() is not None:
+                with self._lock:
+                    self.refresh_errors += 1
+
+        threading.Thread(target=refresh, name="swr-refresh", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "soft_ttl": self.soft_ttl,
+                "hard_ttl": self.hard_ttl,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+@pytest.fixture
+def import_service(monkeypatch):
+    """
+    Make a service's modules importable, e.g. ``import_service("sales_service")``
+    before ``from app import create_app``.
+
+    All services have modules named ``app``, ``db``, ``models`` and so on, so
+    the modules of any service imported earlier are dropped first.
+    """
+    def load(name):
+        for module_name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None) or ""
+            if os.path.basename(os.path.dirname(path)).endswith("_service"):
+                del sys.modules[module_name]
+        monkeypatch.syspath_prepend(os.path.abspath(os.path.join(ROOT, name)))
+
+    return load
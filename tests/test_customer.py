@@ -133,3 +133,322 @@ def test_deduct_wallet():
     response = requests.post(f"{BASE_URL}/customers/non_existing_user/deduct", json=deduct_data)
     assert response.status_code == 404
     assert response.json()["error"] == "Customer not found"
+
+def test_cached_customer_reflects_wallet_changes():
+    """Test that cached customer profiles never serve a stale wallet balance."""
+    register_data = {"username": "cache_customer", "password": "cache_password"}
+    requests.post(f"{BASE_URL}/customers", json=register_data)
+
+    # Warm the cache
+    balance = requests.get(f"{BASE_URL}/customers/cache_customer").json()["wallet_balance"]
+    requests.get(f"{BASE_URL}/customers/cache_customer")
+
+    requests.post(f"{BASE_URL}/customers/cache_customer/charge", json={"amount": 25.0})
+    response = requests.get(f"{BASE_URL}/customers/cache_customer")
+    assert response.json()["wallet_balance"] == balance + 25.0
+
+    requests.post(f"{BASE_URL}/customers/cache_customer/deduct", json={"amount": 5.0})
+    response = requests.get(f"{BASE_URL}/customers/cache_customer")
+    assert response.json()["wallet_balance"] == balance + 20.0
+
+def test_cache_stats():
+    """Test fetching the customer cache counters."""
+    response = requests.get(f"{BASE_URL}/cache/stats")
+    assert response.status_code == 200
+    stats = response.json()
+    for counter in ("hits", "misses", "evictions"):
+        assert counter in stats
+
+def test_create_app_in_process():
+    """Test running the service in-process on an in-memory SQLite database."""
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "customer_service"))
+    from app import create_app
+    from config import TestingConfig
+
+    client = create_app(TestingConfig).test_client()
+    response = client.post("/customers", json={
+        "full_name": "In Process",
+        "username": "in_process",
+        "password": "secret",
+        "age": 30,
+        "address": "Beirut",
+        "gender": "F",
+        "marital_status": "Single",
+    })
+    assert response.status_code == 201
+    assert client.get("/customers/in_process").json["username"] == "in_process"
+
+def test_read_replica_routing(tmp_path):
+    """Test that read-only routes use the replica and profile reads stay on the primary."""
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "customer_service"))
+    from app import create_app
+    from db import db
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'primary.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {"replica": f"sqlite:///{tmp_path / 'replica.db'}"},
+        "CREATE_SCHEMA": True,
+    })
+    with app.app_context():
+        db.metadata.create_all(db.engines["replica"])
+    client = app.test_client()
+    client.post("/customers", json={
+        "full_name": "Primary Only",
+        "username": "primary_only",
+        "password": "secret",
+        "age": 30,
+        "address": "Beirut",
+        "gender": "M",
+        "marital_status": "Single",
+    })
+
+    # The replica file never receives the write, so the listing is empty
+    assert client.get("/customers").json == []
+    assert client.get("/customers/primary_only").status_code == 200
+    status = client.get("/db/replica").json
+    assert status["configured"] is True
+    assert status["reads"] == 1
+
+def test_update_customer_if_match():
+    """Test optimistic concurrency on customer updates with ETag and If-Match."""
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "customer_service"))
+    from app import create_app
+    from config import TestingConfig
+
+    client = create_app(TestingConfig).test_client()
+    client.post("/customers", json={
+        "full_name": "Two Admins",
+        "username": "two_admins",
+        "password": "secret",
+        "age": 40,
+        "address": "Beirut",
+        "gender": "M",
+        "marital_status": "Married",
+    })
+    etag = client.get("/customers/two_admins").headers["ETag"]
+
+    # Both admins read the same version; only the first update applies
+    first = client.put("/customers/two_admins", json={"address": "Tripoli"}, headers={"If-Match": etag})
+    second = client.put("/customers/two_admins", json={"address": "Sidon"}, headers={"If-Match": etag})
+    assert first.status_code == 200
+    assert second.status_code == 412
+    response = client.get("/customers/two_admins")
+    assert response.json["address"] == "Tripoli"
+    assert response.headers["ETag"] == first.headers["ETag"]
+
+    # Wallet movements change the ETag but not the version checked by If-Match
+    client.post("/customers/two_admins/charge", json={"amount": 10.0})
+    assert client.get("/customers/two_admins").headers["ETag"] != first.headers["ETag"]
+    response = client.put("/customers/two_admins", json={"address": "Tyre"},
+                          headers={"If-Match": first.headers["ETag"]})
+    assert response.status_code == 200
+
+def test_wallet_ledger(tmp_path):
+    """Test idempotent wallet movements, concurrent deductions and compaction."""
+    import os
+    import sys
+    import threading
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "customer_service"))
+    from app import create_app
+    from wallet import compact, current
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'customers.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {"connect_args": {"timeout": 30}},
+        "SQLALCHEMY_BINDS": {},
+        "CREATE_SCHEMA": True,
+    })
+    client = app.test_client()
+    client.post("/customers", json={
+        "full_name": "Ledger Customer",
+        "username": "ledger_customer",
+        "password": "secret",
+        "age": 35,
+        "address": "Beirut",
+        "gender": "F",
+        "marital_status": "Single",
+        "wallet_balance": 30.0,
+    })
+
+    # Retrying an operation does not charge twice; reusing its id elsewhere fails
+    first = client.post("/customers/ledger_customer/charge", json={"amount": 20.0, "operation_id": "op-1"})
+    retry = client.post("/customers/ledger_customer/charge", json={"amount": 20.0, "operation_id": "op-1"})
+    assert first.json["balance"] == retry.json["balance"] == 50.0
+    assert retry.json["duplicate"] is True
+    response = client.post("/customers/ledger_customer/deduct", json={"amount": 20.0, "operation_id": "op-1"})
+    assert response.status_code == 409
+
+    # 20 concurrent deductions of 5 from 50: exactly 10 succeed
+    statuses = []
+    def deduct():
+        statuses.append(app.test_client().post("/customers/ledger_customer/deduct", json={"amount": 5.0}).status_code)
+    threads = [threading.Thread(target=deduct) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(statuses) == [200] * 10 + [400] * 10
+    assert client.get("/customers/ledger_customer").json["wallet_balance"] == 0.0
+
+    history = client.get("/customers/ledger_customer/wallet?limit=5").json
+    assert [entry["kind"] for entry in history["entries"]] == ["deduct"] * 5
+    assert history["next_before"] == history["entries"][-1]["seq"]
+
+    with app.app_context():
+        before = current(1)
+        assert compact() == 1
+        assert current(1) == before
+        assert compact() == 0
+
+
+def test_reregistered_customer_starts_with_a_new_wallet(tmp_path, import_service):
+    """Test that a customer registered after a deletion neither reuses the id nor inherits the ledger."""
+    import_service("customer_service")
+    from app import create_app
+    from db import db
+    from models import Customer, WalletEntry
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'customers.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+        "CREATE_SCHEMA": True,
+    })
+    client = app.test_client()
+    customer = {
+        "full_name": "Returning Customer",
+        "username": "returning_customer",
+        "password": "secret",
+        "age": 41,
+        "address": "Tripoli",
+        "gender": "M",
+        "marital_status": "Married",
+        "wallet_balance": 30.0,
+    }
+    assert client.post("/customers", json=customer).status_code == 201
+    client.post("/customers/returning_customer/charge", json={"amount": 5.0})
+    with app.app_context():
+        first_id = Customer.query.filter_by(username="returning_customer").one().id
+    assert client.delete("/customers/returning_customer").status_code == 200
+    with app.app_context():
+        assert WalletEntry.query.filter_by(customer_id=first_id).count() == 0
+
+    assert client.post("/customers", json=dict(customer, wallet_balance=10.0)).status_code == 201
+    with app.app_context():
+        assert Customer.query.filter_by(username="returning_customer").one().id != first_id
+    assert client.get("/customers/returning_customer").json["wallet_balance"] == 10.0
+
+    # An opening entry whose operation id is taken is a conflict, not a server error
+    with app.app_context():
+        next_id = db.session.scalar(db.select(db.func.max(Customer.id))) + 1
+        db.session.add(WalletEntry(customer_id=0, amount=1.0, kind="open", operation_id=f"open-{next_id}"))
+        db.session.commit()
+    response = client.post("/customers", json=dict(customer, username="another_customer"))
+    assert response.status_code == 409
+    assert client.get("/customers/another_customer").status_code == 404
+
+
+def test_migrations_create_the_schema(tmp_path, import_service):
+    """Test that upgrading an empty database creates the schema of the models."""
+    import_service("customer_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'customers.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context(), db.engine.connect() as connection:
+        assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+
+
+def test_migrations_upgrade_a_database_created_before_them(tmp_path, import_service):
+    """Test that the migrations bring a database created by the original init-db up to date."""
+    import sqlite3
+    import_service("customer_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+
+    path = tmp_path / "customers.db"
+    connection = sqlite3.connect(path)
+    connection.execute("""
+        CREATE TABLE customer (
+            id INTEGER NOT NULL, full_name VARCHAR(100) NOT NULL, username VARCHAR(50) NOT NULL,
+            password VARCHAR(100) NOT NULL, age INTEGER NOT NULL, address VARCHAR(200) NOT NULL,
+            gender VARCHAR(10) NOT NULL, marital_status VARCHAR(20) NOT NULL, wallet_balance FLOAT,
+            is_admin BOOLEAN, PRIMARY KEY (id), UNIQUE (username)
+        )
+    """)
+    connection.execute("""
+        INSERT INTO customer VALUES (1, 'Old Customer', 'old_customer', 'secret', 52, 'Saida', 'F',
+                                     'Married', 25.0, 0)
+    """)
+    connection.commit()
+    connection.close()
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context(), db.engine.connect() as connection:
+        assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+
+    client = app.test_client()
+    customer = client.get("/customers/old_customer").json
+    assert customer["wallet_balance"] == 25.0
+    assert customer["version"] == 1
+    assert client.post("/customers/old_customer/charge", json={"amount": 5.0}).status_code == 200
+    assert client.get("/customers/old_customer").json["wallet_balance"] == 30.0
+
+
+def test_writes_invalidate_the_cached_profile(import_service):
+    """Test that writes drop the cached profile after committing instead of caching their own copy."""
+    import_service("customer_service")
+    import app as customers
+    from config import TestingConfig
+
+    client = customers.create_app(TestingConfig).test_client()
+    client.post("/customers", json={
+        "full_name": "Cached Customer",
+        "username": "cached_customer",
+        "password": "secret",
+        "age": 35,
+        "address": "Byblos",
+        "gender": "F",
+        "marital_status": "Single",
+        "wallet_balance": 10.0,
+    })
+    assert client.get("/customers/cached_customer").json["wallet_balance"] == 10.0
+    assert customers.customer_cache.get("cached_customer") is not None
+
+    # A read that started before the charge must not cache what it read
+    token = customers.customer_cache.reserve("cached_customer")
+    stale = client.get("/customers/cached_customer").json
+    response = client.post("/customers/cached_customer/charge", json={"amount": 5.0})
+    assert response.json["balance"] == 15.0
+    assert customers.customer_cache.get("cached_customer") is None
+    customers.customer_cache.fill("cached_customer", stale, token)
+    assert client.get("/customers/cached_customer").json["wallet_balance"] == 15.0
+
+    assert client.put("/customers/cached_customer", json={"username": "renamed_customer"}).status_code == 200
+    assert customers.customer_cache.get("cached_customer") is None
+    assert customers.customer_cache.get("renamed_customer") is None
+    assert client.get("/customers/cached_customer").status_code == 404
+    assert client.get("/customers/renamed_customer").json["wallet_balance"] == 15.0
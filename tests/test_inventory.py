@@ -1,3 +1,4 @@
+import pytest
 import requests
 
 BASE_URL = "http://localhost:5002"
@@ -66,3 +67,375 @@ def test_delete_product():
     response = requests.get(f"{BASE_URL}/inventory/{product_id}")
     assert response.status_code == 404
     assert response.json()["error"] == "Product not found"
+
+@pytest.fixture
+def inventory_app(import_service):
+    """The inventory app in-process on an in-memory SQLite database."""
+    import_service("inventory_service")
+    from app import create_app
+    from config import TestingConfig
+
+    return create_app(TestingConfig)
+
+
+def add_product(client, name, count_in_stock=3, price_per_item=10.0):
+    """Add a product through the API and return its ID."""
+    response = client.post("/inventory", json={
+        "name": name,
+        "category": "Electronics",
+        "price_per_item": price_per_item,
+        "count_in_stock": count_in_stock,
+    })
+    assert response.status_code == 201
+    return next(product["id"] for product in client.get("/inventory").json if product["name"] == name)
+
+
+def test_change_feed(inventory_app):
+    """Test that product writes are published on the change feed in order."""
+    client = inventory_app.test_client()
+    assert client.get("/inventory/changes").json == {"changes": [], "last_seq": 0, "head_seq": 0}
+
+    product_id = add_product(client, "Feed Product")
+    assert client.put(f"/inventory/{product_id}", json={"price_per_item": 12.5}).status_code == 200
+    other_id = add_product(client, "Other Product")
+    assert client.delete(f"/inventory/{product_id}").status_code == 200
+
+    feed = client.get("/inventory/changes").json
+    changes = feed["changes"]
+    assert [(change["product_id"], change["operation"]) for change in changes] == [
+        (product_id, "upsert"), (product_id, "upsert"), (other_id, "upsert"), (product_id, "delete"),
+    ]
+    assert [change["seq"] for change in changes] == sorted(change["seq"] for change in changes)
+    assert changes[0]["data"]["price_per_item"] == 10.0
+    assert changes[1]["data"]["price_per_item"] == 12.5
+    assert changes[3]["data"] is None
+    assert feed["last_seq"] == feed["head_seq"] == changes[-1]["seq"]
+
+    # Consumers page through the feed with the previous page's last_seq
+    page = client.get("/inventory/changes", query_string={"since": changes[0]["seq"], "limit": 2}).json
+    assert [change["seq"] for change in page["changes"]] == [changes[1]["seq"], changes[2]["seq"]]
+    assert page["last_seq"] == changes[2]["seq"]
+    page = client.get("/inventory/changes", query_string={"since": page["last_seq"], "limit": 2}).json
+    assert [change["seq"] for change in page["changes"]] == [changes[3]["seq"]]
+    page = client.get("/inventory/changes", query_string={"since": page["last_seq"]}).json
+    assert page["changes"] == [] and page["last_seq"] == changes[3]["seq"]
+
+    assert client.get("/inventory/changes", query_string={"since": -1}).status_code == 400
+    assert client.get("/inventory/changes", query_string={"limit": 5001}).status_code == 400
+
+def test_snapshot(inventory_app):
+    """Test that the snapshot plus the changes after its head_seq rebuild the catalog."""
+    client = inventory_app.test_client()
+    kept_id = add_product(client, "Kept Product")
+    deleted_id = add_product(client, "Deleted Product")
+
+    snapshot = client.get("/inventory/snapshot").json
+    assert snapshot["head_seq"] == client.get("/inventory/changes").json["head_seq"]
+    assert sorted(product["id"] for product in snapshot["products"]) == [kept_id, deleted_id]
+
+    client.put(f"/inventory/{kept_id}", json={"count_in_stock": 9})
+    client.delete(f"/inventory/{deleted_id}")
+    added_id = add_product(client, "Added Product")
+
+    catalog = {product["id"]: product for product in snapshot["products"]}
+    for change in client.get("/inventory/changes", query_string={"since": snapshot["head_seq"]}).json["changes"]:
+        if change["operation"] == "delete":
+            catalog.pop(change["product_id"], None)
+        else:
+            catalog[change["product_id"]] = change["data"]
+    assert catalog == {product["id"]: product for product in client.get("/inventory").json}
+    assert sorted(catalog) == [kept_id, added_id]
+    assert catalog[kept_id]["count_in_stock"] == 9
+
+def test_expired_deadline_is_rejected(inventory_app):
+    """Test that a request whose caller's deadline has passed is dropped without running."""
+    import time
+
+    client = inventory_app.test_client()
+    response = client.get("/inventory", headers={"X-Request-Deadline": "1000"})
+    assert response.status_code == 504
+    assert response.json["error"] == "Deadline exceeded"
+
+    response = client.post("/inventory", headers={"X-Request-Deadline": "1000"}, json={
+        "name": "Late Product", "category": "Electronics", "price_per_item": 1.0, "count_in_stock": 1,
+    })
+    assert response.status_code == 504
+    assert client.get("/inventory").json == []
+
+    # A deadline still ahead, or one that cannot be read, lets the request run
+    ahead = str(int((time.time() + 60) * 1000))
+    assert client.get("/inventory", headers={"X-Request-Deadline": ahead}).status_code == 200
+    assert client.get("/inventory", headers={"X-Request-Deadline": "soon"}).status_code == 200
+
+def test_get_all_products_msgpack(inventory_app, monkeypatch):
+    """Test that the catalog can be negotiated as MessagePack, and is JSON otherwise."""
+    msgpack = pytest.importorskip("msgpack")
+    import codec
+
+    client = inventory_app.test_client()
+    add_product(client, "Packed Product")
+    expected = client.get("/inventory").json
+
+    response = client.get("/inventory", headers={"Accept": "application/msgpack"})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/msgpack"
+    assert "Accept" in response.headers["Vary"]
+    assert msgpack.unpackb(response.data, raw=False) == expected
+
+    # Clients that rank JSON higher, and servers without msgpack, answer JSON
+    response = client.get("/inventory", headers={"Accept": "application/msgpack;q=0.5, application/json"})
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json == expected
+    monkeypatch.setattr(codec, "msgpack", None)
+    response = client.get("/inventory", headers={"Accept": codec.ACCEPT_MSGPACK})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json == expected
+
+def test_get_all_products_gzip():
+    """Test that large list responses are compressed when the client accepts gzip."""
+    for i in range(20):
+        requests.post(f"{BASE_URL}/inventory", json={
+            "name": f"Bulk Product {i}",
+            "category": "Electronics",
+            "price_per_item": 10.0,
+            "description": "Padding to push the catalog over the compression threshold",
+            "count_in_stock": 1,
+        })
+    response = requests.get(f"{BASE_URL}/inventory", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert isinstance(response.json(), list)
+
+    response = requests.get(f"{BASE_URL}/inventory", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+
+def test_trace_propagation(import_service):
+    """Test that a request continues the caller's trace and records its DB spans."""
+    import_service("inventory_service")
+    from app import create_app
+    from config import TestingConfig
+
+    class Config(TestingConfig):
+        TRACE_SAMPLE_RATE = 1.0
+
+    client = create_app(Config).test_client()
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    response = client.get("/inventory", headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"})
+    assert response.status_code == 200
+    assert response.headers["traceparent"].startswith(f"00-{trace_id}-")
+
+    spans = client.get(f"/traces/{trace_id}").json
+    server = next(span for span in spans if span["kind"] == "server")
+    assert server["parent_id"] == "00f067aa0ba902b7"
+    assert server["name"] == "GET /inventory"
+    assert any(span["kind"] == "db" and span["parent_id"] == server["span_id"] for span in spans)
+
+    # An unsampled caller is not traced here either
+    unsampled = "0af7651916cd43dd8448eb211c80319c"
+    response = client.get("/inventory", headers={"traceparent": f"00-{unsampled}-b7ad6b7169203331-00"})
+    assert "traceparent" not in response.headers
+    assert client.get(f"/traces/{unsampled}").status_code == 404
+
+    response = client.get(f"/traces/{'0' * 32}")
+    assert response.status_code == 404
+    assert response.json["error"] == "Trace not found"
+
+def test_traces_are_not_served_by_default(inventory_app):
+    """Test that without a sample rate only callers' sampled traces are recorded, and none are served."""
+    from tracing import InMemoryExporter
+
+    client = inventory_app.test_client()
+    assert "traceparent" not in client.get("/inventory").headers
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    response = client.get("/inventory", headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"})
+    assert response.headers["traceparent"].startswith(f"00-{trace_id}-")
+    response = client.get(f"/traces/{trace_id}")
+    assert response.status_code == 404
+    assert "error" not in (response.json or {})
+
+    exporter = InMemoryExporter(max_traces=2, max_spans_per_trace=3)
+    for trace in ("a", "b", "c"):
+        for span_id in range(5):
+            exporter.export({"trace_id": trace, "span_id": span_id})
+    assert exporter.trace_ids() == ["b", "c"]
+    assert [span["span_id"] for span in exporter.get_trace("c")] == [0, 1, 2]
+    assert exporter.dropped_spans == 6
+
+def test_decrement_stock(import_service, tmp_path, monkeypatch):
+    """Test taking units out of stock, including concurrent, conflicting and oversized requests."""
+    from concurrent.futures import ThreadPoolExecutor
+    import_service("inventory_service")
+    import app as inventory
+    from config import TestingConfig
+    from db import db
+    from models import Product
+
+    class Config(TestingConfig):
+        # A file, so that concurrent requests get their own connections
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'inventory.db'}"
+
+    app = inventory.create_app(Config)
+    client = app.test_client()
+    product_id = add_product(client, "Hot Product", count_in_stock=5, price_per_item=5.0)
+
+    def decrement(quantity):
+        return app.test_client().post(f"/inventory/{product_id}/decrement", json={"quantity": quantity})
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(decrement, [1] * 8))
+    assert sorted(response.status_code for response in responses) == [200] * 5 + [400] * 3
+    assert all(response.json == {"error": "Insufficient stock", "count_in_stock": 0}
+               for response in responses if response.status_code == 400)
+    assert client.get(f"/inventory/{product_id}").json["count_in_stock"] == 0
+
+    # A writer that restocks between the read and the UPDATE makes the
+    # conditional UPDATE miss; the batch is retried on the new stock
+    get = db.session.get
+
+    def get_then_restock(*args, **kwargs):
+        product = get(*args, **kwargs)
+        if not inventory.stock_combiner.conflicts:
+            with db.engine.begin() as connection:
+                connection.execute(db.update(Product).where(Product.id == product_id).values(count_in_stock=10))
+        return product
+
+    client.put(f"/inventory/{product_id}", json={"count_in_stock": 4})
+    monkeypatch.setattr(db.session, "get", get_then_restock)
+    response = decrement(3)
+    monkeypatch.undo()
+    assert response.status_code == 200
+    assert response.json["count_in_stock"] == 7
+    assert inventory.stock_combiner.stats()["conflicts"] == 1
+
+    response = decrement(8)
+    assert response.status_code == 400
+    assert response.json == {"error": "Insufficient stock", "count_in_stock": 7}
+    assert decrement(0).status_code == 400
+    assert decrement(True).status_code == 400
+    response = client.post("/inventory/999999/decrement", json={"quantity": 1})
+    assert response.status_code == 404
+    assert client.get(f"/inventory/{product_id}").json["count_in_stock"] == 7
+
+def test_update_product_if_match(inventory_app):
+    """Test that a PUT with a stale If-Match version is rejected with 412, and every write bumps the version."""
+    client = inventory_app.test_client()
+    product_id = add_product(client, "Versioned Product", count_in_stock=5)
+
+    response = client.get(f"/inventory/{product_id}")
+    etag = response.headers["ETag"]
+    assert etag == '"1"'
+    response = client.get(f"/inventory/{product_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = client.put(f"/inventory/{product_id}", json={"price_per_item": 12.5}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"2"'
+    assert client.get(f"/inventory/{product_id}").json["version"] == 2
+
+    # A second writer still holding the old version loses
+    response = client.put(f"/inventory/{product_id}", json={"price_per_item": 99.0}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert client.get(f"/inventory/{product_id}").json["price_per_item"] == 12.5
+
+    # So does one whose version a sale has moved on
+    assert client.post(f"/inventory/{product_id}/decrement", json={"quantity": 1}).status_code == 200
+    response = client.put(f"/inventory/{product_id}", json={"count_in_stock": 10}, headers={"If-Match": '"2"'})
+    assert response.status_code == 412
+    response = client.put(f"/inventory/{product_id}", json={"count_in_stock": 10}, headers={"If-Match": '"3"'})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"4"'
+
+    # Without If-Match the update is unconditional, and still bumps the version
+    response = client.put(f"/inventory/{product_id}", json={"description": "Updated"})
+    assert response.headers["ETag"] == '"5"'
+    product = client.get(f"/inventory/{product_id}").json
+    assert (product["count_in_stock"], product["version"]) == (10, 5)
+
+    response = client.put("/inventory/999999", json={"price_per_item": 1.0}, headers={"If-Match": '"1"'})
+    assert response.status_code == 404
+    assert client.put("/inventory/999999", json={"price_per_item": 1.0}).status_code == 404
+    assert client.put(f"/inventory/{product_id}", json={"version": 1}).status_code == 400
+
+
+def test_stock_combiner_uses_a_fixed_set_of_commit_locks(import_service):
+    """Test that decrements of many products share the combiner's striped commit locks."""
+    import_service("inventory_service")
+    from app import create_app
+    from combiner import GRANTED, INSUFFICIENT, StockCombiner
+    from config import TestingConfig
+    from db import db
+    from models import Product
+
+    app = create_app(TestingConfig)
+    combiner = StockCombiner(window=0, commit_stripes=4)
+    with app.app_context():
+        db.session.add_all([
+            Product(id=i, name=f"Product {i}", category="Test", price_per_item=1.0, count_in_stock=1)
+            for i in range(1, 51)
+        ])
+        db.session.commit()
+        for i in range(1, 51):
+            assert combiner.decrement(i, 1) == (GRANTED, 0)
+        assert combiner.decrement(1, 1) == (INSUFFICIENT, 0)
+    assert len(combiner._commit_locks) == 4
+    assert combiner.stats()["commit_stripes"] == 4
+    assert combiner.stats()["decrements"] == 51
+
+
+def test_migrations_create_the_schema(tmp_path, import_service):
+    """Test that upgrading an empty database creates the schema of the models."""
+    import_service("inventory_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'inventory.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context(), db.engine.connect() as connection:
+        assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+
+
+def test_migrations_upgrade_a_database_created_before_them(tmp_path, import_service):
+    """Test that the migrations bring a database created by the original init-db up to date."""
+    import sqlite3
+    import_service("inventory_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+
+    path = tmp_path / "inventory.db"
+    connection = sqlite3.connect(path)
+    connection.execute("""
+        CREATE TABLE product (
+            id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, category VARCHAR(50) NOT NULL,
+            price_per_item FLOAT NOT NULL, description VARCHAR(200), count_in_stock INTEGER NOT NULL,
+            PRIMARY KEY (id)
+        )
+    """)
+    connection.execute("INSERT INTO product VALUES (1, 'Old Product', 'Test', 2.5, NULL, 4)")
+    connection.commit()
+    connection.close()
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context(), db.engine.connect() as connection:
+        assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+
+    client = app.test_client()
+    response = client.put("/inventory/1", json={"count_in_stock": 3}, headers={"If-Match": '"1"'})
+    assert response.status_code == 200
+    assert client.get("/inventory/1").json["version"] == 2
+    assert [change["product_id"] for change in client.get("/inventory/changes").json["changes"]] == [1]
@@ -1,4 +1,6 @@
+import pytest
 import requests
+from unittest.mock import MagicMock
 
 BASE_URL = "http://localhost:5004"
 
@@ -162,3 +164,482 @@ def test_moderate_review_unauthorized():
     response = requests.post(f"{BASE_URL}/reviews/1/moderate", json=admin_data)
     assert response.status_code == 403
     assert response.json()["message"] == "Unauthorized"
+
+ACCOUNTS = {"admin": ("adminpassword", 1), "testuser": ("testpassword", 2)}
+
+
+def downstream_response(status_code, body=None):
+    response = MagicMock(status_code=status_code, headers={"Content-Type": "application/json"})
+    response.json.return_value = body
+    return response
+
+
+@pytest.fixture
+def reviews_app(import_service, monkeypatch):
+    """The reviews app in-process on SQLite, with stub customer and inventory services."""
+    import_service("reviews_service")
+    import app as reviews
+    from config import TestingConfig
+
+    def authenticate(path, json=None, **kwargs):
+        password, customer_id = ACCOUNTS.get(json["username"], (None, None))
+        if password is None or json["password"] != password:
+            return downstream_response(401, {"error": "Invalid credentials"})
+        return downstream_response(200, {"id": customer_id, "username": json["username"]})
+
+    app = reviews.create_app(TestingConfig)
+    monkeypatch.setattr(app.extensions["customers_client"], "post", authenticate)
+    monkeypatch.setattr(app.extensions["inventory_client"], "get", lambda path, **kwargs: downstream_response(200, {}))
+    return reviews, app
+
+
+def add_reviews(app, *reviews):
+    """Store reviews given as ``(customer_id, product_id, created_at, moderated)``; return their ids."""
+    from db import db
+    from models import Review
+
+    with app.app_context():
+        rows = [
+            Review(customer_id=customer_id, product_id=product_id, rating=3, comment="ok",
+                   created_at=created_at, moderated=moderated)
+            for customer_id, product_id, created_at, moderated in reviews
+        ]
+        db.session.add_all(rows)
+        db.session.commit()
+        return [row.id for row in rows]
+
+
+def test_get_unmoderated_reviews(reviews_app):
+    """Test paging through the moderation queue oldest first."""
+    import datetime
+    _, app = reviews_app
+    client = app.test_client()
+    day = datetime.datetime(2024, 5, 1)
+    newest, tied_second, moderated, tied_first = add_reviews(
+        app,
+        (1, 1, day + datetime.timedelta(hours=2), False),
+        (2, 1, day, False),
+        (3, 1, day - datetime.timedelta(hours=1), True),
+        (4, 1, day, False),
+    )
+    # Reviews created at the same time are queued by id
+    tied_first, tied_second = sorted([tied_first, tied_second])
+
+    response = client.get("/reviews/unmoderated", query_string={"limit": 2})
+    assert response.status_code == 200
+    page = response.json
+    assert [review["id"] for review in page["reviews"]] == [tied_first, tied_second]
+    assert page["next_cursor"]
+
+    response = client.get("/reviews/unmoderated", query_string={"limit": 2, "cursor": page["next_cursor"]})
+    assert response.status_code == 200
+    assert [review["id"] for review in response.json["reviews"]] == [newest]
+    assert response.json["next_cursor"] is None
+    assert moderated not in [review["id"] for review in page["reviews"] + response.json["reviews"]]
+
+    response = client.get("/reviews/unmoderated", query_string={"limit": 0})
+    assert response.status_code == 400
+
+
+def test_get_unmoderated_reviews_invalid_cursor(reviews_app):
+    """Test the moderation queue with a malformed cursor."""
+    _, app = reviews_app
+    response = app.test_client().get("/reviews/unmoderated", query_string={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+    assert response.json["error"] == "Invalid cursor"
+
+
+def test_bulk_moderate_reviews(reviews_app):
+    """Test moderating several reviews in one request."""
+    import datetime
+    _, app = reviews_app
+    client = app.test_client()
+    now = datetime.datetime(2024, 5, 1)
+    first, second, third = add_reviews(app, (1, 1, now, False), (2, 1, now, False), (3, 1, now, False))
+
+    response = client.post("/reviews/moderate", json={
+        "username": "admin",
+        "password": "adminpassword",
+        "review_ids": [first, second, second, 9999],
+        "moderated": True,
+    })
+    assert response.status_code == 200
+    assert response.json == {"moderated": True, "requested": 3, "updated": 2}
+    queue = client.get("/reviews/unmoderated").json["reviews"]
+    assert [review["id"] for review in queue] == [third]
+
+    response = client.post("/reviews/moderate", json={
+        "username": "admin", "password": "adminpassword", "review_ids": [first], "moderated": False,
+    })
+    assert response.json["updated"] == 1
+    assert [review["id"] for review in client.get("/reviews/unmoderated").json["reviews"]] == [first, third]
+
+    response = client.post("/reviews/moderate", json={
+        "username": "admin", "password": "adminpassword", "review_ids": [first, "2"],
+    })
+    assert response.status_code == 400
+
+
+def test_bulk_moderate_reviews_unauthorized(reviews_app):
+    """Test bulk moderation by an unauthorized user."""
+    import datetime
+    _, app = reviews_app
+    client = app.test_client()
+    (review_id,) = add_reviews(app, (1, 1, datetime.datetime(2024, 5, 1), False))
+
+    for username, password in [("wronguser", "wrongpassword"), ("testuser", "testpassword"),
+                               ("admin", "wrongpassword")]:
+        response = client.post("/reviews/moderate", json={
+            "username": username, "password": password, "review_ids": [review_id],
+        })
+        assert response.status_code == 403
+        assert response.json["message"] == "Unauthorized"
+    assert client.get(f"/reviews/{review_id}").json["moderated"] is False
+
+def test_submit_review_flagged_comment():
+    """Test that a comment containing a banned term is flagged on submission."""
+    review_data = {
+        "product_id": 2,
+        "rating": 1,
+        "username": "testuser",
+        "password": "testpassword",
+        "comment": "Total scam, do not buy"
+    }
+    response = requests.post(f"{BASE_URL}/reviews", json=review_data)
+    assert response.status_code == 201
+    assert response.json()["flagged"] == True
+    assert response.json()["flag_score"] == 1
+
+def test_rescan_reviews_unauthorized():
+    """Test starting a rescan by an unauthorized user."""
+    admin_data = {
+        "username": "wronguser",
+        "password": "wrongpassword",
+        "terms": ["scam"]
+    }
+    response = requests.post(f"{BASE_URL}/reviews/rescan", json=admin_data)
+    assert response.status_code == 403
+    assert response.json()["message"] == "Unauthorized"
+
+def test_search_reviews(reviews_app):
+    """Test that search ranks by TF-IDF over the reviews searched, all or one product's."""
+    import math
+    from db import db
+    from models import Review
+    from search import index_review
+
+    _, app = reviews_app
+    client = app.test_client()
+    comments = {1: ["battery", "screen screen", "screen", "screen", "screen"], 2: ["cable"] * 20}
+    with app.app_context():
+        for product_id, texts in comments.items():
+            for customer_id, comment in enumerate(texts):
+                review = Review(customer_id=customer_id, product_id=product_id, rating=3, comment=comment)
+                db.session.add(review)
+                index_review(review)
+        db.session.commit()
+
+    # Among all 25 reviews, the repeated common term outweighs the rare one...
+    response = client.get("/reviews/search", query_string={"q": "battery screen"})
+    assert response.status_code == 200
+    result = response.json
+    assert result["total"] == 5
+    assert [review["comment"] for review in result["results"][:2]] == ["screen screen", "battery"]
+    assert result["results"][1]["score"] == pytest.approx(math.log(1 + 25 / 1))
+
+    # ...but not among the 5 reviews of product 1
+    response = client.get("/reviews/search", query_string={"q": "battery screen", "product_id": 1})
+    result = response.json
+    assert result["total"] == 5
+    assert [review["comment"] for review in result["results"][:2]] == ["battery", "screen screen"]
+    assert result["results"][0]["score"] == pytest.approx(math.log(1 + 5 / 1))
+    assert result["results"][1]["score"] == pytest.approx(2 * math.log(1 + 5 / 4))
+    scores = [review["score"] for review in result["results"]]
+    assert scores == sorted(scores, reverse=True)
+
+    response = client.get("/reviews/search", query_string={"q": "battery", "product_id": 2})
+    assert response.json == {"query": "battery", "total": 0, "results": []}
+    response = client.get("/reviews/search", query_string={"q": "screen", "product_id": 1, "limit": 2, "offset": 3})
+    assert [review["comment"] for review in response.json["results"]] == ["screen"]
+
+def test_search_reviews_missing_query(reviews_app):
+    """Test searching without a query."""
+    _, app = reviews_app
+    response = app.test_client().get("/reviews/search")
+    assert response.status_code == 400
+    assert response.json["error"] == "Missing search query"
+
+def test_submit_review_duplicate():
+    """Test that a customer cannot post a second review for the same product."""
+    review_data = {
+        "product_id": 1,
+        "rating": 3,
+        "username": "testuser",
+        "password": "testpassword",
+        "comment": "Second opinion"
+    }
+    response = requests.post(f"{BASE_URL}/reviews", json=review_data)
+    assert response.status_code == 409
+    assert response.json()["error"] == "Customer has already reviewed this product"
+
+def test_submit_review_upsert():
+    """Test replacing an existing review in upsert mode."""
+    review_data = {
+        "product_id": 1,
+        "rating": 2,
+        "username": "testuser",
+        "password": "testpassword",
+        "comment": "Changed my mind",
+        "upsert": True
+    }
+    response = requests.post(f"{BASE_URL}/reviews", json=review_data)
+    assert response.status_code in (200, 201)
+    review = response.json()
+    assert review["rating"] == 2
+    assert review["comment"] == "Changed my mind"
+    assert review["moderated"] == False
+
+    # Upserting again updates the same review
+    review_data["rating"] = 3
+    response = requests.post(f"{BASE_URL}/reviews", json=review_data)
+    assert response.status_code == 200
+    assert response.json()["id"] == review["id"]
+    assert response.json()["rating"] == 3
+
+def test_rating_distribution_report(tmp_path, import_service):
+    """Test submitting, polling and caching the rating distribution report job."""
+    import datetime
+    import time
+    import_service("reviews_service")
+    from app import create_app
+
+    # The job's process opens the database itself, so it must be a file
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'reviews.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+        "CREATE_SCHEMA": True,
+        "REPORT_JOBS_DIR": str(tmp_path / "jobs"),
+    })
+    day = datetime.datetime(2024, 5, 1)
+    add_reviews(app, (1, 1, day, True), (2, 1, day, False), (1, 2, day, True))
+    client = app.test_client()
+
+    response = client.post("/reports/rating-distribution", json={"product_id": 1})
+    assert response.status_code == 202
+    assert response.json["cached"] is False
+    job_url = response.headers["Location"]
+    assert job_url == f"/reports/jobs/{response.json['id']}"
+    deadline = time.time() + 60
+    job = response.json
+    while job["state"] in ("queued", "running") and time.time() < deadline:
+        time.sleep(0.1)
+        job = client.get(job_url).json
+    assert job["state"] == "finished", job
+    assert job["result"] == {
+        "reviews": 2,
+        "average": 3.0,
+        "histogram": [{"rating": 3, "reviews": 2}],
+        "products": [{"product_id": 1, "reviews": 2, "average": 3.0}],
+    }
+
+    # The same report is served from the cache
+    response = client.post("/reports/rating-distribution", json={"product_id": 1})
+    assert response.status_code == 200
+    assert (response.json["cached"], response.json["id"]) == (True, job["id"])
+    assert client.get("/reports").json["cache_hits"] == 1
+
+    response = client.post("/reports/rating-distribution", json={"product_id": "one"})
+    assert response.status_code == 400
+    assert client.post("/reports/no-such-report").status_code == 404
+    response = client.get(f"/reports/jobs/{'0' * 32}")
+    assert response.status_code == 404
+    assert response.json["error"] == "Job not found"
+    assert client.get(f"/reports/jobs/{'0' * 32}/events").status_code == 404
+
+def test_moderation_state_is_shared_by_workers(tmp_path, import_service, monkeypatch):
+    """Test that the term list and the rescan progress live in the database, not in a worker."""
+    import datetime
+    import_service("reviews_service")
+    import moderation
+    from app import create_app
+    from db import db
+    from models import ModerationRescan, ModerationTerms, Review
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'reviews.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+        "CREATE_SCHEMA": True,
+    })
+    monkeypatch.setattr(moderation, "TERMS_RELOAD_INTERVAL", 0)
+    with app.app_context():
+        db.session.add(Review(customer_id=1, product_id=1, rating=1, comment="a scam and a fraud"))
+        db.session.commit()
+        moderation.set_terms(["scam"])
+
+        # Another worker changes the terms; this one reloads them
+        row = db.session.get(ModerationTerms, 1)
+        row.terms, row.version = '["fraud", "scam"]', row.version + 1
+        db.session.commit()
+        assert moderation.get_matcher().terms == ["fraud", "scam"]
+
+        # Only one rescan runs at a time, whichever worker starts it
+        first = moderation.RescanJob(moderation.get_matcher())
+        second = moderation.RescanJob(moderation.get_matcher())
+        assert first.claim()
+        assert not second.claim()
+        assert moderation.rescan_status()["state"] == "pending"
+        first.run()
+        assert moderation.rescan_status() == {
+            "state": "finished", "terms": 2, "scanned": 1, "changed": 1, "error": None,
+        }
+        assert db.session.get(Review, 1, populate_existing=True).flag_score == 2
+
+        # A rescan whose worker died stops blocking new ones
+        assert second.claim()
+        row = db.session.get(ModerationRescan, 1)
+        row.state = "running"
+        row.heartbeat = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+        db.session.commit()
+        assert moderation.rescan_status()["state"] == "failed"
+        assert first.claim()
+
+def test_rescan_keeps_the_score_of_reviews_edited_meanwhile(tmp_path, import_service, monkeypatch):
+    """Test that a rescan does not overwrite the score of a review whose comment changed since it was read."""
+    import_service("reviews_service")
+    import moderation
+    from app import create_app
+    from db import db
+    from models import Review
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'reviews.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+        "CREATE_SCHEMA": True,
+    })
+    with app.app_context():
+        db.session.add_all([
+            Review(customer_id=1, product_id=1, rating=1, comment="a scam", flag_score=0),
+            Review(customer_id=2, product_id=1, rating=1, comment="a fraud", flag_score=0),
+            Review(customer_id=3, product_id=1, rating=1, comment=None, flagged=True, flag_score=1),
+        ])
+        db.session.commit()
+        matcher = moderation.TermMatcher(["fraud", "scam"])
+        score = matcher.score
+
+        def score_while_edited(text):
+            # The customer edits review 1 while the rescan holds its old comment
+            if text == "a scam":
+                with db.engine.begin() as connection:
+                    connection.execute(db.update(Review).where(Review.id == 1)
+                                       .values(comment="all good", flagged=False, flag_score=0))
+            return score(text)
+
+        monkeypatch.setattr(matcher, "score", score_while_edited)
+        job = moderation.RescanJob(matcher)
+        job.run()
+        assert job.state == "finished", job.error
+        scores = dict(db.session.execute(db.select(Review.id, Review.flag_score)).all())
+        assert scores == {1: 0, 2: 1, 3: 0}
+        assert db.session.get(Review, 1, populate_existing=True).comment == "all good"
+
+
+def test_submit_review_checks_credentials_first(reviews_app):
+    """Test that a review with invalid credentials is refused before anything else is read."""
+    reviews, app = reviews_app
+    response = app.test_client().post("/reviews", json={
+        "product_id": 1, "rating": 4, "username": "wronguser", "password": "wrongpassword",
+    })
+    assert response.status_code == 403
+    assert response.json["message"] == "Unauthorized"
+
+
+def test_upsert_review_reports_insert_or_update(tmp_path, import_service):
+    """Test that the upsert tells an insert from an update without comparing timestamps."""
+    import_service("reviews_service")
+    from app import create_app, upsert_review
+    from db import db
+    from models import Review
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'reviews.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+        "CREATE_SCHEMA": True,
+    })
+    with app.app_context():
+        review, created = upsert_review(Review(customer_id=1, product_id=2, rating=4, comment="good"))
+        db.session.commit()
+        assert created is True
+        created_at = review.created_at
+
+        review, created = upsert_review(Review(customer_id=1, product_id=2, rating=2, comment="meh"))
+        db.session.commit()
+        assert created is False
+        assert (review.rating, review.comment, review.created_at) == (2, "meh", created_at)
+        assert db.session.query(Review).count() == 1
+
+
+def test_migrations_create_the_schema(tmp_path, import_service):
+    """Test that upgrading an empty database creates the schema of the models."""
+    import_service("reviews_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'reviews.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context(), db.engine.connect() as connection:
+        assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+
+
+def test_migrations_keep_the_latest_duplicate_review(tmp_path, import_service):
+    """Test that upgrading a database with duplicate reviews keeps the latest of each before adding the constraint."""
+    import sqlite3
+    import_service("reviews_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+    from models import Review
+
+    path = tmp_path / "reviews.db"
+    connection = sqlite3.connect(path)
+    connection.execute("""
+        CREATE TABLE reviews (
+            id INTEGER NOT NULL, customer_id INTEGER NOT NULL, product_id INTEGER NOT NULL,
+            rating FLOAT NOT NULL, comment VARCHAR(500), moderated BOOLEAN, created_at DATETIME,
+            updated_at DATETIME, PRIMARY KEY (id)
+        )
+    """)
+    connection.executemany("INSERT INTO reviews VALUES (?, ?, ?, ?, ?, 0, ?, ?)", [
+        (1, 1, 1, 2.0, "first try", "2024-01-02 00:00:00", "2024-01-02 00:00:00"),
+        (2, 1, 1, 4.0, "second try", "2024-01-03 00:00:00", "2024-01-03 00:00:00"),
+        (3, 1, 1, 3.0, "undated", None, None),
+        (4, 1, 2, 5.0, "other product", "2024-01-01 00:00:00", "2024-01-01 00:00:00"),
+        (5, 2, 1, 1.0, "other customer", "2024-01-01 00:00:00", "2024-01-01 00:00:00"),
+    ])
+    connection.commit()
+    connection.close()
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+        assert [(review.id, review.flagged) for review in Review.query.order_by(Review.id)] == [
+            (2, False), (4, False), (5, False),
+        ]
@@ -1,3 +1,5 @@
+import json
+import os
 import pytest
 from unittest.mock import patch, MagicMock
 import requests
@@ -136,3 +138,1006 @@ def test_make_sale_insufficient_funds(mock_requests):
     assert response.status_code == 400
     result = response.json()
     assert result["error"] == "Insufficient funds"
+
+
+def inventory_feed(snapshot, changes, failures=0):
+    """
+    Stub of the inventory client's ``get`` serving a snapshot and a change feed.
+
+    The first ``failures`` calls raise, like a bug in the caller would.
+    """
+    calls = []
+
+    def get(path, params=None, **kwargs):
+        calls.append(path)
+        if len(calls) <= failures:
+            raise RuntimeError("unexpected failure")
+        if path == "/inventory/snapshot":
+            return downstream_response(200, snapshot)
+        since, limit = params["since"], params["limit"]
+        page = [change for change in changes if change["seq"] > since][:limit]
+        return downstream_response(200, {
+            "changes": page,
+            "last_seq": page[-1]["seq"] if page else since,
+            "head_seq": changes[-1]["seq"] if changes else snapshot["head_seq"],
+        })
+
+    return get
+
+
+CATALOG_SNAPSHOT = {"head_seq": 2, "products": [
+    {"id": 1, "name": "Laptop", "price_per_item": 10.0, "count_in_stock": 5},
+    {"id": 2, "name": "Phone", "price_per_item": 5.0, "count_in_stock": 1},
+]}
+CATALOG_CHANGES = [
+    {"seq": 3, "product_id": 2, "operation": "upsert",
+     "data": {"id": 2, "name": "Tablet", "price_per_item": 7.0, "count_in_stock": 1}},
+    {"seq": 4, "product_id": 1, "operation": "delete", "data": None},
+    {"seq": 5, "product_id": 3, "operation": "upsert",
+     "data": {"id": 3, "name": "Laptop", "price_per_item": 12.0, "count_in_stock": 2}},
+]
+
+
+def test_catalog_status(sales_app, monkeypatch):
+    """Test that the replica loads the snapshot, applies the feed after it and reports its state."""
+    sales, app = sales_app
+    client = app.test_client()
+    catalog = app.extensions["catalog"]
+    monkeypatch.setattr(app.extensions["inventory_client"], "get", inventory_feed(CATALOG_SNAPSHOT, CATALOG_CHANGES))
+    status = client.get("/catalog/status").json
+    assert (status["fresh"], status["seq"], status["products"]) == (False, None, 0)
+
+    monkeypatch.setattr(catalog, "batch_size", 2)
+    catalog.sync()
+    status = client.get("/catalog/status").json
+    assert (status["fresh"], status["seq"], status["products"], status["applied"]) == (True, 5, 2, 3)
+    assert "hits" in status["inventory_cache"]
+    assert catalog.find_by_name("tablet")["price_per_item"] == 7.0
+    assert catalog.find_by_name("Phone") is None
+    assert catalog.find_by_name("laptop")["id"] == 3
+    assert [product["id"] for product in catalog.all_products()] == [2, 3]
+
+
+def test_catalog_replica_keeps_tailing_after_errors(import_service):
+    """Test that the tailer logs any failed sync, backs off and keeps polling."""
+    import_service("sales_service")
+    from replica import CatalogReplica
+
+    client = MagicMock(get=inventory_feed(CATALOG_SNAPSHOT, CATALOG_CHANGES, failures=3))
+    replica = CatalogReplica(client, poll_interval=0.01, max_backoff=0.04)
+    assert [replica.retry_delay(failures) for failures in range(4)] == [0.01, 0.02, 0.04, 0.04]
+    replica.start()
+    try:
+        wait_for(replica.is_fresh)
+    finally:
+        replica.stop()
+    assert replica.sync_errors == 3
+    assert replica.status()["seq"] == 5
+
+
+def test_downstream_status(sales_app):
+    """Test fetching the call counts, circuit breaker and bulkhead state of the downstream clients."""
+    from resilience import DownstreamUnavailable
+
+    sales, app = sales_app
+    client = app.test_client()
+    status = client.get("/downstreams").json
+    assert set(status) == {"customers", "inventory"}
+    for name in ("customers", "inventory"):
+        assert (status[name]["calls"], status[name]["failures"]) == (0, 0)
+        assert status[name]["circuit_breaker"] == {"state": "closed", "trips": 0, "rejections": 0}
+        assert status[name]["bulkhead"]["in_flight"] == 0
+    assert status["inventory"]["single_flight"]["executed"] == 0
+
+    # Enough failed calls trip the breaker, which then rejects calls unsent
+    customers = app.extensions["customers_client"]
+    with patch.object(customers, "_session") as session:
+        session.return_value.request.side_effect = requests.ConnectionError("refused")
+        for _ in range(sales.BREAKER_FAILURE_THRESHOLD + 1):
+            with pytest.raises(DownstreamUnavailable):
+                customers.get("/customers/alice")
+    status = client.get("/downstreams").json
+    assert (status["customers"]["calls"], status["customers"]["failures"]) == (
+        sales.BREAKER_FAILURE_THRESHOLD, sales.BREAKER_FAILURE_THRESHOLD)
+    assert status["customers"]["circuit_breaker"] == {"state": "open", "trips": 1, "rejections": 1}
+    assert status["inventory"]["circuit_breaker"]["state"] == "closed"
+
+
+def test_sale_writer_status():
+    """Test fetching the state of the write-behind sale writer."""
+    response = requests.get(f"{SALES_URL}/sales/writer")
+    assert response.status_code == 200
+    status = response.json()
+    assert "enabled" in status
+    if status["enabled"]:
+        assert status["pending"] >= 0
+        assert "recovered" in status
+
+
+def test_sales_rollup():
+    """Test the per-product and per-customer totals, which include archived sales."""
+    response = requests.get(f"{SALES_URL}/sales/rollup", params={"by": "customer"})
+    assert response.status_code == 200
+    for row in response.json()["rollup"]:
+        assert row["sales"] >= 1
+        assert row["quantity"] >= row["sales"]
+        assert "customer_id" in row
+
+    assert requests.get(f"{SALES_URL}/sales/rollup", params={"by": "day"}).status_code == 400
+    assert requests.get(f"{SALES_URL}/sales/rollup", params={"start": "yesterday"}).status_code == 400
+
+
+def test_sale_archive_status():
+    """Test fetching the state of the sales archive."""
+    response = requests.get(f"{SALES_URL}/sales/archive")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["segments"] >= 0
+    assert status["rows"] >= 0
+
+
+def test_related_goods(sales_db_app, monkeypatch):
+    """Test the products bought together with a product, once the index is built and after an update."""
+    from db import db
+    from models import Sale
+
+    app = sales_db_app
+    for worker in ("catalog", "co_purchases", "compensator"):
+        monkeypatch.setattr(app.extensions[worker], "start", lambda: None)
+    index = app.extensions["co_purchases"]
+    client = app.test_client()
+
+    def buy(*purchases):
+        with app.app_context():
+            db.session.add_all([
+                Sale(customer_id=customer, product_id=product, quantity=1, total_price=1.0)
+                for customer, product in purchases
+            ])
+            db.session.commit()
+
+    # Product 1 was bought by customers 1 to 3; product 2 by all of them, product 3 by one
+    buy((1, 1), (1, 2), (2, 1), (2, 2), (2, 3), (3, 1), (3, 2), (3, 2), (4, 4))
+    response = client.get("/goods/1/related")
+    assert response.status_code == 503
+    assert client.get("/recommendations/status").json["ready"] is False
+
+    with app.app_context():
+        index.build()
+    response = client.get("/goods/1/related")
+    assert response.status_code == 200
+    assert response.json == {"product_id": 1, "related": [
+        {"product_id": 2, "customers": 3},
+        {"product_id": 3, "customers": 1},
+    ]}
+    assert client.get("/goods/1/related", query_string={"limit": 1}).json["related"] == [
+        {"product_id": 2, "customers": 3}]
+    assert client.get("/goods/4/related").json["related"] == []
+    assert client.get("/goods/99/related").json["related"] == []
+
+    # New sales count once the index is updated
+    buy((4, 1), (4, 3), (5, 3), (5, 1))
+    with app.app_context():
+        index.update()
+    assert [(item["product_id"], item["customers"]) for item in client.get("/goods/1/related").json["related"]] == [
+        (2, 3), (3, 3), (4, 1)]
+    status = client.get("/recommendations/status").json
+    assert status["ready"] is True
+    assert status["customers"] == 5
+
+    for limit in (0, 51):
+        assert client.get("/goods/1/related", query_string={"limit": limit}).status_code == 400
+
+
+def test_revenue_by_category_report(sales_db_app, monkeypatch):
+    """Test submitting the revenue-by-category report job, streaming it and reading its result."""
+    import datetime
+
+    app = sales_db_app
+    for worker in ("catalog", "co_purchases", "compensator"):
+        monkeypatch.setattr(app.extensions[worker], "start", lambda: None)
+    # The catalog replica is not fresh, so the categories come from the inventory service
+    catalog = [{"id": product, "name": f"Product {product}", "category": "Books" if product == 3 else "Electronics",
+                "price_per_item": 1.0, "count_in_stock": 1} for product in range(4)]
+    monkeypatch.setattr(app.extensions["inventory_client"], "get",
+                        MagicMock(return_value=downstream_response(200, catalog)))
+    start = datetime.datetime(2024, 5, 1)
+    add_sales(app, 20, start)
+    # Archived sales count too
+    with app.app_context():
+        assert app.extensions["sale_archive"].archive(start + datetime.timedelta(hours=10)) == 10
+    client = app.test_client()
+
+    response = client.post("/reports/revenue-by-category", json={"end": "2024-05-01T18:00:00"})
+    assert response.status_code == 202
+    job_url = response.headers["Location"]
+    events = client.get(f"{job_url}/events")
+    assert events.status_code == 200
+    assert events.headers["Content-Type"].startswith("text/event-stream")
+    last = events.get_data(as_text=True).strip().split("\n\n")[-1]
+    assert last.startswith("event: result")
+    job = json.loads(last.split("data: ", 1)[1])
+    assert job["state"] == "finished", job
+    assert client.get(job_url).json == job
+
+    expected = {}
+    for i in range(18):
+        category = {3: "Books", 4: "uncategorized"}.get(i % 5, "Electronics")
+        total = expected.setdefault(category, {"sales": 0, "quantity": 0, "revenue": 0.0})
+        total["sales"] += 1
+        total["quantity"] += 1 + i % 3
+        total["revenue"] += 1.25 * (1 + i % 7)
+    assert {row["category"]: {"sales": row["sales"], "quantity": row["quantity"], "revenue": row["revenue"]}
+            for row in job["result"]} == {
+        category: dict(total, revenue=round(total["revenue"], 2)) for category, total in expected.items()}
+    assert [row["products"] for row in job["result"] if row["category"] == "Electronics"] == [3]
+    revenues = [row["revenue"] for row in job["result"]]
+    assert revenues == sorted(revenues, reverse=True)
+
+    assert client.post("/reports/revenue-by-category", json={"start": "yesterday"}).status_code == 400
+    assert client.post("/reports/no-such-report").status_code == 404
+    assert client.get(f"/reports/jobs/{'0' * 32}").status_code == 404
+    assert client.get(f"/reports/jobs/{'0' * 32}/events").status_code == 404
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def wait_for(condition, timeout=5.0):
+    import time
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_swr_cache_serves_fresh_entries(import_service):
+    """Test that an entry younger than the soft TTL is served without calling the loader."""
+    import_service("sales_service")
+    from swr_cache import StaleWhileRevalidateCache
+
+    clock = FakeClock()
+    cache = StaleWhileRevalidateCache(soft_ttl=10, hard_ttl=60, clock=clock)
+    loader = MagicMock(return_value="v1")
+
+    assert cache.get("k", loader) == ("v1", 0.0, False)
+    clock.now += 5
+    assert cache.get("k", loader) == ("v1", 5.0, False)
+    assert loader.call_count == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_swr_cache_refreshes_stale_entries_in_background(import_service):
+    """Test that a stale entry is served at once while one background load replaces it."""
+    import threading
+    import_service("sales_service")
+    from swr_cache import StaleWhileRevalidateCache
+
+    clock = FakeClock()
+    cache = StaleWhileRevalidateCache(soft_ttl=10, hard_ttl=60, clock=clock)
+    cache.get("k", lambda: "v1")
+    clock.now += 20
+
+    release = threading.Event()
+    loader = MagicMock(side_effect=lambda: release.wait(5) and "v2")
+    assert cache.get("k", loader) == ("v1", 20.0, True)
+    # A second stale read joins the refresh in flight
+    assert cache.get("k", loader) == ("v1", 20.0, True)
+    assert cache.stats()["coalesced"] == 1
+    release.set()
+    wait_for(lambda: cache.get("k", loader).value == "v2")
+    assert loader.call_count == 1
+    assert cache.stats()["refreshes"] == 1
+
+
+def test_swr_cache_serves_stale_entries_while_refreshes_fail(import_service):
+    """Test that a failing loader keeps the stale entry served and is not retried before retry_after."""
+    import_service("sales_service")
+    from swr_cache import StaleWhileRevalidateCache
+
+    clock = FakeClock()
+    cache = StaleWhileRevalidateCache(soft_ttl=10, hard_ttl=60, retry_after=15, clock=clock)
+    cache.get("k", lambda: "v1")
+    clock.now += 20
+
+    loader = MagicMock(side_effect=ConnectionError("down"))
+    assert cache.get("k", loader) == ("v1", 20.0, True)
+    wait_for(lambda: cache.stats()["refresh_errors"] == 1)
+
+    clock.now += 5
+    assert cache.get("k", loader) == ("v1", 25.0, True)
+    assert loader.call_count == 1
+
+    clock.now += 15
+    assert cache.get("k", loader) == ("v1", 40.0, True)
+    wait_for(lambda: cache.stats()["refresh_errors"] == 2)
+    assert loader.call_count == 2
+
+
+def test_swr_cache_loads_expired_entries_synchronously(import_service):
+    """Test that an entry past the hard TTL is not served and loader errors reach the caller."""
+    import_service("sales_service")
+    from swr_cache import StaleWhileRevalidateCache
+
+    clock = FakeClock()
+    cache = StaleWhileRevalidateCache(soft_ttl=10, hard_ttl=60, clock=clock)
+    cache.get("k", lambda: "v1")
+    clock.now += 60
+
+    with pytest.raises(ConnectionError):
+        cache.get("k", MagicMock(side_effect=ConnectionError("down")))
+    assert cache.get("k", lambda: "v2") == ("v2", 0.0, False)
+    assert cache.stats()["misses"] == 3
+
+
+@pytest.fixture
+def sales_app(tmp_path, import_service, monkeypatch):
+    """The sales app in-process on SQLite, without its background threads."""
+    import_service("sales_service")
+    import app as sales
+    from config import TestingConfig
+
+    class Config(TestingConfig):
+        SALES_ARCHIVE_DIR = str(tmp_path / "archive")
+        SALES_JOURNAL_DIR = str(tmp_path / "journal")
+        REPORT_JOBS_DIR = str(tmp_path / "jobs")
+
+    # Profiled routes write their logs to the working directory
+    monkeypatch.chdir(tmp_path)
+    app = sales.create_app(Config)
+    for worker in ("catalog", "co_purchases", "compensator"):
+        monkeypatch.setattr(app.extensions[worker], "start", lambda: None)
+    return sales, app
+
+
+def downstream_response(status_code, body=None):
+    response = MagicMock(status_code=status_code, headers={"Content-Type": "application/json"})
+    response.json.return_value = body
+    return response
+
+
+def prepare_sale(sales, app, monkeypatch, post):
+    product = {"id": 7, "name": "Laptop", "count_in_stock": 5, "price_per_item": 10.0}
+    monkeypatch.setattr(sales, "fetch_product_by_name", lambda name: (product, None))
+    monkeypatch.setattr(app.extensions["customers_client"], "get", lambda path, **kwargs: downstream_response(
+        200, {"id": 3, "username": "alice", "wallet_balance": 100.0}))
+    monkeypatch.setattr(app.extensions["customers_client"], "post", post)
+
+
+def test_unanswered_deduction_is_retried_then_compensated(sales_app, monkeypatch):
+    """Test that a deduction without answer is retried under its operation id and then recorded as owed."""
+    from resilience import DownstreamUnavailable
+    from models import Sale, SaleCompensation
+
+    sales, app = sales_app
+    post = MagicMock(side_effect=DownstreamUnavailable("timed out"))
+    prepare_sale(sales, app, monkeypatch, post)
+
+    response = app.test_client().post("/sale", json={"product_name": "Laptop", "username": "alice"})
+    assert response.status_code == 503
+    assert post.call_count == sales.SALE_DEDUCT_ATTEMPTS
+    operation_ids = {call.kwargs["json"]["operation_id"] for call in post.call_args_list}
+    assert len(operation_ids) == 1
+    with app.app_context():
+        (owed,) = SaleCompensation.query.all()
+        assert (owed.reason, owed.username, owed.amount) == ("deduct", "alice", 10.0)
+        assert operation_ids == {f"sale-{owed.uid}"}
+        assert Sale.query.count() == 0
+
+
+def test_deduction_answered_by_a_retry_completes_the_sale(sales_app, monkeypatch):
+    """Test that a retried deduction that is answered lets the sale go through without compensation."""
+    from resilience import DownstreamUnavailable
+    from models import Sale, SaleCompensation
+
+    sales, app = sales_app
+    post = MagicMock(side_effect=[
+        DownstreamUnavailable("timed out"),
+        downstream_response(200, {"duplicate": True}),
+    ])
+    prepare_sale(sales, app, monkeypatch, post)
+    monkeypatch.setattr(app.extensions["inventory_client"], "post", lambda path, **kwargs: downstream_response(200))
+
+    response = app.test_client().post("/sale", json={"product_name": "Laptop", "username": "alice"})
+    assert response.status_code == 200
+    with app.app_context():
+        assert Sale.query.count() == 1
+        assert SaleCompensation.query.count() == 0
+
+
+def test_failed_refund_is_recorded_and_settled(sales_app, monkeypatch):
+    """Test that a refund that fails is recorded, and sent again by the compensator."""
+    from resilience import DownstreamUnavailable
+    from models import SaleCompensation
+
+    sales, app = sales_app
+    post = MagicMock(side_effect=[downstream_response(200), DownstreamUnavailable("timed out")])
+    prepare_sale(sales, app, monkeypatch, post)
+    monkeypatch.setattr(app.extensions["inventory_client"], "post", lambda path, **kwargs: downstream_response(400))
+
+    response = app.test_client().post("/sale", json={"product_name": "Laptop", "username": "alice"})
+    assert response.status_code == 400
+    with app.app_context():
+        (owed,) = SaleCompensation.query.all()
+        assert owed.reason == "refund"
+        uid = owed.uid
+
+    post.side_effect = None
+    post.return_value = downstream_response(200)
+    assert app.extensions["compensator"].run_once() == 1
+    assert post.call_args.kwargs["json"] == {"amount": 10.0, "operation_id": f"refund-{uid}"}
+    with app.app_context():
+        owed = SaleCompensation.query.one()
+        assert (owed.outcome, owed.attempts) == ("refunded", 1)
+        assert app.extensions["compensator"].stats()["open"] == 0
+
+
+def test_compensator_refunds_only_recorded_deductions(sales_app, monkeypatch):
+    """Test that an unanswered deduction is refunded only if the customer's ledger holds it."""
+    import compensation
+    from db import db
+    from models import SaleCompensation
+
+    sales, app = sales_app
+    client = app.extensions["customers_client"]
+    monkeypatch.setattr(app.extensions["compensator"], "grace", 0)
+    with app.app_context():
+        compensation.owe("a" * 32, "alice", 10.0, compensation.DEDUCT, "timed out")
+        compensation.owe("b" * 32, "alice", 20.0, compensation.DEDUCT, "timed out")
+
+    ledger = {"entries": [{"operation_id": f"sale-{'a' * 32}"}], "next_before": None}
+    monkeypatch.setattr(client, "get", MagicMock(return_value=downstream_response(200, ledger)))
+    post = MagicMock(return_value=downstream_response(200))
+    monkeypatch.setattr(client, "post", post)
+
+    assert app.extensions["compensator"].run_once() == 2
+    post.assert_called_once()
+    assert post.call_args.kwargs["json"] == {"amount": 10.0, "operation_id": f"refund-{'a' * 32}"}
+    with app.app_context():
+        outcomes = dict(db.session.execute(db.select(SaleCompensation.uid, SaleCompensation.outcome)).all())
+        assert outcomes == {"a" * 32: "refunded", "b" * 32: "not-deducted"}
+
+
+def test_unexpected_error_resolves_half_open_probe(import_service):
+    """Test that a probe failing with an error other than a request error reopens the circuit."""
+    import_service("sales_service")
+    from resilience import CircuitBreaker, Downstream
+
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    client = Downstream("customers", "http://customers", breaker=breaker)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    with patch.object(client, "_session") as session:
+        session.return_value.request.side_effect = ValueError("bad header")
+        with pytest.raises(ValueError):
+            client.get("/customers/alice")
+    assert breaker.state == CircuitBreaker.OPEN
+    assert client.stats()["failures"] == 1
+
+
+def test_concurrent_identical_gets_share_one_call(import_service):
+    """Test that concurrent GETs of the same resource make one downstream call."""
+    import threading
+    import_service("sales_service")
+    from resilience import Downstream
+
+    callers = 8
+    client = Downstream("inventory", "http://inventory", coalesce_gets=True)
+    release = threading.Event()
+    results = []
+
+    with patch.object(client, "_session") as session:
+        session.return_value.request.side_effect = lambda *args, **kwargs: release.wait(5) and MagicMock(status_code=200)
+        threads = [
+            threading.Thread(target=lambda: results.append(client.get("/inventory", params={"page": 1})))
+            for _ in range(callers)
+        ]
+        for thread in threads:
+            thread.start()
+        wait_for(lambda: client.single_flight.stats()["coalesced"] == callers - 1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+    assert session.return_value.request.call_count == 1
+    assert len(results) == callers and all(result is results[0] for result in results)
+    assert client.single_flight.stats() == {"executed": 1, "coalesced": callers - 1, "in_flight": 0}
+
+
+def test_expired_request_deadline_is_rejected(sales_app):
+    """Test that a request whose X-Request-Deadline has passed is answered 504 without running."""
+    import time
+    from resilience import DEADLINE_HEADER, DeadlineExceeded
+
+    sales, app = sales_app
+    expired = str(int((time.time() - 1) * 1000))
+    with patch.object(sales, "fetch_product_by_name") as fetch:
+        response = app.test_client().post("/sale", json={"product_name": "Laptop", "username": "alice"},
+                                          headers={DEADLINE_HEADER: expired})
+    assert response.status_code == 504
+    fetch.assert_not_called()
+
+    with patch.object(app.extensions["customers_client"], "_session") as session:
+        with pytest.raises(DeadlineExceeded):
+            app.extensions["customers_client"].get("/customers/alice", deadline=time.time() - 1)
+    session.assert_not_called()
+
+
+def test_compressed_stream_chunks_decode_on_arrival(import_service):
+    """Test that each compressed chunk of a streamed response can be decoded before the stream ends."""
+    import zlib
+    import_service("sales_service")
+    from compression import ENCODINGS, compress_stream
+
+    decoders = {"gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS).decompress}
+    if "br" in ENCODINGS:
+        import brotli
+        decoders["br"] = lambda: brotli.Decompressor().process
+    if "zstd" in ENCODINGS:
+        import zstandard
+        decoders["zstd"] = lambda: zstandard.ZstdDecompressor().decompressobj().decompress
+
+    events = ["event: state\ndata: {\"state\": \"queued\"}\n\n", ": keep-alive\n\n", b"event: done\ndata: {}\n\n"]
+    for encoding in ENCODINGS:
+        decode = decoders[encoding]()
+        stream = compress_stream(iter(events), encoding)
+        for event in events:
+            expected = event.encode() if isinstance(event, str) else event
+            assert decode(next(stream)) == expected, encoding
+        decode(next(stream))
+        with pytest.raises(StopIteration):
+            next(stream)
+
+
+def test_tracing_settings_come_from_config(tmp_path, import_service):
+    """Test that the trace sample rate and span file are read from the app's config."""
+    import_service("sales_service")
+    from flask import Flask
+    from tracing import FileExporter, InMemoryExporter, init_tracing
+
+    app = Flask(__name__)
+    app.config.update(TRACE_SAMPLE_RATE=0.25, TRACE_FILE=str(tmp_path / "spans.jsonl"))
+    tracer = init_tracing(app, "sales")
+    assert tracer.sample_rate == 0.25
+    assert isinstance(tracer.exporter, FileExporter)
+
+    tracer = init_tracing(Flask(__name__), "sales")
+    assert tracer.sample_rate == 0.0
+    assert isinstance(tracer.exporter, InMemoryExporter)
+
+
+def test_statement_shape(import_service):
+    """Test that statements differing only in literals have the same shape."""
+    import_service("sales_service")
+    from sqlstats import statement_shape
+
+    assert statement_shape("SELECT * FROM sale WHERE id = 42 AND uid = 'it''s'") == \
+        "SELECT * FROM sale WHERE id = ? AND uid = ?"
+    assert statement_shape("SELECT * FROM sale\n  WHERE id IN (1, 2, 3)") == \
+        statement_shape("SELECT * FROM sale WHERE id IN (7)") == \
+        "SELECT * FROM sale WHERE id IN (?)"
+    assert statement_shape("SELECT * FROM sale WHERE total_price > 9.5 LIMIT ?") == \
+        "SELECT * FROM sale WHERE total_price > ? LIMIT ?"
+    assert statement_shape("SELECT col1 FROM t2") == "SELECT col1 FROM t2"
+
+
+def test_query_stats(import_service):
+    """Test that the process-wide totals add up per shape and rank by total time."""
+    import threading
+    import_service("sales_service")
+    from sqlstats import QueryStats
+
+    stats = QueryStats()
+    stats.record("SELECT a", 5.0)
+    stats.record("SELECT b", 1.0)
+    stats.record("SELECT a", 7.0)
+
+    def count():
+        for _ in range(1000):
+            stats.record("SELECT b", 0.0)
+            stats.record_slow_query()
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert stats.top() == [
+        {"statement": "SELECT a", "count": 2, "total_ms": 12.0, "max_ms": 7.0},
+        {"statement": "SELECT b", "count": 4001, "total_ms": 1.0, "max_ms": 1.0},
+    ]
+    assert stats.top(1)[0]["statement"] == "SELECT a"
+    assert stats.counters() == {"slow_queries": 4000, "n_plus_one_warnings": 0}
+
+
+def test_sql_instrumentation_reports_n_plus_one(tmp_path, import_service, monkeypatch):
+    """Test the Server-Timing header, the N+1 warning and the slow-query plan through the app."""
+    import_service("sales_service")
+    from flask import jsonify
+    from app import create_app
+    from config import TestingConfig
+    from db import db
+    from models import Sale
+
+    class Config(TestingConfig):
+        SQL_INSTRUMENTATION = True
+        SQL_N_PLUS_ONE_THRESHOLD = 3
+        SQL_SLOW_QUERY_MS = 0.0
+        SALES_ARCHIVE_DIR = str(tmp_path / "archive")
+        REPORT_JOBS_DIR = str(tmp_path / "jobs")
+
+    monkeypatch.chdir(tmp_path)
+    app = create_app(Config)
+
+    @app.route("/test/prices")
+    def prices():
+        # One query per sale, as an N+1 would
+        ids = db.session.scalars(db.select(Sale.id)).all()
+        return jsonify([db.session.get(Sale, sale_id).total_price for sale_id in ids])
+
+    with app.app_context():
+        db.session.add_all([Sale(customer_id=1, product_id=i, quantity=1, total_price=i) for i in range(5)])
+        db.session.commit()
+
+    client = app.test_client()
+    response = client.get("/test/prices")
+    assert response.status_code == 200
+    assert response.headers["Server-Timing"].endswith('desc="6 queries"')
+    stats = client.get("/sql/stats").get_json()
+    assert stats["n_plus_one_warnings"] == 1
+    assert stats["slow_queries"] >= 6
+
+
+def test_failed_explain_keeps_the_transaction(tmp_path, import_service):
+    """Test that a failing EXPLAIN neither fails nor commits the surrounding transaction."""
+    import_service("sales_service")
+    from app import create_app
+    from config import TestingConfig
+    from db import db
+    from models import Sale
+    from sqlstats import explain
+
+    app = create_app(TestingConfig)
+    with app.app_context():
+        db.session.add(Sale(customer_id=1, product_id=1, quantity=1, total_price=1.0))
+        db.session.flush()
+        conn = db.session.connection()
+        assert explain(conn, "SELECT * FROM missing_table", ()) is None
+        assert "sale" in explain(conn, "SELECT * FROM sale WHERE id = ?", (1,))
+        assert Sale.query.count() == 1
+        db.session.rollback()
+        assert Sale.query.count() == 0
+
+
+@pytest.fixture
+def sales_db_app(tmp_path, import_service, monkeypatch):
+    """The sales app on a SQLite file, which background threads can share."""
+    import_service("sales_service")
+    from app import create_app
+    from config import TestingConfig
+
+    class Config(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'sales.db'}"
+        SALES_ARCHIVE_DIR = str(tmp_path / "archive")
+        SALES_JOURNAL_DIR = str(tmp_path / "journal")
+        REPORT_JOBS_DIR = str(tmp_path / "jobs")
+
+    monkeypatch.chdir(tmp_path)
+    return create_app(Config)
+
+
+def test_sale_writer_flushes_on_close(sales_db_app):
+    """Test that sales still pending when the writer closes are committed."""
+    from models import Sale
+    from sale_writer import SaleWriter
+
+    app = sales_db_app
+    journal = app.config["SALES_JOURNAL_DIR"]
+    writer = SaleWriter(app, journal, batch_size=1000, flush_interval=60)
+    writer.start()
+    uids = [writer.submit(1, product, 1, 10.0)["uid"] for product in range(3)]
+    with app.app_context():
+        assert Sale.query.count() == 0
+    assert writer.stats()["pending"] == 3
+
+    writer.close()
+    with app.app_context():
+        assert sorted(sale.uid for sale in Sale.query.all()) == sorted(uids)
+    assert os.listdir(journal) == []
+    assert writer.stats()["written"] == 3
+
+
+def test_sale_writer_shares_fsyncs(sales_db_app, monkeypatch):
+    """Test that concurrent sales are appended while another is being fsynced, and share the next fsync."""
+    import threading
+    import time
+    from models import Sale
+    from sale_writer import SaleWriter
+
+    fsync = os.fsync
+    synced = []
+
+    def slow_fsync(fd):
+        time.sleep(0.05)
+        fsync(fd)
+        synced.append(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+    app = sales_db_app
+    writer = SaleWriter(app, app.config["SALES_JOURNAL_DIR"], batch_size=1000, flush_interval=60)
+    writer.start()
+    uids = []
+
+    def submit(customer):
+        for product in range(5):
+            uids.append(writer.submit(customer, product, 1, 10.0)["uid"])
+
+    threads = [threading.Thread(target=submit, args=(customer,)) for customer in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(uids) == 40
+        assert writer.stats()["fsyncs"] == len(synced) < 40
+    finally:
+        writer.close()
+    with app.app_context():
+        assert sorted(sale.uid for sale in Sale.query.all()) == sorted(uids)
+
+def test_sale_writer_replays_orphaned_journal(sales_db_app):
+    """Test that a crashed writer's journal is replayed once, and a live writer's is left alone."""
+    import fcntl
+    from db import db
+    from models import Sale
+    from sale_writer import SaleWriter
+
+    app = sales_db_app
+    journal = app.config["SALES_JOURNAL_DIR"]
+    os.makedirs(journal)
+    record = {"customer_id": 1, "product_id": 2, "quantity": 1, "total_price": 5.0,
+              "timestamp": "2024-05-01T12:00:00"}
+    with app.app_context():
+        # Committed just before the crash, so replaying it must not duplicate it
+        db.session.add(Sale(uid="a" * 32, customer_id=1, product_id=2, quantity=1, total_price=5.0))
+        db.session.commit()
+    with open(os.path.join(journal, "sales-1-1-1.jsonl"), "w") as f:
+        f.write(json.dumps(dict(record, uid="a" * 32)) + "\n")
+        f.write(json.dumps(dict(record, uid="b" * 32)) + "\n")
+        f.write('{"uid": "torn')
+    live = open(os.path.join(journal, "sales-2-1-1.jsonl"), "w")
+    live.write(json.dumps(dict(record, uid="c" * 32)) + "\n")
+    live.flush()
+    fcntl.flock(live, fcntl.LOCK_EX)
+
+    writer = SaleWriter(app, journal, batch_size=1000, flush_interval=60)
+    try:
+        writer.start()
+        assert writer.stats()["recovered"] == 2
+        assert writer.flush()
+        with app.app_context():
+            assert sorted(sale.uid for sale in Sale.query.all()) == ["a" * 32, "b" * 32]
+        assert not os.path.exists(os.path.join(journal, "sales-1-1-1.jsonl"))
+        assert os.path.exists(live.name)
+    finally:
+        writer.close()
+        live.close()
+
+
+def add_sales(app, count, start):
+    """Add ``count`` sales, one hour apart from ``start``, over 4 customers and 5 products."""
+    import datetime
+    from db import db
+    from models import Sale
+
+    with app.app_context():
+        db.session.add_all([
+            Sale(uid=f"{i:032x}", customer_id=i % 4, product_id=i % 5, quantity=1 + i % 3,
+                 total_price=1.25 * (1 + i % 7), timestamp=start + datetime.timedelta(hours=i))
+            for i in range(count)
+        ])
+        db.session.commit()
+
+
+def test_sale_archive_answers_like_the_table(sales_db_app):
+    """Test that history and rollups are the same before and after sales move to the archive."""
+    import datetime
+    from archive import SaleArchive, sales_history, sales_rollup
+    from models import Sale
+
+    app = sales_db_app
+    start = datetime.datetime(2024, 1, 30)
+    add_sales(app, 200, start)
+    archive = SaleArchive(app.config["SALES_ARCHIVE_DIR"], cache_size=4)
+    window = (start + datetime.timedelta(hours=20), start + datetime.timedelta(hours=150))
+
+    def answers():
+        return {
+            "history": sales_history(archive, 1, limit=30),
+            "page": sales_history(archive, 1, before=120, limit=10),
+            "by_product": sales_rollup(archive, "product_id"),
+            "by_customer": sales_rollup(archive, "customer_id", *window),
+        }
+
+    with app.app_context():
+        before = answers()
+        assert archive.archive(start + datetime.timedelta(hours=100), batch_size=30) == 100
+        assert Sale.query.count() == 100
+        assert answers() == before
+
+    stats = archive.stats()
+    assert stats["rows"] == 100
+    assert stats["months"] == ["2024-01", "2024-02"]
+    assert not any(name.endswith(".pending") for _, _, names in os.walk(archive.directory) for name in names)
+
+
+def test_sale_archive_recovers_interrupted_runs(sales_db_app):
+    """Test that a pending segment is kept if its batch was deleted and dropped otherwise."""
+    import datetime
+    from archive import SaleArchive, write_segment
+    from db import db
+    from models import Sale
+
+    app = sales_db_app
+    add_sales(app, 10, datetime.datetime(2024, 5, 1))
+    archive = SaleArchive(app.config["SALES_ARCHIVE_DIR"])
+    month = os.path.join(archive.directory, "2024-05")
+    os.makedirs(month)
+    with app.app_context():
+        sales = Sale.query.order_by(Sale.id).all()
+        # Crashed after its delete committed: the segment is the only copy
+        committed = os.path.join(month, f"sales-{sales[0].id}-{sales[4].id}.col")
+        write_segment(committed + ".pending", sales[:5])
+        # Crashed before its delete committed: the sales are still in the table
+        rolled_back = os.path.join(month, f"sales-{sales[5].id}-{sales[9].id}.col")
+        write_segment(rolled_back + ".pending", sales[5:])
+        db.session.execute(db.delete(Sale).where(Sale.id.in_([sale.id for sale in sales[:5]])))
+        db.session.commit()
+
+        assert archive.archive(datetime.datetime(2024, 1, 1)) == 0
+        assert os.path.exists(committed)
+        assert not os.path.exists(rolled_back) and not os.path.exists(rolled_back + ".pending")
+        assert archive.stats()["rows"] == 5
+
+        assert archive.archive(datetime.datetime(2025, 1, 1)) == 5
+        assert archive.stats()["rows"] == 10
+        assert Sale.query.count() == 0
+
+
+def test_archive_sales_refuses_ephemeral_storage(sales_db_app, monkeypatch, tmp_path):
+    """Test that archive-sales archives nothing unless the archive directory is on a persistent mount."""
+    import datetime
+    import archive
+    from models import Sale
+
+    app = sales_db_app
+    add_sales(app, 5, datetime.datetime(2024, 5, 1))
+    directory = os.path.realpath(app.config["SALES_ARCHIVE_DIR"])
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(
+        "22 1 0:21 / / rw,relatime - overlay overlay rw,lowerdir=/l,upperdir=/u\n"
+        "23 22 0:22 / /dev/shm rw - tmpfs shm rw\n"
+    )
+    monkeypatch.setattr(archive, "MOUNTINFO", str(mountinfo))
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=["archive-sales", "--older-than-days", "0"])
+    assert result.exit_code != 0
+    assert "overlay" in result.output
+    with app.app_context():
+        assert Sale.query.count() == 5
+
+    # A volume mounted on a parent of the directory, its path escaped as the kernel does
+    volume = os.path.dirname(directory)
+    with open(mountinfo, "a") as f:
+        f.write(f"24 22 8:1 /volumes/archive {volume.replace(' ', chr(92) + '040')} rw - ext4 /dev/sda1 rw\n")
+    assert archive.filesystem_type(directory) == "ext4"
+    assert archive.filesystem_type("/dev/shm/x") == "tmpfs"
+    result = runner.invoke(args=["archive-sales", "--older-than-days", "0"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert Sale.query.count() == 0
+
+def test_co_purchase_index_update_matches_build(sales_db_app):
+    """Test that incremental updates, including archived sales, give the index a full build gives."""
+    import datetime
+    from archive import SaleArchive
+    from db import db
+    from models import Sale
+    from recommendations import CoPurchaseIndex
+
+    app = sales_db_app
+    archive = SaleArchive(app.config["SALES_ARCHIVE_DIR"])
+    add_sales(app, 60, datetime.datetime(2024, 1, 1))
+    with app.app_context():
+        archive.archive(datetime.datetime(2024, 1, 2))
+        updated = CoPurchaseIndex(app, archive, top_k=3)
+        updated.build()
+
+        db.session.add_all([
+            Sale(customer_id=customer, product_id=product, quantity=1, total_price=1.0)
+            for customer, product in [(1, 0), (7, 2), (7, 3), (7, 4), (8, 3), (8, 4), (8, 9), (1, 9)]
+        ])
+        db.session.commit()
+        assert updated.update() == 7
+
+        built = CoPurchaseIndex(app, archive, top_k=3)
+        built.build()
+
+    for product in range(10):
+        assert updated.related(product) == built.related(product)
+    # Bought by customer 8 with products 3 and 4, and by customer 1 with products 0 to 4
+    assert updated.related(9) == ((3, 2), (4, 2), (0, 1))
+    for key in ("customers", "products", "pairs", "last_sale_id"):
+        assert updated.stats()[key] == built.stats()[key]
+
+
+def test_migrations_create_the_schema(tmp_path, import_service, monkeypatch):
+    """Test that upgrading an empty database creates the schema of the models."""
+    import_service("sales_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+
+    monkeypatch.chdir(tmp_path)
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'sales.db'}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context(), db.engine.connect() as connection:
+        assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+
+
+def test_migrations_upgrade_a_database_created_before_them(tmp_path, import_service, monkeypatch):
+    """Test that the migrations bring a database created by the original init-db up to date."""
+    import sqlite3
+    import_service("sales_service")
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from app import create_app
+    from db import db
+    from models import Sale
+    from sqlalchemy.exc import IntegrityError
+
+    path = tmp_path / "sales.db"
+    connection = sqlite3.connect(path)
+    connection.execute("""
+        CREATE TABLE sale (
+            id INTEGER NOT NULL, customer_id INTEGER NOT NULL, product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL, total_price FLOAT NOT NULL,
+            timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP), PRIMARY KEY (id)
+        )
+    """)
+    connection.execute("INSERT INTO sale (id, customer_id, product_id, quantity, total_price) VALUES (1, 3, 7, 2, 20.0)")
+    connection.commit()
+    connection.close()
+
+    monkeypatch.chdir(tmp_path)
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+        "SQLALCHEMY_BINDS": {},
+    })
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context(), db.engine.connect() as connection:
+        assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+
+    with app.app_context():
+        assert db.session.get(Sale, 1).uid is None
+        db.session.add_all([Sale(customer_id=3, product_id=8, quantity=1, total_price=5.0, uid="a" * 32),
+                            Sale(customer_id=3, product_id=9, quantity=1, total_price=5.0, uid="a" * 32)])
+        with pytest.raises(IntegrityError):
+            db.session.commit()